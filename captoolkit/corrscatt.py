@@ -11,6 +11,25 @@ Notes:
     - The (back)scattering correction is applied as:
         h_corr = h - h_bs
 
+    - Grid nodes without data within the search radius are skipped
+      before the node loop. Nodes can also be restricted to a raster
+      mask (--mask file, GeoTIFF or HDF5 with x/y/mask in -j proj).
+
+    - By default nodes are solved in batches (-m vec): the data of -k
+      nodes are gathered into padded arrays and the whole pipeline is
+      computed for all nodes at once. Use -m loop for the original node
+      loop (always used in TEST_MODE).
+
+    - Nodes of each file can be solved in parallel (-c n_cores). The
+      best estimate for each data point (lowest p_std, first node on
+      ties) is selected after all nodes are solved, so the results are
+      the same as the sequential run.
+
+    - The fitted coefficients are also saved on the node grid (_SCATGRD
+      file). New data (e.g. new cycles) can be corrected with a saved
+      grid (-g file) by bilinear interpolation of the coefficients, with
+      no fitting. Only h_bs is saved (and applied with -a) in this mode.
+
     - Edit parameters below.
 
 Example:
@@ -97,6 +116,15 @@ WINDOW = 15
 ORDER = 1
 DERIV = 1
 
+# Default engine: batched nodes (vec) or node by node (loop)
+ENGINE = "vec"
+
+# Default number of nodes per batch (vec engine)
+CHUNK = 100
+
+# Default number of cores to solve the nodes of each file
+NCORES = 1
+
 # ----------------------------------------------------------------
 
 # Supress anoying warnings
@@ -217,6 +245,52 @@ def get_args():
         help=("apply correction to height in addition to saving"),
         default=False,
     )
+    parser.add_argument(
+        "--mask",
+        metavar="file",
+        dest="mask",
+        type=str,
+        nargs=1,
+        help=("raster mask (GeoTIFF or HDF5 x/y/mask) to select grid nodes"),
+        default=[None],
+    )
+    parser.add_argument(
+        "-m",
+        metavar=None,
+        dest="engine",
+        type=str,
+        nargs=1,
+        help=("solve nodes in batches or one by one (vec|loop)"),
+        choices=("vec", "loop"),
+        default=[ENGINE],
+    )
+    parser.add_argument(
+        "-k",
+        metavar="chunk",
+        dest="chunk",
+        type=int,
+        nargs=1,
+        help=("number of nodes per batch (vec engine)"),
+        default=[CHUNK],
+    )
+    parser.add_argument(
+        "-c",
+        metavar="n_cores",
+        dest="ncores",
+        type=int,
+        nargs=1,
+        help=("for parallel processing of the nodes of each file"),
+        default=[NCORES],
+    )
+    parser.add_argument(
+        "-g",
+        metavar="grid",
+        dest="fgrid",
+        type=str,
+        nargs=1,
+        help=("apply coefficient grid (%s file) instead of fitting" % SUFFIX2),
+        default=[None],
+    )
     return parser.parse_args()
 
 
@@ -635,6 +709,166 @@ def get_radius_idx(
     return idx
 
 
+def cap_median(arrs, caps):
+    """ Median of each array over the indices of each cap (NaN if empty). """
+    n = np.array([len(c) for c in caps])
+    valid = np.arange(max(n.max(), 1)) < n[:, None]
+    i_pad = np.zeros(valid.shape, dtype=int)
+    i_pad[valid] = np.concatenate(caps)
+    i_row = np.arange(len(caps))
+    i_lo, i_hi = np.maximum((n - 1) // 2, 0), np.maximum(n // 2, 0)
+    meds = []
+    for a in arrs:
+        A = np.sort(np.where(valid, a[i_pad], np.inf), axis=1)
+        med = 0.5 * (A[i_row, i_lo] + A[i_row, i_hi])
+        meds.append(np.where(n > 0, med, np.nan))
+    return meds
+
+
+def get_radius_idx_batch(x, y, x0, y0, r, Tree, n_reloc=0):
+    """
+    Get indices of all data points inside radius of each node.
+
+    Same as get_radius_idx for arrays of nodes (x0, y0): all nodes are
+    queried and relocated at once, and indices are in the same order as
+    for a single node. A node stops relocating when the total relocation
+    is larger than the search radius, or when its center no longer moves
+    (the cap would not change).
+
+    Returns the indices of each node, and the last relocation distance.
+    """
+    x0, y0 = np.asarray(x0, dtype=float), np.asarray(y0, dtype=float)
+
+    # Query the Tree from the nodes
+    idx = Tree.query_ball_point(
+        np.c_[x0, y0], r, workers=-1, return_sorted=False
+    )
+
+    reloc_dist = np.zeros(len(x0))
+
+    # Nodes with enough points to do relocation
+    active = np.array([len(i) >= 2 for i in idx], dtype=bool)
+    xc, yc = x0.copy(), y0.copy()
+
+    # Relocate center of search radius and query again
+    for k in range(n_reloc):
+
+        (i_act,) = np.where(active)
+
+        if len(i_act) == 0:
+            break
+
+        # Compute new search locations => median of each cap
+        x_new, y_new = cap_median([x, y], [idx[i] for i in i_act])
+
+        # Compute relocation distance
+        reloc_dist[i_act] = np.hypot(x_new - x0[i_act], y_new - y0[i_act])
+
+        # Do not allow total relocation to be larger than the search radius
+        move = ~(reloc_dist[i_act] > r) & ~np.isnan(x_new)
+        move &= (x_new != xc[i_act]) | (y_new != yc[i_act])
+
+        active[i_act[~move]] = False
+        i_act, x_new, y_new = i_act[move], x_new[move], y_new[move]
+
+        if len(i_act) == 0:
+            break
+
+        # Query from the new locations
+        idx_new = Tree.query_ball_point(
+            np.c_[x_new, y_new], r, workers=-1, return_sorted=False
+        )
+
+        for i, i_new in zip(i_act, idx_new):
+            idx[i] = i_new
+
+        xc[i_act], yc[i_act] = x_new, y_new
+
+    return list(idx), reloc_dist
+
+
+def geotiffread(ifile):
+    """ Read Geotiff file """
+
+    from osgeo import gdal, osr
+
+    file = gdal.Open(ifile, gdal.GA_ReadOnly)
+
+    projection = file.GetProjection()
+    src = osr.SpatialReference()
+    src.ImportFromWkt(projection)
+    proj = src.ExportToWkt()
+
+    Nx = file.RasterXSize
+    Ny = file.RasterYSize
+
+    trans = file.GetGeoTransform()
+
+    dx = trans[1]
+    dy = trans[5]
+
+    Xp = np.arange(Nx)
+    Yp = np.arange(Ny)
+
+    (Xp, Yp) = np.meshgrid(Xp, Yp)
+
+    X = trans[0] + (Xp + 0.5) * trans[1] + (Yp + 0.5) * trans[2]
+    Y = trans[3] + (Xp + 0.5) * trans[4] + (Yp + 0.5) * trans[5]
+
+    band = file.GetRasterBand(1)
+
+    Z = band.ReadAsArray()
+
+    dx = np.abs(dx)
+    dy = np.abs(dy)
+
+    return X, Y, Z, dx, dy, proj
+
+
+def read_mask(fmask):
+    """Read raster mask: GeoTIFF or HDF5 grid with "x", "y" and "mask"."""
+
+    if fmask.endswith((".tif", ".tiff")):
+        X, Y, Z = geotiffread(fmask)[:3]
+        return X[0, :], Y[:, 0], Z
+    else:
+        with h5py.File(fmask, "r") as f:
+            return f["x"][:], f["y"][:], f["mask"][:]
+
+
+def node_mask(xi, yi, Tree, dmax, fmask=None):
+    """Flag grid nodes with data within dmax and inside (raster) mask.
+
+    Nodes outside the mask extent, or where the mask is zero/NaN, are
+    flagged False. dmax can be a scalar or an array (one per node).
+    """
+
+    # Distance to closest observation for all nodes
+    d = Tree.query(np.c_[xi, yi], k=1, distance_upper_bound=np.max(dmax),
+                   workers=-1)[0]
+
+    # Nodes with data within search radius
+    keep = d <= dmax
+
+    if fmask:
+
+        # Read mask (same projection as grid)
+        xm, ym, zm = read_mask(fmask)
+
+        # Closest mask pixel for each node
+        j = np.round((xi - xm[0]) / (xm[1] - xm[0])).astype(int)
+        i = np.round((yi - ym[0]) / (ym[1] - ym[0])).astype(int)
+
+        # Nodes inside mask extent
+        inside = (i >= 0) & (i < len(ym)) & (j >= 0) & (j < len(xm))
+
+        # Nodes inside mask
+        keep &= inside
+        keep[inside] &= zm[i[inside], j[inside]] > 0
+
+    return keep
+
+
 def multi_fit_coef(t_, h_, bs_, lew_, tes_):
     """
     Calculate scattering correction for height time series.
@@ -1033,132 +1267,451 @@ def plot(
     plt.show()
 
 
-def main(
-    ifile,
-    vnames,
-    wnames,
-    dxy,
-    proj,
-    radius=0,
-    n_reloc=0,
-    proc=None,
-    apply_=False,
-):
+""" Batched functions (padded nodes x obs arrays) """
 
-    if is_empty(ifile):
-        print("empty file... skipping!!!")
-        return
 
-    if TEST_MODE:
-        print("*********************************************************")
-        print("* RUNNING IN TEST MODE (PLOTTING ONLY, NOT SAVING DATA) *")
-        print("*********************************************************")
+def pad_series(arrs, caps):
+    """
+    Gather the data of each cap into padded (nodes x obs) arrays.
 
-    print(("processing file:", ifile, "..."))
+    Entries beyond the number of obs in each cap are set to NaN.
+    """
+    n = np.array([len(c) for c in caps])
+    valid = np.arange(n.max()) < n[:, None]
+    i_pad = np.zeros(valid.shape, dtype=int)
+    i_pad[valid] = np.concatenate(caps)
+    return n, [np.where(valid, a[i_pad], np.nan) for a in arrs]
 
-    # Test if parameter file exists
-    if "_scatgrd" in ifile.lower():
-        return
 
-    xvar, yvar, zvar, tvar = vnames
-    bpar, wpar, spar = wnames
+def mad_std_batch(X):
+    """ Robust standard deviation (using MAD) of each row. """
+    return 1.4826 * np.nanmedian(
+        np.abs(X - np.nanmedian(X, axis=1)[:, None]), axis=1
+    )
 
-    # Load full data into memory (only once)
-    with h5py.File(ifile, "r") as fi:
 
-        t = fi[tvar][:]
-        h = fi[zvar][:]
-        lon = fi[xvar][:]
-        lat = fi[yvar][:]
-        bs = fi[bpar][:]
-        lew = fi[wpar][:]
-        tes = fi[spar][:]
+def group_median(g, v, n):
+    """ Median of values v for each group g (0..n-1), NaN if empty. """
+    i_sort = np.lexsort((v, g))
+    g, v = g[i_sort], v[i_sort]
+    count = np.bincount(g, minlength=n)
+    start = np.cumsum(count) - count
+    med = np.full(n, np.nan)
+    (i_grp,) = np.where(count > 0)
+    i_lo = start[i_grp] + (count[i_grp] - 1) // 2
+    i_hi = start[i_grp] + count[i_grp] // 2
+    med[i_grp] = 0.5 * (v[i_lo] + v[i_hi])
+    return med
 
-    # Convert into sterographic coordinates
-    x, y = transform_coord("4326", proj, lon, lat)
 
-    # Get bbox from data
-    xmin_d, xmax_d, ymin_d, ymax_d = x.min(), x.max(), y.min(), y.max()
+def binning_batch(T, Y, dx=1 / 12.0, window=3 / 12.0, median=False):
+    """
+    Time-series binning (w/overlapping windows) of each row.
 
-    # If no bbox given, limits are defined by data
-    if bbox[0] is None:
-        xmin, xmax, ymin, ymax = xmin_d, xmax_d, ymin_d, ymax_d
+    Same bins as binning() for each row of padded (nodes x obs) arrays,
+    computed for all rows at once. Returns the bin centers and the binned
+    values (nodes x bins). Empty bins are NaN in both.
+    """
+    N = T.shape[0]
+
+    tmin, tmax = np.nanmin(T, axis=1), np.nanmax(T, axis=1)
+
+    # Bin edges of each row (as in binning)
+    steps = [np.arange(t1, t2 + dx, dx) for t1, t2 in zip(tmin, tmax)]
+    nb = np.array([len(s) for s in steps])
+    N_bins = nb.max()
+
+    S = np.full((N, N_bins), np.nan)
+    S[np.arange(N_bins) < nb[:, None]] = np.concatenate(steps)
+
+    # Candidate bins for each obs (overlapping windows)
+    i_row, i_obs = np.where(~np.isnan(T))
+    t_obs = T[i_row, i_obs]
+    n_win = int(np.ceil(window / dx))
+    i_bin = np.floor((t_obs - tmin[i_row]) / dx).astype(int)[:, None]
+    i_bin = i_bin + np.arange(-n_win - 1, 2)
+    i_row = np.broadcast_to(i_row[:, None], i_bin.shape)
+
+    # Keep the bins that contain each obs
+    is_bin = (i_bin >= 0) & (i_bin < nb[i_row])
+    i_bin = np.where(is_bin, i_bin, 0)
+    t1 = S[i_row, i_bin]
+    t2 = t1 + window
+    is_bin &= (t_obs[:, None] >= t1) & (t_obs[:, None] <= t2)
+
+    # Group (row, bin) and value of each obs in each bin
+    g = (i_row * N_bins + i_bin)[is_bin]
+    v = np.broadcast_to(Y[i_row[:, 0], i_obs][:, None], is_bin.shape)[is_bin]
+
+    # Bin centers of non-empty bins
+    n_obs = np.bincount(g, minlength=N * N_bins).reshape(N, N_bins)
+    xb = np.where(n_obs > 0, 0.5 * (S + (S + window)), np.nan)
+
+    # Binned values (NaNs ignored)
+    g, v = g[~np.isnan(v)], v[~np.isnan(v)]
+
+    if median:
+        yb = group_median(g, v, N * N_bins)
     else:
-        xmin, xmax, ymin, ymax = bbox
+        n_val = np.bincount(g, minlength=N * N_bins)
+        yb = np.bincount(g, weights=v, minlength=N * N_bins) / n_val
 
-    # Grid solution - defined by nodes
-    Xi, Yi = make_grid(xmin, xmax, ymin, ymax, dxy, dxy)
+    return xb, yb.reshape(N, N_bins)
 
-    # Flatten prediction grid
-    x_nodes, y_nodes = Xi.ravel(), Yi.ravel()
 
-    """ Create output containers """
+def interp_batch(T, xb, yb):
+    """ Interpolate binned values to the obs times of each row. """
+    Y = np.full(T.shape, np.nan)
+    for i in range(T.shape[0]):
+        i_valid = ~np.isnan(xb[i])
+        if i_valid.any():
+            Y[i] = np.interp(T[i], xb[i, i_valid], yb[i, i_valid])
+    return Y
 
-    N_data = len(x)
-    N_nodes = len(x_nodes)
 
-    # Values for each data point
-    r2fit = np.full(N_data, 0.0)  # r2 of the multivar fit
-    pval = np.full(N_data, np.nan)  # r2 of the multivar fit
-    dstd = np.full(N_data, np.nan)  # magnitude std change after cor
-    dtrend = np.full(N_data, np.nan)  # magnitude trend change after cor
-    pstd = np.full(
-        N_data, np.inf
-    )  # perc std change after cor   ##NOTE: Init w/inf
-    ptrend = np.full(N_data, np.nan)  # perc trend change after cor
-    hbs = np.full(N_data, np.nan)  # scatt cor from multivar fit
-    rbs = np.full(N_data, np.nan)  # corr coef h x Bs
-    rlew = np.full(N_data, np.nan)  # corr coef h x LeW
-    rtes = np.full(N_data, np.nan)  # corr coef h x TeS
-    sbs = np.full(N_data, np.nan)  # sensit h x Bs
-    slew = np.full(N_data, np.nan)  # sensit h x LeW
-    stes = np.full(N_data, np.nan)  # sensit h x TeS
-    bbs = np.full(N_data, np.nan)  # multivar fit coef a.Bs
-    blew = np.full(N_data, np.nan)  # multivar fit coef b.LeW
-    btes = np.full(N_data, np.nan)  # multivar fit coef c.TeS
+def polyfit_batch(X, Y, order=1):
+    """
+    OLS polynomial fit of each row (NaNs ignored).
 
-    # Values for each node
-    r2fitc = np.full(N_nodes, 0.0)
-    dstdc = np.full(N_nodes, np.nan)
-    dtrendc = np.full(N_nodes, np.nan)
-    pstdc = np.full(N_nodes, np.inf)  # NOTE: Init w/inf
-    ptrendc = np.full(N_nodes, np.nan)
-    rbsc = np.full(N_nodes, np.nan)
-    rlewc = np.full(N_nodes, np.nan)
-    rtesc = np.full(N_nodes, np.nan)
-    sbsc = np.full(N_nodes, np.nan)
-    slewc = np.full(N_nodes, np.nan)
-    stesc = np.full(N_nodes, np.nan)
-    bbsc = np.full(N_nodes, np.nan)
-    blewc = np.full(N_nodes, np.nan)
-    btesc = np.full(N_nodes, np.nan)
-    lonc = np.full(N_nodes, np.nan)
-    latc = np.full(N_nodes, np.nan)
+    Returns the coefficients (lowest order first) w.r.t. the centered X,
+    and the center of X for each row.
+    """
+    valid = ~np.isnan(X) & ~np.isnan(Y)
+    x0 = np.nanmean(np.where(valid, X, np.nan), axis=1)
+    A = (X - x0[:, None])[:, :, None] ** np.arange(order + 1)
+    A = np.where(valid[:, :, None], A, 0.0)
+    y = np.where(valid, Y, 0.0)[:, :, None]
+    coef = np.matmul(np.linalg.pinv(A), y)[:, :, 0]
+    return coef, x0
+
+
+def polyval_batch(coef, x0, X):
+    """ Evaluate polynomial of each row (see polyfit_batch). """
+    A = (X - x0[:, None])[:, :, None] ** np.arange(coef.shape[1])
+    return np.sum(A * coef[:, None, :], axis=2)
+
+
+def detrend_batch(T, Y, order=1, window=3 / 12.0):
+    """ Same as detrend_binned() for each row. """
+    xb, yb = binning_batch(T, Y, median=True, window=window)
+    coef, x0 = polyfit_batch(xb, yb, order)
+    Y_trend = polyval_batch(coef, x0, T)
+    return Y - Y_trend, Y_trend
+
+
+def mode_filter_batch(X, min_count=10, maxiter=3):
+    """ Same as mode_filter() for each row. """
+    X = X.copy()
+    N, M = X.shape
+    i_obs = np.arange(M)
+    active = np.ones(N, dtype=bool)
+    for _ in range(maxiter):
+        # Length of the runs of repeated values (sorted, NaNs last)
+        Xs = np.sort(X, axis=1)
+        new = np.ones(X.shape, dtype=bool)
+        new[:, 1:] = Xs[:, 1:] != Xs[:, :-1]
+        first = np.maximum.accumulate(np.where(new, i_obs, 0), axis=1)
+        count = np.where(np.isnan(Xs), 0, i_obs - first + 1)
+        # Most repeated value (smallest if tie)
+        i_mode = np.argmax(count, axis=1)
+        active &= count[np.arange(N), i_mode] > min_count
+        if not active.any():
+            break
+        mode_ = Xs[np.arange(N), i_mode]
+        X[active[:, None] & (X == mode_[:, None])] = np.nan
+    return X
 
-    # Select cells at random (for testing)
-    if TEST_MODE:
-        if USE_NODES:
-            # Convert into sterographic coordinates
-            x_nodes = [
-                transform_coord("4326", "3031", xp, yp)[0] for xp, yp in NODES
-            ]
-            y_nodes = [
-                transform_coord("4326", "3031", xp, yp)[1] for xp, yp in NODES
-            ]
-        else:
-            if USE_SEED:
-                np.random.seed(SEED)  # not so random!
-            # Select a few random nodes
-            ii = np.random.randint(0, N_nodes, N_CELLS)
-            x_nodes, y_nodes = x_nodes[ii], y_nodes[ii]
-        N_nodes = len(x_nodes)
 
-    # Build KD-Tree with polar stereo coords
-    x, y = transform_coord(4326, proj, lon, lat)
-    Tree = cKDTree(list(zip(x, y)))
+def sigma_filter_batch(T, Y, order=1, window=3 / 12.0, n_iter=3, n_sigma=3):
+    """ Same as sigma_filter() for each row. """
+    Y_res = Y.copy()
+    active = np.ones(Y.shape[0], dtype=bool)
+    for _ in range(n_iter):
+        if not active.any():
+            break
+        Y_res[active] = detrend_batch(
+            T[active], Y_res[active], order=order, window=window
+        )[0]
+        i_out = np.abs(Y_res) > mad_std_batch(Y_res)[:, None] * n_sigma
+        i_out[~active] = False
+        active &= i_out.any(axis=1)  # if no data to filter, stop iterating
+        Y_res[i_out] = np.nan
+        active &= np.sum(~np.isnan(Y_res), axis=1) >= 10  # NOTE: Arbitrary
+    Y_filt = Y.copy()
+    Y_filt[np.isnan(Y_res)] = np.nan
+    return Y_filt
+
+
+def sgolay_batch(H, n, window=3, order=1, deriv=0, dt=1.0):
+    """ Same as sgolay1d() w/NaNs -> 0 for each row of length n. """
+    i_pad = np.arange(H.shape[1]) >= n[:, None]
+    H2 = np.where(np.isnan(H), 0.0, H)
+    # Extend each row w/its last value (mode='nearest' for each row)
+    H2 = np.where(i_pad, H2[np.arange(len(n)), n - 1][:, None], H2)
+    H2 = savgol_filter(H2, window, order, deriv, delta=dt, mode="nearest")
+    H2[i_pad] = np.nan
+    return H2
+
+
+def center_batch(*arrs):
+    """ Remove mean from each row of array(s). """
+    return [a - np.nanmean(a, axis=1)[:, None] for a in arrs]
+
+
+def multi_fit_batch(h_, bs_, lew_, tes_):
+    """
+    Multivariate fit (OLS) of each row: same as multi_fit_coef().
+
+    Returns the coefficients for Bs, LeW, TeS and the adjusted r-squared.
+    """
+    # Ensure zero mean of processed series
+    h_, bs_, lew_, tes_ = center_batch(h_, bs_, lew_, tes_)
+
+    # Only entries valid in all series (missing='drop')
+    valid = ~np.isnan(h_) & ~np.isnan(bs_) & ~np.isnan(lew_) & ~np.isnan(tes_)
+
+    # Design matrix and obs: First-order model
+    A = np.where(valid[:, :, None], np.dstack((bs_, lew_, tes_)), 0.0)
+    y = np.where(valid, h_, 0.0)
+
+    # Normal equations
+    coef = np.matmul(
+        np.linalg.pinv(np.matmul(A.transpose(0, 2, 1), A)),
+        np.matmul(A.transpose(0, 2, 1), y[:, :, None]),
+    )[:, :, 0]
+
+    # Adjusted r-squared (model w/o constant)
+    nobs = valid.sum(axis=1)
+    ssr = np.sum((y - np.sum(A * coef[:, None, :], axis=2)) ** 2, axis=1)
+    r2 = 1 - ssr / np.sum(y ** 2, axis=1)
+    r2_adj = 1 - nobs / (nobs - 3.0) * (1 - r2)
+
+    return coef, r2_adj
+
+
+def corr_batch(h, bs, lew, tes):
+    """ Corr coef and gradient (OLS) between h and w/f params of each row. """
+    valid = ~np.isnan(h) & ~np.isnan(bs) & ~np.isnan(lew) & ~np.isnan(tes)
+    h_ = np.where(valid, h, np.nan)
+    h_ = np.where(valid, h_ - np.nanmean(h_, axis=1)[:, None], 0.0)
+    r, s = [], []
+    for p in [bs, lew, tes]:
+        p_ = np.where(valid, p, np.nan)
+        p_ = np.where(valid, p_ - np.nanmean(p_, axis=1)[:, None], 0.0)
+        cov = np.sum(p_ * h_, axis=1)
+        var = np.sum(p_ ** 2, axis=1)
+        r.append(cov / np.sqrt(var * np.sum(h_ ** 2, axis=1)))
+        s.append(np.where(valid.sum(axis=1) < 3, np.nan, cov / var))
+    return r, s
+
+
+def std_change_batch(T, X1, X2, order=1):
+    """ Same as std_change() for each row. """
+    valid = ~np.isnan(X1) & ~np.isnan(X2)
+    s1 = mad_std_batch(detrend_batch(T, X1, order=order)[0])
+    s2 = mad_std_batch(detrend_batch(T, X2, order=order)[0])
+    delta_s = np.where(valid.sum(axis=1) < 3, np.nan, s2 - s1)
+    return delta_s, delta_s / s1
+
+
+def trend_change_batch(T, X1, X2):
+    """ Same as trend_change() for each row. """
+    valid = ~np.isnan(X1) & ~np.isnan(X2)
+    T_ = np.where(valid, T, np.nan)
+    a1 = polyfit_batch(T_, X1, 1)[0][:, 1]
+    a2 = polyfit_batch(T_, X2, 1)[0][:, 1]
+    delta_a = np.where(valid.sum(axis=1) < 3, np.nan, a2 - a1)
+    return delta_a, delta_a / np.abs(a1)
+
+
+def fit_batch(t, h, x, y, bs, lew, tes, caps, proc=None):
+    """
+    Calculate scattering correction for a batch of nodes.
+
+    Same as the node loop in main(), with the data of all caps gathered
+    into padded (nodes x obs) arrays, and the filtering, binning,
+    detrending, normalization, multivariate fit and change statistics
+    computed for all nodes at once.
+
+    Returns the indices (into caps) of the nodes with a solution, and for
+    each of these nodes a tuple with the cap data and parameters (see
+    loop_nodes).
+    """
+    n, (tc, hc, xc, yc, bc, wc, sc) = pad_series(
+        [t, h, x, y, bs, lew, tes], caps
+    )
+
+    # Filter invalid points
+    hc, bc, wc, sc = [
+        sigma_filter_batch(
+            tc, mode_filter_batch(v), order=2, n_sigma=3, n_iter=3
+        )
+        for v in [hc, bc, wc, sc]
+    ]
+
+    # Test minimum number of obs in all params
+    nobs = np.min([np.sum(~np.isnan(v), axis=1) for v in [hc, bc, wc, sc]], 0)
+
+    # Bin at monthly intervals to check temporal sampling
+    h_bin = binning_batch(tc, hc, dx=1 / 12.0, window=3 / 12.0)[1]
+    n_months = np.sum(~np.isnan(h_bin), axis=1)
+
+    # Test for enough points
+    (i_node,) = np.where((nobs >= MIN_PTS) & (n_months >= MIN_MONTHS))
+
+    if len(i_node) == 0:
+        return i_node, []
+
+    n, tc, hc, xc, yc, bc, wc, sc = [
+        v[i_node] for v in [n, tc, hc, xc, yc, bc, wc, sc]
+    ]
+
+    if BIN_SERIES:
+        hc_bin, bc_bin, wc_bin, sc_bin = [
+            interp_batch(
+                tc, *binning_batch(tc, v, median=True, window=3 / 12.0)
+            )
+            for v in [hc, bc, wc, sc]
+        ]
+    else:
+        hc_bin, bc_bin, wc_bin, sc_bin = hc, bc, wc, sc
+
+    # Mean of w/f params (for coefs in physical units)
+    mu = np.column_stack([np.nanmean(v, axis=1) for v in [bc, wc, sc]])
+
+    # Ensure zero mean on all variables
+    hc, bc, wc, sc = center_batch(hc, bc, wc, sc)
+    hc_bin, bc_bin, wc_bin, sc_bin = center_batch(
+        hc_bin, bc_bin, wc_bin, sc_bin
+    )
+
+    # Std of w/f params (for coefs in physical units)
+    sd = np.column_stack([mad_std_batch(v) for v in [bc, wc, sc]])
+
+    # Normalize the w/f params to std = 1
+    bc, wc, sc = [v / sd[:, i, None] for i, v in enumerate([bc, wc, sc])]
+    bc_bin, wc_bin, sc_bin = [
+        v / mad_std_batch(v)[:, None] for v in [bc_bin, wc_bin, sc_bin]
+    ]
+
+    if proc == "det":
+        # Detrend time series
+        hc_res, bc_res, wc_res, sc_res = [
+            detrend_batch(tc, v, order=2)[0]
+            for v in [hc_bin, bc_bin, wc_bin, sc_bin]
+        ]
+    else:
+        # Savitzky-Golay numerical diff
+        hc_res, bc_res, wc_res, sc_res = [
+            sgolay_batch(v, n, WINDOW, ORDER, DERIV)
+            for v in [hc_bin, bc_bin, wc_bin, sc_bin]
+        ]
+
+    # Get coefs from multivariate fit
+    coef, r2 = multi_fit_batch(hc_res, bc_res, wc_res, sc_res)
+
+    # Get linear combination of original FILTERED series
+    # h_bs = a Bs + b LeW + c TeS (NaNs preserved)
+    hc_bs = (
+        bc * coef[:, 0, None] + wc * coef[:, 1, None] + sc * coef[:, 2, None]
+    )
+
+    # Coefs in physical units: h_bs = c0 + c1 Bs + c2 LeW + c3 TeS
+    c_w = coef / sd
+    c_0 = -np.sum(c_w * mu, axis=1)
+
+    # Apply correction to height
+    hc_cor = hc - hc_bs
+
+    # Calculate correlation and sensitivity values (corr grad)
+    (r_bc, r_wc, r_sc), (s_bc, s_wc, s_sc) = corr_batch(
+        hc_res, bc_res, wc_res, sc_res
+    )
+
+    # Calculate variance change (magnitude and perc)
+    d_std, p_std = std_change_batch(tc, hc, hc_cor, order=1)
+
+    # Calculate trend change (magnitude and perc)
+    d_trend, p_trend = trend_change_batch(tc, hc, hc_cor)
+
+    # Nodes with a valid solution
+    valid = (
+        (coef.sum(axis=1) != 0)
+        & ~np.isnan(hc_bs).all(axis=1)
+        & ~np.isnan(d_std)
+        & ~np.isnan(p_std)
+        & ~np.isnan(d_trend)
+    )
+
+    # Do not apply correction if: std increases by more than 5%
+    hc_bs[(p_std > 0.05)[:, None] & ~np.isnan(hc_bs)] = 0.0
+    c_w[p_std > 0.05] = 0.0
+    c_0[p_std > 0.05] = 0.0
+
+    (i_valid,) = np.where(valid)
+
+    results = [
+        (
+            xc[i, : n[i]],
+            yc[i, : n[i]],
+            hc_bs[i, : n[i]],
+            r2[i],
+            d_std[i],
+            p_std[i],
+            d_trend[i],
+            p_trend[i],
+            r_bc[i],
+            r_wc[i],
+            r_sc[i],
+            s_bc[i],
+            s_wc[i],
+            s_sc[i],
+            coef[i, 0],
+            coef[i, 1],
+            coef[i, 2],
+            c_0[i],
+            c_w[i, 0],
+            c_w[i, 1],
+            c_w[i, 2],
+        )
+        for i in i_valid
+    ]
+
+    return i_node[i_valid], results
+
+
+def loop_nodes(
+    t,
+    h,
+    x,
+    y,
+    bs,
+    lew,
+    tes,
+    x_nodes,
+    y_nodes,
+    i_nodes,
+    Tree,
+    radius,
+    n_reloc=0,
+    proc=None,
+):
+    """
+    Calculate scattering correction node by node.
+
+    Yields for each node with a solution: node index, cap indices, cap
+    x/y coords, correction and parameters (r2, d_std, p_std, d_trend,
+    p_trend, r_bs, r_lew, r_tes, s_bs, s_lew, s_tes, b_bs, b_lew, b_tes,
+    c_0, c_bs, c_lew, c_tes). The c coefs give the correction in physical
+    units of the w/f params: h_bs = c_0 + c_bs Bs + c_lew LeW + c_tes TeS.
+    """
+    N_nodes = len(x_nodes)
+
+    # Get bbox from data
+    xmin_d, xmax_d, ymin_d, ymax_d = x.min(), x.max(), y.min(), y.max()
 
     # Loop through nodes
-    for k in range(N_nodes):
+    for k in i_nodes:
 
         if (k % 500) == 0:
             print(("Calculating correction for node", k, "of", N_nodes, "..."))
@@ -1290,10 +1843,16 @@ def main(
             wc_bin = wc
             sc_bin = sc
 
+        # Mean of w/f params (for coefs in physical units)
+        mu = np.array([np.nanmean(v) for v in [bc, wc, sc]])
+
         # Ensure zero mean on all variables
         hc, bc, wc, sc = center(hc, bc, wc, sc)
         hc_bin, bc_bin, wc_bin, sc_bin = center(hc_bin, bc_bin, wc_bin, sc_bin)
 
+        # Std of w/f params (for coefs in physical units)
+        sd = np.array([mad_std(v) for v in [bc, wc, sc]])
+
         # Normalize the w/f params to std = 1
         bc, wc, sc = normalize(bc, wc, sc)
         bc_bin, wc_bin, sc_bin = normalize(bc_bin, wc_bin, sc_bin)
@@ -1331,6 +1890,10 @@ def main(
         if np.isnan(hc_bs).all():
             continue
 
+        # Coefs in physical units: h_bs = c0 + c1 Bs + c2 LeW + c3 TeS
+        c_bc, c_wc, c_sc = np.array([b_bc, b_wc, b_sc]) / sd
+        c_0 = -np.dot([c_bc, c_wc, c_sc], mu)
+
         # Apply correction to height
         hc_cor = hc - hc_bs
 
@@ -1369,6 +1932,7 @@ def main(
             hc_bs[
                 ~np.isnan(hc_bs)
             ] = 0.0  # hc_bs keeps NaNs from filtered out values
+            c_0, c_bc, c_wc, c_sc = 0.0, 0.0, 0.0, 0.0
 
             """
             # All params are set to zero/one
@@ -1414,60 +1978,483 @@ def main(
                 pvals,
             )
 
-        """ Store results (while checking previously stored estimates) """
-
-        # Check where previously stored values need update
-        # r2_prev <= r2_new (new r2 is larger)
-        # i_update, = np.where(r2fit[i_cell] <= r2)
-        (i_update,) = np.where(
-            pstd[i_cell] > p_std
-        )  # std_prev > std_new (new std is lower)
-
-        # Remove indices and values that will not be updated
-        i_cell_new = [i_cell[i] for i in i_update]
-        hc_bs_new = hc_bs[i_update]
-
-        # Store correction for cell: only the improved values
-        hbs[i_cell_new] = hc_bs_new  # set of values
-        r2fit[i_cell_new] = r2  # one value (same for all)
-        dstd[i_cell_new] = d_std
-        pstd[i_cell_new] = p_std
-        dtrend[i_cell_new] = d_trend
-        ptrend[i_cell_new] = p_trend
-        rbs[i_cell_new] = r_bc  # corr coef
-        rlew[i_cell_new] = r_wc
-        rtes[i_cell_new] = r_sc
-        sbs[i_cell_new] = s_bc  # sensitivity
-        slew[i_cell_new] = s_wc
-        stes[i_cell_new] = s_sc
-        bbs[i_cell_new] = b_bc  # multivar fit coef
-        blew[i_cell_new] = b_wc
-        btes[i_cell_new] = b_sc
-
-        # Compute centroid of cell
-        xc_ = np.nanmedian(xc)
-        yc_ = np.nanmedian(yc)
+        yield (
+            k,
+            i_cell,
+            xc,
+            yc,
+            hc_bs,
+            r2,
+            d_std,
+            p_std,
+            d_trend,
+            p_trend,
+            r_bc,
+            r_wc,
+            r_sc,
+            s_bc,
+            s_wc,
+            s_sc,
+            b_bc,
+            b_wc,
+            b_sc,
+            c_0,
+            c_bc,
+            c_wc,
+            c_sc,
+        )
+
+
+def batch_nodes(
+    t,
+    h,
+    x,
+    y,
+    bs,
+    lew,
+    tes,
+    x_nodes,
+    y_nodes,
+    i_nodes,
+    Tree,
+    radius,
+    n_reloc=0,
+    proc=None,
+    chunk=CHUNK,
+):
+    """
+    Calculate scattering correction for batches of nodes.
+
+    Same as loop_nodes, with chunks of nodes solved at once by fit_batch.
+    """
+    for i in range(0, len(i_nodes), chunk):
+
+        print(
+            (
+                "Calculating correction for nodes",
+                i,
+                "-",
+                min(i + chunk, len(i_nodes)),
+                "of",
+                len(i_nodes),
+                "...",
+            )
+        )
+
+        # Get indices of data within search radius of each node
+        k_nodes = i_nodes[i : i + chunk]
+        i_cells = get_radius_idx_batch(
+            x, y, x_nodes[k_nodes], y_nodes[k_nodes], radius, Tree, n_reloc
+        )[0]
+
+        # If cell empty or not enough data leave node out
+        nodes, caps = [], []
+        for k, i_cell in zip(k_nodes, i_cells):
+            if len(i_cell) >= MIN_PTS:
+                nodes.append(k)
+                caps.append(i_cell)
+
+        if len(nodes) == 0:
+            continue
+
+        i_fit, results = fit_batch(t, h, x, y, bs, lew, tes, caps, proc)
+
+        for j, res in zip(i_fit, results):
+            yield (nodes[j], caps[j]) + res
+
+
+def solve_nodes(
+    t,
+    h,
+    x,
+    y,
+    bs,
+    lew,
+    tes,
+    x_nodes,
+    y_nodes,
+    i_nodes,
+    radius,
+    n_reloc=0,
+    proc=None,
+    engine=ENGINE,
+    chunk=CHUNK,
+):
+    """ Solve a block of nodes independently (for node-parallel runs). """
+    Tree = cKDTree(np.column_stack((x, y)))
+    if engine == "vec":
+        nodes = batch_nodes(
+            t, h, x, y, bs, lew, tes, x_nodes, y_nodes, i_nodes, Tree, radius,
+            n_reloc, proc, chunk,
+        )
+    else:
+        nodes = loop_nodes(
+            t, h, x, y, bs, lew, tes, x_nodes, y_nodes, i_nodes, Tree, radius,
+            n_reloc, proc,
+        )
+    return list(nodes)
+
+
+def reduce_nodes(solutions):
+    """
+    Select the best node solution (lowest p_std) for each data point.
+
+    Same result as updating the data points of each cap in node order,
+    only where the new p_std is lower than the stored one (init w/inf):
+    ties are resolved in favor of the first node in node order.
+
+    Returns the indices of the data points with a solution, the index of
+    the best solution for each point, and the correction of that node.
+    """
+    i_sol = np.repeat(np.arange(len(solutions)), [len(s[1]) for s in solutions])
+    i_data = np.concatenate([s[1] for s in solutions]).astype(int)
+    h_bs = np.concatenate([s[4] for s in solutions])
+    p_std = np.array([s[7] for s in solutions])[i_sol]
+
+    # Sort by data point, then p_std, then node order
+    i_sort = np.lexsort((i_sol, p_std, i_data))
+    i_sort = i_sort[p_std[i_sort] < np.inf]
+
+    # First (best) entry for each data point
+    is_first = np.ones(len(i_sort), dtype=bool)
+    is_first[1:] = i_data[i_sort][1:] != i_data[i_sort][:-1]
+    i_best = i_sort[is_first]
+
+    return i_data[i_best], i_sol[i_best], h_bs[i_best]
+
+
+def interp_grid(xg, yg, Z, x, y):
+    """
+    Bilinear interpolation of grid(s) Z (.. x ny x nx) to points x/y.
+
+    NaN nodes are left out (weights renormalized). Points outside the
+    grid are set to NaN.
+    """
+    fx = (x - xg[0]) / (xg[1] - xg[0])
+    fy = (y - yg[0]) / (yg[1] - yg[0])
+
+    i_out = ~((fx >= 0) & (fx <= len(xg) - 1) & (fy >= 0) & (fy <= len(yg) - 1))
+
+    # Lower-left node and weights
+    j0 = np.clip(np.floor(np.where(i_out, 0, fx)).astype(int), 0, len(xg) - 2)
+    i0 = np.clip(np.floor(np.where(i_out, 0, fy)).astype(int), 0, len(yg) - 2)
+    wx, wy = fx - j0, fy - i0
+
+    zsum, wsum = 0.0, 0.0
+
+    for di, dj, w in [
+        (0, 0, (1 - wx) * (1 - wy)),
+        (0, 1, wx * (1 - wy)),
+        (1, 0, (1 - wx) * wy),
+        (1, 1, wx * wy),
+    ]:
+        z = Z[..., i0 + di, j0 + dj]
+        zsum = zsum + np.where(np.isnan(z), 0.0, w * z)
+        wsum = wsum + np.where(np.isnan(z), 0.0, w)
+
+    zi = zsum / wsum
+    zi[..., i_out] = np.nan
+
+    return zi
+
+
+def apply_grid(ifile, fgrid, x, y, h, bs, lew, tes, zvar, apply_=False):
+    """
+    Correct data with a previously saved coefficient grid (_SCATGRD).
+
+    The coefficients (in physical units) are interpolated to the data
+    points and the correction is h_bs = c_0 + c_bs Bs + c_lew LeW +
+    c_tes TeS.
+    """
+    print(("applying coefficient grid:", fgrid))
+
+    with h5py.File(fgrid, "r") as fg:
+
+        if "c_0" not in fg:
+            print("NO COEFFICIENT GRID (c_0, c_bs, c_lew, c_tes) IN FILE")
+            print(fgrid)
+            return
+
+        # Grid nodes (flattened) and coefs
+        xg, yg = np.unique(fg["x"][:]), np.unique(fg["y"][:])
+        C = np.vstack([fg[v][:] for v in ["c_0", "c_bs", "c_lew", "c_tes"]])
+
+    c_0, c_bs, c_lew, c_tes = interp_grid(
+        xg, yg, C.reshape(4, len(yg), len(xg)), x, y
+    )
+
+    hbs = c_0 + c_bs * bs + c_lew * lew + c_tes * tes
+
+    if apply_:
+        h[~np.isnan(hbs)] -= hbs[~np.isnan(hbs)]
+
+    if TEST_MODE:
+        return
+
+    print("saving data ...")
+
+    with h5py.File(ifile, "a") as fi:
+
+        if apply_:
+            fi[zvar][:] = h
+
+        if H_BS in fi:
+            del fi[H_BS]
+
+        fi[H_BS] = hbs
+
+    # Only rename file if _SCAT has not been added
+    if ifile.find(SUFFIX1 + ".h5") < 0:
+        os.rename(ifile, ifile.replace(".h5", SUFFIX1 + ".h5"))
+
+
+def main(
+    ifile,
+    vnames,
+    wnames,
+    dxy,
+    proj,
+    radius=0,
+    n_reloc=0,
+    proc=None,
+    apply_=False,
+    fmask=None,
+    engine=ENGINE,
+    chunk=CHUNK,
+    n_cores=NCORES,
+    fgrid=None,
+):
+
+    if is_empty(ifile):
+        print("empty file... skipping!!!")
+        return
+
+    if TEST_MODE:
+        print("*********************************************************")
+        print("* RUNNING IN TEST MODE (PLOTTING ONLY, NOT SAVING DATA) *")
+        print("*********************************************************")
+
+    print(("processing file:", ifile, "..."))
+
+    # Test if parameter file exists
+    if "_scatgrd" in ifile.lower():
+        return
+
+    xvar, yvar, zvar, tvar = vnames
+    bpar, wpar, spar = wnames
+
+    # Load full data into memory (only once)
+    with h5py.File(ifile, "r") as fi:
+
+        t = fi[tvar][:]
+        h = fi[zvar][:]
+        lon = fi[xvar][:]
+        lat = fi[yvar][:]
+        bs = fi[bpar][:]
+        lew = fi[wpar][:]
+        tes = fi[spar][:]
+
+    # Convert into sterographic coordinates
+    x, y = transform_coord("4326", proj, lon, lat)
+
+    # Correct data with a previously saved coefficient grid (no fitting)
+    if fgrid:
+        apply_grid(ifile, fgrid, x, y, h, bs, lew, tes, zvar, apply_)
+        return
+
+    # Get bbox from data
+    xmin_d, xmax_d, ymin_d, ymax_d = x.min(), x.max(), y.min(), y.max()
+
+    # If no bbox given, limits are defined by data
+    if bbox[0] is None:
+        xmin, xmax, ymin, ymax = xmin_d, xmax_d, ymin_d, ymax_d
+    else:
+        xmin, xmax, ymin, ymax = bbox
+
+    # Grid solution - defined by nodes
+    Xi, Yi = make_grid(xmin, xmax, ymin, ymax, dxy, dxy)
+
+    # Flatten prediction grid
+    x_nodes, y_nodes = Xi.ravel(), Yi.ravel()
+
+    """ Create output containers """
+
+    N_data = len(x)
+    N_nodes = len(x_nodes)
+
+    # Values for each data point
+    r2fit = np.full(N_data, 0.0)  # r2 of the multivar fit
+    dstd = np.full(N_data, np.nan)  # magnitude std change after cor
+    dtrend = np.full(N_data, np.nan)  # magnitude trend change after cor
+    pstd = np.full(
+        N_data, np.inf
+    )  # perc std change after cor   ##NOTE: Init w/inf
+    ptrend = np.full(N_data, np.nan)  # perc trend change after cor
+    hbs = np.full(N_data, np.nan)  # scatt cor from multivar fit
+    rbs = np.full(N_data, np.nan)  # corr coef h x Bs
+    rlew = np.full(N_data, np.nan)  # corr coef h x LeW
+    rtes = np.full(N_data, np.nan)  # corr coef h x TeS
+    sbs = np.full(N_data, np.nan)  # sensit h x Bs
+    slew = np.full(N_data, np.nan)  # sensit h x LeW
+    stes = np.full(N_data, np.nan)  # sensit h x TeS
+    bbs = np.full(N_data, np.nan)  # multivar fit coef a.Bs
+    blew = np.full(N_data, np.nan)  # multivar fit coef b.LeW
+    btes = np.full(N_data, np.nan)  # multivar fit coef c.TeS
+
+    # Values for each node
+    r2fitc = np.full(N_nodes, 0.0)
+    dstdc = np.full(N_nodes, np.nan)
+    dtrendc = np.full(N_nodes, np.nan)
+    pstdc = np.full(N_nodes, np.inf)  # NOTE: Init w/inf
+    ptrendc = np.full(N_nodes, np.nan)
+    rbsc = np.full(N_nodes, np.nan)
+    rlewc = np.full(N_nodes, np.nan)
+    rtesc = np.full(N_nodes, np.nan)
+    sbsc = np.full(N_nodes, np.nan)
+    slewc = np.full(N_nodes, np.nan)
+    stesc = np.full(N_nodes, np.nan)
+    bbsc = np.full(N_nodes, np.nan)
+    blewc = np.full(N_nodes, np.nan)
+    btesc = np.full(N_nodes, np.nan)
+    c0c = np.full(N_nodes, np.nan)  # cor coefs in physical units
+    cbsc = np.full(N_nodes, np.nan)
+    clewc = np.full(N_nodes, np.nan)
+    ctesc = np.full(N_nodes, np.nan)
+    lonc = np.full(N_nodes, np.nan)
+    latc = np.full(N_nodes, np.nan)
+
+    # Select cells at random (for testing)
+    if TEST_MODE:
+        if USE_NODES:
+            # Convert into sterographic coordinates
+            x_nodes = [
+                transform_coord("4326", "3031", xp, yp)[0] for xp, yp in NODES
+            ]
+            y_nodes = [
+                transform_coord("4326", "3031", xp, yp)[1] for xp, yp in NODES
+            ]
+        else:
+            if USE_SEED:
+                np.random.seed(SEED)  # not so random!
+            # Select a few random nodes
+            ii = np.random.randint(0, N_nodes, N_CELLS)
+            x_nodes, y_nodes = x_nodes[ii], y_nodes[ii]
+        N_nodes = len(x_nodes)
+
+    # Build KD-Tree with polar stereo coords
+    x, y = transform_coord(4326, proj, lon, lat)
+    Tree = cKDTree(list(zip(x, y)))
+
+    # Nodes with data within search radius and inside mask
+    i_nodes = np.flatnonzero(
+        node_mask(np.asarray(x_nodes), np.asarray(y_nodes), Tree, radius, fmask)
+    )
+
+    print(("Number of nodes with data/inside mask:", len(i_nodes), "of", N_nodes))
+
+    # Solution for each node: node-parallel, batched or node by node
+    if n_cores > 1 and not TEST_MODE:
+        from joblib import Parallel, delayed
+
+        print(("solving nodes in parallel (%d cores) ..." % n_cores))
+
+        # Consecutive blocks of whole chunks (same batches as sequential)
+        n_block = chunk * int(np.ceil(len(i_nodes) / (chunk * n_cores * 4.0)))
+        blocks = [
+            i_nodes[i : i + n_block] for i in range(0, len(i_nodes), n_block)
+        ]
+
+        solutions = Parallel(n_jobs=n_cores, verbose=5)(
+            delayed(solve_nodes)(
+                t, h, x, y, bs, lew, tes, x_nodes, y_nodes, i_block, radius,
+                n_reloc, proc, engine, chunk,
+            )
+            for i_block in blocks
+        )
+
+        solutions = [s for block in solutions for s in block]
+
+    elif engine == "vec" and not TEST_MODE:
+        solutions = list(
+            batch_nodes(
+                t, h, x, y, bs, lew, tes, x_nodes, y_nodes, i_nodes, Tree,
+                radius, n_reloc, proc, chunk,
+            )
+        )
+    else:
+        solutions = list(
+            loop_nodes(
+                t, h, x, y, bs, lew, tes, x_nodes, y_nodes, i_nodes, Tree,
+                radius, n_reloc, proc,
+            )
+        )
+
+    """ Store results (best estimate for each data point) """
+
+    if len(solutions) > 0:
+
+        # Node w/lowest p_std for each data point (std_new < std_prev)
+        i_data, i_sol, hbs_best = reduce_nodes(solutions)
+
+        # One value per node: r2, d_std, p_std, d_trend, p_trend, r, s, b, c
+        params = np.array([s[5:] for s in solutions])
+
+        # Store correction and params of best node for each data point
+        hbs[i_data] = hbs_best
+        for p, p_sol in zip(
+            [
+                r2fit,
+                dstd,
+                pstd,
+                dtrend,
+                ptrend,
+                rbs,
+                rlew,
+                rtes,
+                sbs,
+                slew,
+                stes,
+                bbs,
+                blew,
+                btes,
+            ],
+            params.T[:14],
+        ):
+            p[i_data] = p_sol[i_sol]
+
+        # Compute centroid of each cell
+        k = np.array([s[0] for s in solutions])
+        xc_ = np.array([np.nanmedian(s[2]) for s in solutions])
+        yc_ = np.array([np.nanmedian(s[3]) for s in solutions])
 
         # Convert x/y -> lon/lat
-        lon_c, lat_c = transform_coord(proj, 4326, xc_, yc_)
+        lonc[k], latc[k] = transform_coord(proj, 4326, xc_, yc_)
 
         # Store one s and r value per cell
-        lonc[k] = lon_c
-        latc[k] = lat_c
-        r2fitc[k] = r2
-        dstdc[k] = d_std
-        pstdc[k] = p_std
-        dtrendc[k] = d_trend
-        ptrendc[k] = p_trend
-        rbsc[k] = r_bc
-        rlewc[k] = r_wc
-        rtesc[k] = r_sc
-        sbsc[k] = s_bc
-        slewc[k] = s_wc
-        stesc[k] = s_sc
-        bbsc[k] = b_bc
-        blewc[k] = b_wc
-        btesc[k] = b_sc
+        for p, p_sol in zip(
+            [
+                r2fitc,
+                dstdc,
+                pstdc,
+                dtrendc,
+                ptrendc,
+                rbsc,
+                rlewc,
+                rtesc,
+                sbsc,
+                slewc,
+                stesc,
+                bbsc,
+                blewc,
+                btesc,
+                c0c,
+                cbsc,
+                clewc,
+                ctesc,
+            ],
+            params.T,
+        ):
+            p[k] = p_sol
 
     """ Correct h (full dataset) with best values """
 
@@ -1557,6 +2544,12 @@ def main(
                 fo["b_bs"] = bbsc
                 fo["b_lew"] = blewc
                 fo["b_tes"] = btesc
+                fo["c_0"] = c0c
+                fo["c_bs"] = cbsc
+                fo["c_lew"] = clewc
+                fo["c_tes"] = ctesc
+                fo["x"] = x_nodes
+                fo["y"] = y_nodes
 
             # Catch any exceptions
             except IOError:
@@ -1582,6 +2575,11 @@ if __name__ == "__main__":
     tmin = args.tlim[0]  # min time in decimal years
     tmax = args.tlim[1]  # max time in decimal years
     bbox = args.bbox[:]
+    fmask = args.mask[0]  # raster mask for grid nodes
+    engine = args.engine[0]  # batched (vec) or node loop
+    chunk = args.chunk[0]  # nodes per batch
+    ncores = args.ncores[0]  # parallel nodes
+    fgrid = args.fgrid[0]  # coefficient grid to apply (no fitting)
 
     print("parameters:")
     for arg in list(vars(args).items()):
@@ -1591,7 +2589,8 @@ if __name__ == "__main__":
         print("running sequential code ...")
         [
             main(
-                ifile, vnames, wnames, dxy, proj, radius, nreloc, proc, apply_
+                ifile, vnames, wnames, dxy, proj, radius, nreloc, proc, apply_,
+                fmask, engine, chunk, ncores, fgrid,
             )
             for ifile in ifiles
         ]
@@ -1601,7 +2600,8 @@ if __name__ == "__main__":
 
         Parallel(n_jobs=njobs, verbose=5)(
             delayed(main)(
-                ifile, vnames, wnames, dxy, proj, radius, nreloc, proc, apply_
+                ifile, vnames, wnames, dxy, proj, radius, nreloc, proc, apply_,
+                fmask, engine, chunk, ncores, fgrid,
             )
             for ifile in ifiles
         )
@@ -0,0 +1,396 @@
+#!/usr/bin/env python
+"""
+Empirical spatial covariance of scattered data and model fit
+
+Computes the empirical covariance (and semi-variogram) of detrended data
+as a function of distance, and fits the third-order Gauss-Markov model
+used by interpkrig.py to provide the correlation length (-a) and the
+signal variance (c0) without having to run the full interpolator.
+
+Pairs are counted in distance bins using cKDTree pair queries between a
+set of random anchor points and a random or stratified subsample of the
+data. This makes the estimation independent of the total number of
+observations (a few seconds for ~10^7 points).
+
+Takes as input a h5df file with needed data in geographical coordinates.
+The user provides the wanted projection using the EPSG projection format.
+
+Output consists of an hdf5 file containing the binned distances, the
+empirical covariance, semi-variance, number of pairs per bin and the
+fitted covariance model. The fitted parameters are printed to screen and
+stored as file attributes.
+
+Notes:
+    The model is C(d) = c0 * (1 + d/a - 0.5 * (d/a)^2) * exp(-d/a), with
+    a = 0.9132 * alpha, the same parameterization as in interpkrig.py.
+
+    The difference between the zero-lag variance and the fitted c0 (the
+    nugget) is an estimate of the (white) noise variance, and its square
+    root can be used as the constant rms noise (-e) in interpkrig.py.
+
+    Stratified sampling (-m strat) draws one random observation per cell
+    of size 'dim' before the random subsampling. This reduces the weight
+    of dense along-track sampling on the covariance estimate.
+
+Example:
+
+    python covx.py ifile.h5 ofile.h5 -v lon lat dhdt -p 3031 -r 100 -l 2 \
+        -n 50000 -k 2000 -m strat -s 5 -t 1
+
+Credits:
+    captoolkit - JPL Cryosphere Altimetry Processing Toolkit
+
+    Johan Nilsson (johan.nilsson@jpl.nasa.gov)
+    Fernando Paolo (paolofer@jpl.nasa.gov)
+    Alex Gardner (alex.s.gardner@jpl.nasa.gov)
+
+    Jet Propulsion Laboratory, California Institute of Technology
+
+"""
+
+import h5py
+import pyproj
+import argparse
+import numpy as np
+from scipy.optimize import curve_fit
+from scipy.spatial import cKDTree
+
+
+def transform_coord(proj1, proj2, x, y):
+    """Transform coordinates from proj1 to proj2 (EPSG num)."""
+
+    # Set full EPSG projection strings
+    proj1 = pyproj.Proj("+init=EPSG:" + proj1)
+    proj2 = pyproj.Proj("+init=EPSG:" + proj2)
+
+    # Convert coordinates
+    return pyproj.transform(proj1, proj2, x, y)
+
+
+def detrend(x, y, z, order=1):
+    """Remove polynomial surface (order 0, 1 or 2) by least-squares."""
+
+    # Nothing to remove
+    if order < 0:
+        return z
+
+    # Center coordinates for numerical stability
+    dx = x - np.mean(x)
+    dy = y - np.mean(y)
+
+    # Design matrix
+    if order == 0:
+        A = np.c_[np.ones(x.shape)]
+    elif order == 1:
+        A = np.c_[np.ones(x.shape), dx, dy]
+    else:
+        A = np.c_[np.ones(x.shape), dx, dy, dx * dy, dx ** 2, dy ** 2]
+
+    # Solve for coefficients
+    coef = np.linalg.lstsq(A, z, rcond=None)[0]
+
+    # Return residuals
+    return z - np.dot(A, coef)
+
+
+def subsample(x, y, n, mode='rand', dxy=None):
+    """Random or stratified (one obs. per cell) subsample of indices."""
+
+    # Index of all data
+    idx = np.random.permutation(len(x))
+
+    # Keep one random observation per cell
+    if mode == 'strat' and dxy:
+
+        # Cell number for each (permuted) observation
+        i = np.floor((x[idx] - x.min()) / dxy).astype(np.int64)
+        j = np.floor((y[idx] - y.min()) / dxy).astype(np.int64)
+
+        # First occurrence of each cell in the random permutation
+        _, i_first = np.unique(i * (j.max() + 1) + j, return_index=True)
+
+        # Randomly ordered cell representatives
+        idx = np.random.permutation(idx[i_first])
+
+    # Limit to max number of obs.
+    return idx[:n]
+
+
+def gauss_markov(d, c0, alpha):
+    """Third-order Gauss-Markov covariance model."""
+
+    # Markov-model parameter
+    a = 0.9132 * alpha
+
+    return c0 * (1 + (d / a) - 0.5 * (d / a) ** 2) * np.exp(-d / a)
+
+
+def empirical_cov(x, y, z, dmax, dr, nanc=2000, chunk=500):
+    """Binned empirical covariance and semi-variance by KD-tree pair queries.
+
+    Pairs are formed between 'nanc' random anchor points and all points,
+    with the pair search done in chunks of anchors (bounded memory).
+
+    Returns bin centers, covariance, semi-variance and number of pairs,
+    where the first element is the zero-lag (variance) bin.
+    """
+
+    # Number of distance bins (plus zero-lag bin)
+    nbin = int(np.ceil(dmax / dr)) + 1
+
+    # Output sums for each bin
+    npairs = np.zeros(nbin)
+    sum_zz = np.zeros(nbin)
+    sum_dz = np.zeros(nbin)
+
+    # Construct cKDTree
+    Tree = cKDTree(np.c_[x, y])
+
+    # Random anchor points
+    ianc = np.random.permutation(len(x))[:nanc]
+
+    # Loop through anchor chunks
+    for k in range(0, len(ianc), chunk):
+
+        # Anchors in chunk
+        ia = ianc[k:k + chunk]
+
+        # Tree of anchors
+        TreeA = cKDTree(np.c_[x[ia], y[ia]])
+
+        # All pairs (anchor, point, distance) within search radius
+        pairs = TreeA.sparse_distance_matrix(Tree, dmax,
+                                             output_type='ndarray')
+
+        # Index and distance of pairs
+        i, j, d = ia[pairs['i']], pairs['j'], pairs['v']
+
+        # Exclude self/colocated pairs (handled as zero-lag)
+        i, j, d = i[d > 0], j[d > 0], d[d > 0]
+
+        # Bin number of each pair
+        ib = np.minimum(np.ceil(d / dr).astype(int), nbin - 1)
+
+        # Accumulate counts, products and squared differences
+        npairs += np.bincount(ib, minlength=nbin)
+        sum_zz += np.bincount(ib, weights=z[i] * z[j], minlength=nbin)
+        sum_dz += np.bincount(ib, weights=(z[i] - z[j]) ** 2,
+                              minlength=nbin)
+
+    # Zero-lag bin from the anchors themselves
+    npairs[0] = len(ianc)
+    sum_zz[0] = np.sum(z[ianc] ** 2)
+
+    # Avoid division by zero
+    n = npairs.copy()
+    n[n == 0] = np.nan
+
+    # Covariance: mean of z_i * z_j per bin
+    cov = sum_zz / n
+
+    # Semi-variance: 0.5 * mean of (z_i - z_j)^2 per bin
+    svar = 0.5 * sum_dz / n
+
+    # Bin centers
+    dist = np.r_[0, (np.arange(1, nbin) - 0.5) * dr]
+
+    return dist, cov, svar, npairs
+
+
+# Description of algorithm
+des = 'Empirical spatial covariance and Gauss-Markov model fit'
+
+# Define command-line arguments
+parser = argparse.ArgumentParser(description=des)
+
+parser.add_argument(
+    'ifile', metavar='ifile', type=str, nargs='+',
+    help='name of input file (h5-format)')
+
+parser.add_argument(
+    'ofile', metavar='ofile', type=str, nargs='+',
+    help='name of ouput file (h5-format)')
+
+parser.add_argument(
+    '-b', metavar=('w', 'e', 's', 'n'), dest='bbox', type=float, nargs=4,
+    help=('bounding box for geograph. region (m), optional'),
+    default=[None], )
+
+parser.add_argument(
+    '-v', metavar=('x', 'y', 'z'), dest='vnames', type=str, nargs=3,
+    help=('name of varibales in the HDF5-file'),
+    default=['lon', 'lat', 'h_cor'], )
+
+parser.add_argument(
+    '-p', metavar=('epsg_num'), dest='proj', type=str, nargs=1,
+    help=('EPSG proj number (AnIS=3031, GrIS=3413)'),
+    default=['3031'], )
+
+parser.add_argument(
+    '-r', metavar='radius', dest='radius', type=float, nargs=1,
+    help=('max distance of covariance estimate (km)'),
+    default=[100], )
+
+parser.add_argument(
+    '-l', metavar='lag', dest='lag', type=float, nargs=1,
+    help=('width of distance bins (km)'),
+    default=[1], )
+
+parser.add_argument(
+    '-n', metavar='nobs', dest='nobs', type=int, nargs=1,
+    help=('max number of obs. in subsample'),
+    default=[50000], )
+
+parser.add_argument(
+    '-k', metavar='nanc', dest='nanc', type=int, nargs=1,
+    help=('number of anchor points for pair search'),
+    default=[2000], )
+
+parser.add_argument(
+    '-m', metavar=None, dest='mode', type=str, nargs=1,
+    help=('sampling mode: random (rand) or stratified (strat)'),
+    choices=('rand', 'strat'), default=['rand'], )
+
+parser.add_argument(
+    '-s', metavar='dim', dest='cell', type=float, nargs=1,
+    help=('cell size for stratified sampling (km)'),
+    default=[1], )
+
+parser.add_argument(
+    '-t', metavar='order', dest='order', type=int, nargs=1,
+    help=('order of surface to detrend (-1=none, 0=mean, 1=plane, 2=quad)'),
+    choices=(-1, 0, 1, 2), default=[1], )
+
+parser.add_argument(
+    '-x', metavar='seed', dest='seed', type=int, nargs=1,
+    help=('seed for random sampling'),
+    default=[None], )
+
+# Parser argument to variable
+args = parser.parse_args()
+
+# Read input from terminal
+ifile = args.ifile[0]
+ofile = args.ofile[0]
+bbox = args.bbox
+proj = args.proj[0]
+dmax = args.radius[0] * 1e3
+dr = args.lag[0] * 1e3
+nobs = args.nobs[0]
+nanc = args.nanc[0]
+mode = args.mode[0]
+dxy = args.cell[0] * 1e3
+order = args.order[0]
+seed = args.seed[0]
+vicol = args.vnames[:]
+
+# Print parameters to screen
+print('parameters:')
+for p in list(vars(args).items()): print(p)
+
+# Set seed for reproducibility
+np.random.seed(seed)
+
+# Get variable names
+xvar, yvar, zvar = vicol
+
+print('reading data ...')
+
+# Load all 1d variables needed
+with h5py.File(ifile, 'r') as fi:
+
+    # Get variables
+    lon = fi[xvar][:]
+    lat = fi[yvar][:]
+    zp = fi[zvar][:]
+
+    # Remove data with NaN's
+    lon, lat, zp = lon[~np.isnan(zp)], lat[~np.isnan(zp)], zp[~np.isnan(zp)]
+
+# Transform coordinates to wanted projection
+xp, yp = transform_coord('4326', proj, lon, lat)
+
+# Test for different types of input
+if bbox[0] is not None:
+
+    # Extract bounding box elements
+    xmin, xmax, ymin, ymax = bbox
+
+    # Select data inside bounding box
+    ibox = (xp >= xmin) & (xp <= xmax) & (yp >= ymin) & (yp <= ymax)
+
+    # Subset data
+    xp, yp, zp = xp[ibox], yp[ibox], zp[ibox]
+
+# Signal variance of entire field (as used by interpkrig)
+c0_field = np.nanvar(zp)
+
+print('-> subsampling data ...')
+
+# Draw random or stratified subsample
+isub = subsample(xp, yp, nobs, mode=mode, dxy=dxy)
+
+# Subset data
+xs, ys, zs = xp[isub], yp[isub], zp[isub]
+
+# Remove large-scale trend
+zs = detrend(xs, ys, zs, order=order)
+
+print('-> computing empirical covariance ...')
+
+# Empirical covariance from pair counts
+dist, cov, svar, npairs = empirical_cov(xs, ys, zs, dmax, dr, nanc=nanc)
+
+# Zero-lag variance (signal + noise)
+var0 = cov[0]
+
+# Use only non-zero lags with pairs for the fit
+ifit = (dist > 0) & np.isfinite(cov)
+
+print('-> fitting covariance model ...')
+
+try:
+
+    # Weighted fit of Gauss-Markov model (weights by number of pairs)
+    popt, pcov = curve_fit(gauss_markov, dist[ifit], cov[ifit],
+                           p0=[var0, 0.1 * dmax],
+                           sigma=1.0 / np.sqrt(npairs[ifit]),
+                           bounds=([0, dr * 1e-3], [np.inf, np.inf]))
+
+    # Model parameters
+    c0, alpha = popt
+
+except (RuntimeError, ValueError) as e:
+
+    print('model fit failed:', e)
+
+    c0, alpha = np.nan, np.nan
+
+# Nugget / noise variance
+nugget = np.maximum(var0 - c0, 0)
+
+# Model covariance at bin centers
+cov_model = gauss_markov(dist, c0, alpha)
+
+print('number of obs. used:', len(zs), 'of', len(zp))
+print('field variance (interpkrig c0):', c0_field)
+print('zero-lag variance:', var0)
+print('fitted variance c0:', c0)
+print('fitted correlation length alpha (km):', alpha * 1e-3)
+print('noise rms (sqrt of nugget):', np.sqrt(nugget))
+
+print('-> saving covariances to file...')
+
+# Save data to file
+with h5py.File(ofile, 'w') as foo:
+
+    foo['dist'] = dist
+    foo['cov'] = cov
+    foo['semivar'] = svar
+    foo['npairs'] = npairs
+    foo['cov_model'] = cov_model
+    foo.attrs['c0'] = c0
+    foo.attrs['alpha'] = alpha
+    foo.attrs['nugget'] = nugget
+    foo.attrs['var0'] = var0
+    foo.attrs['epsg'] = int(proj)
@@ -1,6 +1,27 @@
 """
 Filter point-cloud data in space and time.
 
+Notes:
+    Grid nodes without data within the search radius are skipped before
+    the spatial loop. Nodes can also be restricted to a raster mask
+    (--mask file, GeoTIFF or HDF5 with x/y/mask in the -j projection).
+
+    By default (-m vec) the local filter is computed for blocks of cells
+    at once: each point is assigned to its grid cell once, the caps are
+    gathered from the neighbouring cells, and the cap residuals of all
+    cells are computed with grouped operations. Blocks of cells can be
+    processed in parallel (-c n_cores). Use -m loop for the node loop.
+
+    Tiles of files indexed with tile.py -i are passed as "file:tile":
+    the tile and its buffer are read from the indexed file, and only
+    the tile rows (no buffer) are saved to "file_tile_NNN_STFILT".
+
+    For files larger than memory, -s applies only the global filters
+    (stfilter2 and absfilter) in two passes: global stats are computed
+    from the data (or an evenly strided sample of NSAMP obs), and the
+    thresholds are applied chunk by chunk, writing back only the chunks
+    with filtered obs.
+
 Credits:
     captoolkit - JPL Cryosphere Altimetry Processing Toolkit
 
@@ -55,6 +76,19 @@ PROJ = 3031
 # Default njobs for parallel processing of *tiles*
 NJOBS = 1
 
+# Default engine for local filter: all cells at once (vec) or node loop
+ENGINE = "vec"
+
+# Default ncores for parallel processing of *cells* (vec engine)
+NCORES = 1
+
+# Number of nodes per block of cells (vec engine)
+CHUNK = 10000
+
+# Max obs for global stats and obs per chunk (streaming mode)
+NSAMP = 2000000
+CHUNK_OBS = 1000000
+
 
 def get_args():
     # Output description of solution
@@ -67,7 +101,10 @@ def get_args():
         metavar="ifile",
         type=str,
         nargs="+",
-        help="file(s) to process (ASCII, HDF5 or Numpy)",
+        help=(
+            "file(s) to process (ASCII, HDF5 or Numpy), "
+            'or "file:tile" for files indexed with tile.py -i'
+        ),
     )
     parser.add_argument(
         "-d",
@@ -132,6 +169,42 @@ def get_args():
         help="full bbox in case of processing tiles (for consistency)",
         default=[None],
     )
+    parser.add_argument(
+        "--mask",
+        metavar="file",
+        dest="mask",
+        type=str,
+        nargs=1,
+        help="raster mask (GeoTIFF or HDF5 x/y/mask) to select grid nodes",
+        default=[None],
+    )
+    parser.add_argument(
+        "-m",
+        metavar=None,
+        dest="engine",
+        type=str,
+        nargs=1,
+        help="local filter for all cells at once or node by node (vec|loop)",
+        choices=("vec", "loop"),
+        default=[ENGINE],
+    )
+    parser.add_argument(
+        "-c",
+        metavar=("n_cores"),
+        dest="ncores",
+        type=int,
+        nargs=1,
+        help="for parallel processing of cells (vec engine), optional",
+        default=[NCORES],
+    )
+    parser.add_argument(
+        "-s",
+        dest="stream",
+        action="store_true",
+        help="global filters only (stfilter2/absfilter), chunk by chunk "
+        "(plain files only)",
+        default=False,
+    )
 
     return parser.parse_args()
 
@@ -250,6 +323,97 @@ def intersect(x1, x2, y1, y2, a1, a2, b1, b2):
     return overlap(x1, x2, a1, a2) & overlap(y1, y2, b1, b2)
 
 
+def split_ref(fref):
+    """Split "file:tile" reference into file name and tile number."""
+    fname, sep, tile = fref.rpartition(":")
+    if sep and tile.isdigit():
+        return fname, int(tile)
+
+    return fref, None
+
+
+def tile_name(fref):
+    """Name for outputs of "file:tile" reference (file name if no tile)."""
+    fname, tile = split_ref(fref)
+    if tile is None:
+        return fname
+    path, ext = os.path.splitext(fname)
+
+    return path + "_tile_%03d" % tile + ext
+
+
+def read_tile(fref, vnames=None):
+    """Read data of "file:tile" reference (file indexed with tile.py -i).
+
+    The rows of the tile and of its neighbours are read from the file
+    (sorted by tile), and the buffer is selected with the tile bbox.
+    Returns dict of 1d arrays (in original order), mask of the rows
+    of the tile itself (no buffer), bbox of the tile, and projection
+    (EPSG number) of the bbox. Data is empty if tile is not in index.
+    """
+    fname, tile = split_ref(fref)
+    path, ext = os.path.splitext(fname)
+
+    with h5py.File(path + "_INDEX" + ext, "r") as fi, h5py.File(
+        fname, "r"
+    ) as f:
+
+        tiles = fi["tile_num"][:]
+        bboxs = fi["bbox"][:]
+        i_start = fi["i_start"][:]
+        n_rows = fi["n_rows"][:]
+        buff, proj = fi.attrs["buff"], str(fi.attrs["proj"])
+        xvar, yvar = fi.attrs["xvar"], fi.attrs["yvar"]
+
+        if tile not in tiles:
+            return {}, np.array([], dtype=bool), None, proj
+
+        bbox = list(bboxs[tiles == tile][0])
+        xmin, xmax, ymin, ymax = bbox
+
+        # Tiles overlapping the buffered bbox
+        (k,) = np.where(
+            intersect(
+                bboxs[:, 0],
+                bboxs[:, 1],
+                bboxs[:, 2],
+                bboxs[:, 3],
+                xmin - buff,
+                xmax + buff,
+                ymin - buff,
+                ymax + buff,
+            )
+        )
+
+        def read(d):
+            return np.concatenate(
+                [d[i : i + n] for i, n in zip(i_start[k], n_rows[k])]
+            )
+
+        if vnames is None:
+            vnames = list(f.keys())
+        vnames = set([v for v in vnames if v and v in f] + [xvar, yvar])
+
+        data = {v: read(f[v]) for v in vnames}
+        row = read(fi["row"])
+        own = np.repeat(tiles[k] == tile, n_rows[k])
+
+    x, y = transform_coord(4326, proj, data[xvar], data[yvar])
+
+    # Select buffer and restore original order
+    (i_buff,) = np.where(
+        (x >= xmin - buff)
+        & (x <= xmax + buff)
+        & (y >= ymin - buff)
+        & (y <= ymax + buff)
+    )
+    i_buff = i_buff[np.argsort(row[i_buff])]
+
+    data = {v: d[i_buff] for v, d in data.items()}
+
+    return data, own[i_buff], bbox, proj
+
+
 def binning(
     x,
     y,
@@ -338,6 +502,88 @@ def get_radius_idx(x, y, x0, y0, radius, Tree):
     return Tree.query_ball_point((x0, y0), radius)
 
 
+def geotiffread(ifile):
+    """ Read Geotiff file """
+
+    from osgeo import gdal, osr
+
+    file = gdal.Open(ifile, gdal.GA_ReadOnly)
+
+    projection = file.GetProjection()
+    src = osr.SpatialReference()
+    src.ImportFromWkt(projection)
+    proj = src.ExportToWkt()
+
+    Nx = file.RasterXSize
+    Ny = file.RasterYSize
+
+    trans = file.GetGeoTransform()
+
+    dx = trans[1]
+    dy = trans[5]
+
+    Xp = np.arange(Nx)
+    Yp = np.arange(Ny)
+
+    (Xp, Yp) = np.meshgrid(Xp, Yp)
+
+    X = trans[0] + (Xp + 0.5) * trans[1] + (Yp + 0.5) * trans[2]
+    Y = trans[3] + (Xp + 0.5) * trans[4] + (Yp + 0.5) * trans[5]
+
+    band = file.GetRasterBand(1)
+
+    Z = band.ReadAsArray()
+
+    dx = np.abs(dx)
+    dy = np.abs(dy)
+
+    return X, Y, Z, dx, dy, proj
+
+
+def read_mask(fmask):
+    """Read raster mask: GeoTIFF or HDF5 grid with "x", "y" and "mask"."""
+
+    if fmask.endswith((".tif", ".tiff")):
+        X, Y, Z = geotiffread(fmask)[:3]
+        return X[0, :], Y[:, 0], Z
+    else:
+        with h5py.File(fmask, "r") as f:
+            return f["x"][:], f["y"][:], f["mask"][:]
+
+
+def node_mask(xi, yi, Tree, dmax, fmask=None):
+    """Flag grid nodes with data within dmax and inside (raster) mask.
+
+    Nodes outside the mask extent, or where the mask is zero/NaN, are
+    flagged False. dmax can be a scalar or an array (one per node).
+    """
+
+    # Distance to closest observation for all nodes
+    d = Tree.query(np.c_[xi, yi], k=1, distance_upper_bound=np.max(dmax),
+                   workers=-1)[0]
+
+    # Nodes with data within search radius
+    keep = d <= dmax
+
+    if fmask:
+
+        # Read mask (same projection as grid)
+        xm, ym, zm = read_mask(fmask)
+
+        # Closest mask pixel for each node
+        j = np.round((xi - xm[0]) / (xm[1] - xm[0])).astype(int)
+        i = np.round((yi - ym[0]) / (ym[1] - ym[0])).astype(int)
+
+        # Nodes inside mask extent
+        inside = (i >= 0) & (i < len(ym)) & (j >= 0) & (j < len(xm))
+
+        # Nodes inside mask
+        keep &= inside
+        keep[inside] &= zm[i[inside], j[inside]] > 0
+
+    return keep
+
+
 def get_residuals(tc, hc, order=1, dx=3 / 12.0, window=5 / 12.0):
     hc_cycle, hc_trend = detrend_binned(
         tc, hc, order=order, dx=dx, window=window
@@ -358,6 +604,7 @@ def stfilter(
     n_std=3,
     step=1 / 12.0,
     window=1 / 12.0,
+    fmask=None,
 ):
 
     (xi, yi) = xxx_todo_changeme
@@ -380,9 +627,19 @@ def stfilter(
     print("building KDTree ...")
     Tree = cKDTree(np.column_stack((x, y)))
 
+    if radius == 0:
+        radius = get_radius(
+            xi[0], yi[0]
+        )  ##FIXME: <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+
+    # Nodes with data within search radius and inside mask
+    i_nodes = np.flatnonzero(node_mask(xi, yi, Tree, radius, fmask))
+
+    print("nodes with data/inside mask:", len(i_nodes), "of", xi.shape[0])
+
     print("entering spatial loop ...")
 
-    for i_node in range(xi.shape[0]):
+    for i_node in i_nodes:
 
         if i_node % 500 == 0:
             print("node:", i_node)
@@ -392,11 +649,6 @@ def stfilter(
         ##NOTE: For topofit we don't want to pass a subgrid because we
         # also want to detrend overlapping points (outside the tile bbox).
 
-        if radius == 0:
-            radius = get_radius(
-                x0, y0
-            )  ##FIXME: <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
-
         # If search radius falls outside tile bbox, skip
 
         if not intersect(
@@ -442,6 +694,285 @@ def stfilter(
     return i_invalid
 
 
+def group_median(g, v, n):
+    """ Median of values v for each group g (0..n-1), NaN if empty. """
+    i_sort = np.lexsort((v, g))
+    g, v = g[i_sort], v[i_sort]
+    count = np.bincount(g, minlength=n)
+    start = np.cumsum(count) - count
+    med = np.full(n, np.nan)
+    (i_grp,) = np.where(count > 0)
+    i_lo = start[i_grp] + (count[i_grp] - 1) // 2
+    i_hi = start[i_grp] + count[i_grp] // 2
+    med[i_grp] = 0.5 * (v[i_lo] + v[i_hi])
+
+    return med
+
+
+def cap_pairs(x, y, xi, yi, radius, dx, dy):
+    """
+    Get data within search radius of all nodes, as (node, point) pairs.
+
+    Each point is assigned once to its (extended) grid cell and sorted by
+    cell, so the cap of each node is gathered from the neighbouring cells.
+    Pairs are returned sorted by node.
+    """
+    if len(x) == 0:
+        return np.array([], dtype=int), np.array([], dtype=int)
+
+    x0, y0 = np.min(xi), np.min(yi)
+
+    # Cell of each point and node (on the extended grid)
+    jp = np.round((x - x0) / dx).astype(int)
+    ip = np.round((y - y0) / dy).astype(int)
+    jn = np.round((xi - x0) / dx).astype(int)
+    in_ = np.round((yi - y0) / dy).astype(int)
+
+    # Neighbouring cells that can be within search radius
+    nj = int(np.ceil(radius / dx)) + 1
+    ni = int(np.ceil(radius / dy)) + 1
+
+    jmin = min(jp.min(), jn.min() - nj)
+    imin = min(ip.min(), in_.min() - ni)
+    ncol = max(jp.max(), jn.max() + nj) - jmin + 1
+
+    # Sort points by cell
+    key = (ip - imin) * ncol + (jp - jmin)
+    i_sort = np.argsort(key, kind="stable")
+    key = key[i_sort]
+
+    nodes, points = [], []
+
+    for di in range(-ni, ni + 1):
+        for dj in range(-nj, nj + 1):
+
+            # Points of neighbouring cell of each node
+            key_n = (in_ + di - imin) * ncol + (jn + dj - jmin)
+            i_lo = np.searchsorted(key, key_n, side="left")
+            count = np.searchsorted(key, key_n, side="right") - i_lo
+
+            if count.sum() == 0:
+                continue
+
+            i_node = np.repeat(np.arange(len(xi)), count)
+            i_pt = np.arange(count.sum()) - np.repeat(
+                np.cumsum(count) - count, count
+            )
+            i_pt = i_sort[np.repeat(i_lo, count) + i_pt]
+
+            # Keep points within search radius
+            i_cap = (x[i_pt] - xi[i_node]) ** 2 + (
+                y[i_pt] - yi[i_node]
+            ) ** 2 <= radius ** 2
+
+            nodes.append(i_node[i_cap])
+            points.append(i_pt[i_cap])
+
+    if len(nodes) == 0:
+        return np.array([], dtype=int), np.array([], dtype=int)
+
+    nodes, points = np.concatenate(nodes), np.concatenate(points)
+
+    i_sort = np.argsort(nodes, kind="stable")
+
+    return nodes[i_sort], points[i_sort]
+
+
+def get_residuals_groups(g, tc, hc, dx=3 / 12.0, window=5 / 12.0):
+    """
+    Same as get_residuals() for each group (cap) of obs.
+
+    Groups g (0..n-1) must be sorted and have valid (non-NaN) obs. The
+    binning, detrending (linear) and interpolation of all groups are done
+    at once. Empty bins are left out of the interpolation.
+    """
+    n = g[-1] + 1
+    i_first = np.searchsorted(g, np.arange(n))
+
+    # Time bins of each group (as in binning)
+    tmin = np.minimum.reduceat(tc, i_first)
+    tmax = np.maximum.reduceat(tc, i_first)
+    delta = (tmin + dx) - tmin
+    nb = np.ceil((tmax + dx - tmin) / dx).astype(int)
+    b_first = np.cumsum(nb) - nb
+    b_grp = np.repeat(np.arange(n), nb)
+    t1 = tmin[b_grp] + (np.arange(nb.sum()) - b_first[b_grp]) * delta[b_grp]
+    t2 = t1 + window
+
+    # Candidate bins for each obs (overlapping windows)
+    n_win = int(np.ceil(window / dx))
+    i_bin = np.floor((tc - tmin[g]) / delta[g]).astype(int)[:, None]
+    i_bin = i_bin + np.arange(-n_win - 1, 2)
+    i_obs = np.broadcast_to(np.arange(len(tc))[:, None], i_bin.shape)
+    is_bin = (i_bin >= 0) & (i_bin < nb[g][:, None])
+    i_bin = np.where(is_bin, i_bin, 0) + b_first[g][:, None]
+    is_bin &= (tc[:, None] >= t1[i_bin]) & (tc[:, None] <= t2[i_bin])
+    i_obs, i_bin = i_obs[is_bin], i_bin[is_bin]
+
+    # Bin centers (NaN if empty)
+    n_bin = np.bincount(i_bin, minlength=len(t1))
+    xb = np.where(n_bin > 0, 0.5 * (t1 + t2), np.nan)
+    valid = ~np.isnan(xb)
+
+    # Binned median, and trend (OLS) of binned values of each group
+    yb = group_median(i_bin, hc[i_obs], len(t1))
+    n_val = np.bincount(b_grp[valid], minlength=n)
+    xm = np.bincount(b_grp[valid], weights=xb[valid], minlength=n) / n_val
+    ym = np.bincount(b_grp[valid], weights=yb[valid], minlength=n) / n_val
+    xa = xb[valid] - xm[b_grp[valid]]
+    sxy = np.bincount(b_grp[valid], weights=xa * yb[valid], minlength=n)
+    sxx = np.bincount(b_grp[valid], weights=xa * xa, minlength=n)
+    slope = np.where(sxx > 0, sxy / np.where(sxx > 0, sxx, 1), 0.0)
+
+    # Detrend
+    hc_cycle = hc - (ym[g] + slope[g] * (tc - xm[g]))
+
+    # Binned median of detrended obs, interpolated to obs times
+    yb = group_median(i_bin, hc_cycle[i_obs], len(t1))
+
+    # Previous and next non-empty bin of each bin (within group)
+    i_prev = np.maximum.accumulate(np.where(valid, np.arange(len(t1)), -1))
+    i_next = np.minimum.accumulate(
+        np.where(valid, np.arange(len(t1)), len(t1))[::-1]
+    )[::-1]
+
+    # Bin (center) preceding each obs
+    i_c = np.floor((tc - (tmin[g] + 0.5 * window)) / delta[g]).astype(int)
+    i_c = np.clip(i_c, -1, nb[g] - 1)
+
+    i_lo = np.where(i_c >= 0, i_prev[b_first[g] + np.maximum(i_c, 0)], -1)
+    i_lo = np.where(i_lo >= b_first[g], i_lo, -1)
+    i_hi = np.where(
+        i_c + 1 < nb[g], i_next[b_first[g] + np.minimum(i_c + 1, nb[g] - 1)], -1
+    )
+    i_hi = np.where((i_hi >= 0) & (i_hi < b_first[g] + nb[g]), i_hi, -1)
+
+    # Linear interpolation (constant outside the bins, as np.interp)
+    x_lo, y_lo = xb[np.maximum(i_lo, 0)], yb[np.maximum(i_lo, 0)]
+    x_hi, y_hi = xb[np.maximum(i_hi, 0)], yb[np.maximum(i_hi, 0)]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        hc_bin = y_lo + (tc - x_lo) * (y_hi - y_lo) / (x_hi - x_lo)
+    hc_bin = np.where(i_hi < 0, y_lo, hc_bin)
+    hc_bin = np.where(i_lo < 0, y_hi, hc_bin)
+
+    return hc_cycle - hc_bin  # residual
+
+
+def filter_cells(
+    t, x, y, z, xi, yi, radius, dx, dy, min_obs=25, n_std=3, step=1 / 12.0,
+    window=1 / 12.0,
+):
+    """Get valid obs within the cells of nodes xi/yi (all cells at once)."""
+    # Caps of all nodes: (node, point) pairs sorted by node
+    i_node, i_cap = cap_pairs(x, y, xi, yi, radius, dx, dy)
+
+    # Nodes w/enough obs within search radius
+    n_cap = np.bincount(i_node, minlength=len(xi))
+    keep = n_cap[i_node] >= min_obs
+
+    # Leave out invalid obs (never within a valid cell)
+    keep &= ~np.isnan(z[i_cap])
+
+    i_node, i_cap = i_node[keep], i_cap[keep]
+
+    if len(i_node) == 0:
+        return i_cap
+
+    # Consecutive group number of each node
+    g = np.cumsum(np.r_[True, i_node[1:] != i_node[:-1]]) - 1
+
+    tc, xc, yc, zc = t[i_cap], x[i_cap], y[i_cap], z[i_cap]
+
+    """ Temporal filtering """
+
+    zc_res = get_residuals_groups(g, tc, zc, dx=step, window=window)
+
+    # Median and MAD-std of residuals of each cap
+    n = g[-1] + 1
+    zc_dev = np.abs(zc_res - group_median(g, zc_res, n)[g])
+    zc_mad = 1.4826 * group_median(g, zc_dev, n)[g]
+
+    x0, y0 = xi[i_node], yi[i_node]
+
+    cond1 = zc_dev < zc_mad * n_std  # boolean full radius
+    cond2 = (
+        (xc > x0 - dx / 2.0)
+        & (xc < x0 + dx / 2.0)
+        & (yc > y0 - dy / 2.0)
+        & (yc < y0 + dy / 2.0)
+    )  # within cell
+
+    return i_cap[cond1 & cond2]
+
+
+def stfilter_cells(
+    data,
+    grid,
+    radius=None,
+    min_obs=25,
+    n_std=3,
+    step=1 / 12.0,
+    window=1 / 12.0,
+    fmask=None,
+    n_cores=1,
+    chunk=CHUNK,
+):
+    """Does the same as stfilter() for blocks of cells at once."""
+    xi, yi = grid
+    t, x, y, z = data  # full file/tile data
+
+    xi_uniq, yi_uniq = np.unique(xi), np.unique(yi)
+    dx, dy = xi_uniq[1] - xi_uniq[0], yi_uniq[1] - yi_uniq[0]  # cell size
+
+    # Create output container
+    i_invalid = np.full(z.shape, True, dtype=bool)
+
+    if radius == 0:
+        radius = get_radius(
+            xi[0], yi[0]
+        )  ##FIXME: <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+
+    # Nodes inside mask
+    if fmask:
+        Tree = cKDTree(np.column_stack((x, y)))
+        i_nodes = np.flatnonzero(node_mask(xi, yi, Tree, radius, fmask))
+        xi, yi = xi[i_nodes], yi[i_nodes]
+
+    # Sort data by y: each block of nodes (grid rows) -> slice of data
+    i_sort = np.argsort(y, kind="stable")
+    y_sort = y[i_sort]
+
+    blocks = []
+
+    for k in range(0, len(xi), chunk):
+        xb, yb = xi[k : k + chunk], yi[k : k + chunk]
+        i1 = np.searchsorted(y_sort, yb.min() - radius, side="left")
+        i2 = np.searchsorted(y_sort, yb.max() + radius, side="right")
+        blocks.append((i_sort[i1:i2], xb, yb))
+
+    print("filtering %d blocks of cells ..." % len(blocks))
+
+    args = (
+        (t[ii], x[ii], y[ii], z[ii], xb, yb, radius, dx, dy, min_obs, n_std,
+         step, window)
+        for ii, xb, yb in blocks
+    )
+
+    if n_cores > 1:
+        from joblib import Parallel, delayed
+
+        i_valid = Parallel(n_jobs=n_cores, verbose=1)(
+            delayed(filter_cells)(*a) for a in args
+        )
+    else:
+        i_valid = [filter_cells(*a) for a in args]
+
+    for (ii, _, _), iv in zip(blocks, i_valid):
+        i_invalid[ii[iv]] = False  # update full tile pts
+
+    return i_invalid
+
+
 def stfilter2(
     data, xxx_todo_changeme1,
     radius=None,
@@ -483,6 +1014,93 @@ def absfilter(t, h, max_abs=50, order=1, step=1 / 12.0, window=1 / 12.0):
     return i_invalid
 
 
+def global_stats(ifile, tvar, zvar, step=1 / 12.0, window=1 / 12.0,
+                 n_samp=NSAMP):
+    """First pass of streaming mode: global trend and residual stats.
+
+    Computes the binned trend (absfilter) and the binned detrended series
+    (stfilter2) from the data, or from an evenly strided sample of at most
+    n_samp obs for large files (the full data if it fits).
+    """
+    with h5py.File(ifile, "r") as f:
+        n_obs = f[zvar].shape[0]
+        stride = max(1, int(np.ceil(n_obs / float(n_samp))))
+        t = f[tvar][::stride]
+        h = f[zvar][::stride]
+
+    print("computing global stats from %d obs ..." % len(h))
+
+    # Trend (OLS) of binned medians
+    xb, yb = binning(t, h, median=True, dx=step, window=window)[:2]
+    i_valid = ~np.isnan(yb) & ~np.isnan(xb)
+    coef = np.polyfit(xb[i_valid], yb[i_valid], 1)
+
+    h_cycle = h - np.polyval(coef, t)
+
+    # Binned medians of detrended series (empty bins left out)
+    xb, yb = binning(t, h_cycle, dx=step, window=window, median=True)[:2]
+    i_valid = ~np.isnan(xb)
+    xb, yb = xb[i_valid], yb[i_valid]
+
+    h_res = h_cycle - np.interp(t, xb, yb)
+
+    return {
+        "coef": coef,
+        "xb": xb,
+        "yb": yb,
+        "cycle_med": np.nanmedian(h_cycle),
+        "res_med": np.nanmedian(h_res),
+        "res_std": mad_std(h_res),
+    }
+
+
+def stream_filter(ifile, tvar, zvar, stats, n_std=3, max_abs=50,
+                  chunk=CHUNK_OBS):
+    """Second pass of streaming mode: filter and write chunk by chunk.
+
+    Same thresholds as stfilter2 (n_std) and absfilter (max_abs), using
+    the global stats from the first pass. Only chunks with filtered obs
+    are written back to the file.
+    """
+    n_invalid = 0
+
+    with h5py.File(ifile, "a") as f:
+
+        n_obs = f[zvar].shape[0]
+
+        # Align chunks to the HDF5 storage chunks
+        if f[zvar].chunks:
+            c = f[zvar].chunks[0]
+            chunk = int(np.ceil(chunk / float(c))) * c
+
+        for i in range(0, n_obs, chunk):
+
+            t = f[tvar][i : i + chunk]
+            h = f[zvar][i : i + chunk]
+
+            h_cycle = h - np.polyval(stats["coef"], t)
+            h_res = h_cycle - np.interp(t, stats["xb"], stats["yb"])
+
+            i_invalid = (
+                np.abs(h_res - stats["res_med"]) > stats["res_std"] * n_std
+            )  # stfilter2
+            i_invalid |= (
+                np.abs(h_cycle - stats["cycle_med"]) > max_abs
+            )  # absfilter
+
+            if not i_invalid.any():
+                continue
+
+            h[i_invalid] = np.nan
+            f[zvar][i : i + chunk] = h
+
+            n_invalid += i_invalid.sum()
+
+        f.flush()
+
+    print("filtered obs:", n_invalid, "of", n_obs)
+
+
 def main(ifile, args):
 
     print(ifile)
@@ -499,8 +1117,28 @@ def main(ifile, args):
 
     tvar, xvar, yvar, zvar = vnames
 
+    fname, tile = split_ref(ifile)
+
+    # Global filters only, in two passes (no full columns in memory)
+    if args.stream and tile is None:
+        stats = global_stats(ifile, tvar, zvar, step=STEP, window=WINDOW)
+        stream_filter(ifile, tvar, zvar, stats, n_std=N_STD, max_abs=MAX_ABS)
+        rename_file(ifile, suffix=SUFFIX)
+        return
+
     print("loading data ...")
-    time, lon, lat, obs = load_data(ifile, tvar, xvar, yvar, zvar, step=1)
+    if tile is None:
+        time, lon, lat, obs = load_data(ifile, tvar, xvar, yvar, zvar, step=1)
+    else:
+        # Tile of indexed file (data + buffer)
+        data, own, _, _ = read_tile(ifile)
+
+        # Tile not in index (e.g. split tile of adaptive index)
+        if not data:
+            print(("SKIP FILE: TILE NOT IN INDEX:", ifile))
+            return
+
+        time, lon, lat, obs = data[tvar], data[xvar], data[yvar], data[zvar]
 
     if len(obs) < MINOBS:
         return
@@ -526,15 +1164,29 @@ def main(ifile, args):
     xi, yi = Xi.ravel(), Yi.ravel()
 
     # Filter data in sapace and time (locally)
-    i_invalid = stfilter(
-        [time, x, y, obs],
-        (xi, yi),
-        radius=radius,
-        min_obs=min_obs,
-        n_std=N_STD,
-        step=STEP,
-        window=WINDOW,
-    )
+    if args.engine[0] == "vec":
+        i_invalid = stfilter_cells(
+            [time, x, y, obs],
+            (xi, yi),
+            radius=radius,
+            min_obs=min_obs,
+            n_std=N_STD,
+            step=STEP,
+            window=WINDOW,
+            fmask=args.mask[0],
+            n_cores=args.ncores[0],
+        )
+    else:
+        i_invalid = stfilter(
+            [time, x, y, obs],
+            (xi, yi),
+            radius=radius,
+            min_obs=min_obs,
+            n_std=N_STD,
+            step=STEP,
+            window=WINDOW,
+            fmask=args.mask[0],
+        )
     """
 
     i_invalid = stfilter2([time, x, y, obs], (xi,yi), radius=radius,
@@ -565,13 +1217,22 @@ def main(ifile, args):
 
     # Save data
 
-    if 1:
+    if tile is None:
         with h5py.File(ifile, "a") as f:
             f[zvar][:] = obs
             f.flush()
 
         rename_file(ifile, suffix=SUFFIX)
 
+    else:
+        # Only the tile rows (no buffer), with all variables
+        data[zvar] = obs
+        path, ext = os.path.splitext(tile_name(ifile))
+
+        with h5py.File(path + SUFFIX + ext, "w") as f:
+            for v, d in data.items():
+                f[v] = d[own]
+
 
 # Get command line args
 args = get_args()
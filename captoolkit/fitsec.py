@@ -6,6 +6,24 @@ Compute surface height changes from satellite and airborne altimetry.
 Example:
     python secfit.py /path/to/files/*.h5 -v lon lat t_year h_cor None None h_bs \
         -m g -d 1 1 -r 1 3 -a 0.5 -q 2 -z 50 -f fixed -s 1 -p 2 -n 16
+
+    python secfit.py /path/to/files/*.h5 -v lon lat t_year h_cor None None h_bs \
+        -m g -d 1 1 -r 1 3 -a 0.5 -q 2 -z 50 -f fixed -s 1 -p 2 -n 16 \
+        -g orbit 0.1 -y mean
+
+Notes:
+    Dense along-track data can be thinned before the neighbor search
+    (-g orbit dim), by averaging (-y mean) or decimating (-y dec) the
+    observations of each orbit/track in segments of length dim (km).
+
+    Grid nodes without data within the max search radius are skipped
+    before the prediction loop. Nodes can also be restricted to a raster
+    mask (--mask file, GeoTIFF or HDF5 with x/y/mask in the grid proj).
+
+    Tiles of files indexed with tile.py -i are passed as "file:tile".
+    With a tile manifest (--manifest, from tile.py -a) the tiles are
+    processed largest first, so parallel jobs do not stall on the last
+    dense tiles.
 """
 __version__ = 0.3
 
@@ -96,6 +114,21 @@ TSTEP = 1.0
 # Order of design matrix
 ORDER = 2
 
+# Number of nodes per block of search-radius queries
+CHUNK = 1000
+
+# Default orbit/track variable and segment length (km) for thinning
+THIN = [None, 0]
+
+# Default along-track thinning mode (mean|dec)
+TMODE = 'mean'
+
+# Default raster mask for grid nodes (GeoTIFF or HDF5), None = no mask
+MASK = None
+
+# Default tile manifest (tile.py -a) to process largest tiles first
+MANIFEST = None
+
 # Output description of solution
 description = ('Computes robust surface-height changes '
                'from satellite/airborne altimetry.')
@@ -105,7 +138,8 @@ parser = argparse.ArgumentParser(description=description)
 
 parser.add_argument(
         'files', metavar='file', type=str, nargs='+',
-        help='file(s) to process (ASCII, HDF5 or Numpy)')
+        help=('file(s) to process (ASCII, HDF5 or Numpy), '
+              'or "file:tile" for files indexed with tile.py -i'))
 parser.add_argument(
         '-o', metavar=('outfile'), dest='ofile', type=str, nargs=1,
         help='output file name, default same as input',
@@ -190,6 +224,22 @@ parser.add_argument(
         '-p', metavar=None, dest='model', type=int, nargs=1,
         help=('select design matrix (order of model fit)'),
         choices=(0,1,2,3), default=[ORDER],)
+parser.add_argument(
+        '-g', metavar=('orbit','dim'), dest='thin', type=str, nargs=2,
+        help=('name of orbit/track variable and length (km) for thinning'),
+        default=THIN,)
+parser.add_argument(
+        '-y', metavar=None, dest='tmode', type=str, nargs=1,
+        help=('along-track thinning: average (mean) or decimate (dec)'),
+        choices=('mean','dec'), default=[TMODE],)
+parser.add_argument(
+        '--mask', metavar=('file'), dest='mask', type=str, nargs=1,
+        help=('raster mask (GeoTIFF or HDF5 x/y/mask) to select grid nodes'),
+        default=[MASK],)
+parser.add_argument(
+        '--manifest', metavar=('file'), dest='manifest', type=str, nargs=1,
+        help=('tile manifest (tile.py -a) to process largest tiles first'),
+        default=[MANIFEST],)
 args = parser.parse_args()
 
 # Pass arguments
@@ -217,6 +267,11 @@ expr = args.expr[0]                 # expression to transform time
 njobs = args.njobs[0]               # for parallel processing
 model = args.model[0]               # model order lin=trend+accel, biq=linear+topo
 names = args.vnames[:]              # Name of hdf5 parameters of interest
+ovar = args.thin[0]                 # orbit/track variable for thinning
+dl = float(args.thin[1]) * 1e3      # along-track segment length (km -> m)
+tmode = args.tmode[0]               # thinning mode: average or decimate
+fmask = args.mask[0]                # raster mask for grid nodes
+fmanifest = args.manifest[0]        # tile manifest for scheduling
 
 print('parameters:')
 for p in list(vars(args).items()): print(p)
@@ -333,6 +388,100 @@ def get_bbox(fname):
     return list(map(float, fname[i+1:i+5]))  # m
 
 
+def split_ref(fref):
+    """ Split 'file:tile' reference into file name and tile number. """
+    fname, sep, tile = fref.rpartition(':')
+    if sep and tile.isdigit():
+        return fname, int(tile)
+    return fref, None
+
+
+def tile_name(fref):
+    """ Name for outputs of 'file:tile' reference (file name if no tile). """
+    fname, tile = split_ref(fref)
+    if tile is None:
+        return fname
+    path, ext = os.path.splitext(fname)
+    return path + '_tile_%03d' % tile + ext
+
+
+def read_tile(fref, vnames=None):
+    """
+    Read data of 'file:tile' reference (file indexed with tile.py -i).
+
+    The rows of the tile and of its neighbours are read from the file
+    (sorted by tile), and the buffer is selected with the tile bbox.
+    Returns dict of 1d arrays (in original order), mask of the rows
+    of the tile itself (no buffer), bbox of the tile, and projection
+    (EPSG number) of the bbox. Data is empty if tile is not in index.
+    """
+    fname, tile = split_ref(fref)
+    path, ext = os.path.splitext(fname)
+
+    with h5py.File(path + '_INDEX' + ext, 'r') as fi, \
+         h5py.File(fname, 'r') as f:
+
+        tiles = fi['tile_num'][:]
+        bboxs = fi['bbox'][:]
+        i_start = fi['i_start'][:]
+        n_rows = fi['n_rows'][:]
+        buff, proj = fi.attrs['buff'], str(fi.attrs['proj'])
+        xvar, yvar = fi.attrs['xvar'], fi.attrs['yvar']
+
+        if tile not in tiles:
+            return {}, np.array([], dtype=bool), None, proj
+
+        bbox = list(bboxs[tiles == tile][0])
+        xmin, xmax, ymin, ymax = bbox
+
+        # Tiles overlapping the buffered bbox
+        k, = np.where( (bboxs[:,0] <= xmax+buff) & (bboxs[:,1] >= xmin-buff) &
+                       (bboxs[:,2] <= ymax+buff) & (bboxs[:,3] >= ymin-buff) )
+
+        def read(d):
+            return np.concatenate([d[i:i+n] for i, n in
+                                   zip(i_start[k], n_rows[k])])
+
+        if vnames is None: vnames = list(f.keys())
+        vnames = set([v for v in vnames if v and v in f] + [xvar, yvar])
+
+        data = {v: read(f[v]) for v in vnames}
+        row = read(fi['row'])
+        own = np.repeat(tiles[k] == tile, n_rows[k])
+
+    x, y = transform_coord('4326', proj, data[xvar], data[yvar])
+
+    # Select buffer and restore original order
+    i_buff, = np.where( (x >= xmin-buff) & (x <= xmax+buff) &
+                        (y >= ymin-buff) & (y <= ymax+buff) )
+    i_buff = i_buff[np.argsort(row[i_buff])]
+
+    data = {v: d[i_buff] for v, d in data.items()}
+
+    return data, own[i_buff], bbox, proj
+
+
+def sort_tiles(files, fmanifest):
+    """
+    Sort tiles by number of points (tile.py -a manifest), largest first.
+
+    Tiles are given as tile files (*_tile_NNN*) or "file:tile" references.
+    Files without tile number (or not in the manifest) are left last.
+    """
+    with h5py.File(fmanifest, 'r') as fm:
+        n_pts = dict(zip(fm['tile_num'][:], fm['n_pts'][:]))
+
+    def size(fname):
+        fname, tile = split_ref(fname)
+        if tile is None:
+            name = os.path.splitext(os.path.basename(fname))[0].split('_')
+            if 'tile' not in name: return -1
+            tile = int(name[name.index('tile') + 1])
+        return n_pts.get(tile, -1)
+
+    return sorted(files, key=size, reverse=True)
+
+
 def mad_std(x, axis=None):
     """ Robust standard deviation (using MAD). """
     return 1.4826 * np.nanmedian(np.abs(x - np.nanmedian(x, axis)), axis)
@@ -384,6 +533,232 @@ def get_radius_idx(x, y, x0, y0, r, Tree, n_reloc=0):
     return idx, reloc_dist
 
 
+def cap_median(arrs, caps):
+    """ Median of each array over the indices of each cap (NaN if empty). """
+    n = np.array([len(c) for c in caps])
+    valid = np.arange(max(n.max(), 1)) < n[:, None]
+    i_pad = np.zeros(valid.shape, dtype=int)
+    i_pad[valid] = np.concatenate(caps)
+    i_row = np.arange(len(caps))
+    i_lo, i_hi = np.maximum((n - 1) // 2, 0), np.maximum(n // 2, 0)
+    meds = []
+    for a in arrs:
+        A = np.sort(np.where(valid, a[i_pad], np.inf), axis=1)
+        med = 0.5 * (A[i_row, i_lo] + A[i_row, i_hi])
+        meds.append(np.where(n > 0, med, np.nan))
+    return meds
+
+
+def get_radius_idx_batch(x, y, x0, y0, r, Tree, n_reloc=0):
+    """
+    Get indices of all data points inside radius of each node.
+
+    Same as get_radius_idx for arrays of nodes (x0, y0): all nodes are
+    queried and relocated at once, and indices are in the same order as
+    for a single node. A node stops relocating when the total relocation
+    is larger than the search radius, or when its center no longer moves
+    (the cap would not change).
+
+    Returns the indices of each node, and the last relocation distance.
+    """
+    x0, y0 = np.asarray(x0, dtype=float), np.asarray(y0, dtype=float)
+
+    # Query the Tree from the nodes
+    idx = Tree.query_ball_point(
+        np.c_[x0, y0], r, workers=-1, return_sorted=False
+    )
+
+    reloc_dist = np.zeros(len(x0))
+
+    # Nodes with enough points to do relocation
+    active = np.array([len(i) >= 2 for i in idx], dtype=bool)
+    xc, yc = x0.copy(), y0.copy()
+
+    # Relocate center of search radius and query again
+    for k in range(n_reloc):
+
+        (i_act,) = np.where(active)
+
+        if len(i_act) == 0:
+            break
+
+        # Compute new search locations => median of each cap
+        x_new, y_new = cap_median([x, y], [idx[i] for i in i_act])
+
+        # Compute relocation distance
+        reloc_dist[i_act] = np.hypot(x_new - x0[i_act], y_new - y0[i_act])
+
+        # Do not allow total relocation to be larger than the search radius
+        move = ~(reloc_dist[i_act] > r) & ~np.isnan(x_new)
+        move &= (x_new != xc[i_act]) | (y_new != yc[i_act])
+
+        active[i_act[~move]] = False
+        i_act, x_new, y_new = i_act[move], x_new[move], y_new[move]
+
+        if len(i_act) == 0:
+            break
+
+        # Query from the new locations
+        idx_new = Tree.query_ball_point(
+            np.c_[x_new, y_new], r, workers=-1, return_sorted=False
+        )
+
+        for i, i_new in zip(i_act, idx_new):
+            idx[i] = i_new
+
+        xc[i_act], yc[i_act] = x_new, y_new
+
+    return list(idx), reloc_dist
+
+
+def thin_track(orb, dl, x, y, s, *var, mode='mean', ids=()):
+    """Along-track thinning of observations (by orbit/track id).
+
+    Observations are binned along each track (in the order they are
+    stored) into segments of length 'dl', and each segment is replaced
+    by its mean (mode='mean') or its middle observation (mode='dec').
+
+    Returns thinned x, y, sigma and any other variables passed. Labels
+    in 'ids' (e.g. mission id, constant along a track) are always taken
+    from the middle observation and returned last. For the mean, sigma
+    is propagated as sqrt(sum(s**2))/n, unless no a-priori errors are
+    given (all ones). Observations with NaNs are not used.
+    """
+
+    # Use only valid observations
+    i_valid = np.all(np.isfinite(np.vstack((x, y, s) + var)), axis=0)
+
+    # Sort by track keeping the along-track order
+    i_sort = np.flatnonzero(i_valid)[np.argsort(orb[i_valid], kind='stable')]
+
+    # Coordinates and tracks in sorted order
+    xs, ys, ts = x[i_sort], y[i_sort], orb[i_sort]
+
+    # Flag start of new track
+    new = np.r_[True, ts[1:] != ts[:-1]]
+
+    # Along-track distance (reset at the start of each track)
+    step = np.r_[0, np.hypot(np.diff(xs), np.diff(ys))]
+    step[new] = 0
+    dist = np.cumsum(step)
+    dist -= dist[np.flatnonzero(new)][np.cumsum(new) - 1]
+
+    # Segment number along each track
+    seg = np.floor(dist / dl).astype(np.int64)
+
+    # Flag start of new segment and label segments
+    new |= np.r_[True, seg[1:] != seg[:-1]]
+    label = np.cumsum(new) - 1
+
+    # Number of obs. per segment
+    n = np.bincount(label)
+
+    # Middle observation of each segment
+    i_keep = i_sort[np.flatnonzero(new) + n // 2]
+
+    if mode == 'dec':
+
+        # Decimated variables
+        xo, yo, so = x[i_keep], y[i_keep], s[i_keep]
+        var = [v[i_keep] for v in var]
+
+    else:
+
+        # Mean of each segment
+        xo, yo = [np.bincount(label, weights=v[i_sort]) / n for v in (x, y)]
+        var = [np.bincount(label, weights=v[i_sort]) / n for v in var]
+
+        # Error of the mean (keep ones if no a-priori errors)
+        if np.all(s == 1):
+            so = np.ones(len(n))
+        else:
+            so = np.sqrt(np.bincount(label, weights=s[i_sort] ** 2)) / n
+
+    return (xo, yo, so) + tuple(var) + tuple(v[i_keep] for v in ids)
+
+
+def geotiffread(ifile):
+    """ Read Geotiff file """
+
+    from osgeo import gdal, osr
+
+    file = gdal.Open(ifile, gdal.GA_ReadOnly)
+
+    projection = file.GetProjection()
+    src = osr.SpatialReference()
+    src.ImportFromWkt(projection)
+    proj = src.ExportToWkt()
+
+    Nx = file.RasterXSize
+    Ny = file.RasterYSize
+
+    trans = file.GetGeoTransform()
+
+    dx = trans[1]
+    dy = trans[5]
+
+    Xp = np.arange(Nx)
+    Yp = np.arange(Ny)
+
+    (Xp, Yp) = np.meshgrid(Xp, Yp)
+
+    X = trans[0] + (Xp + 0.5) * trans[1] + (Yp + 0.5) * trans[2]
+    Y = trans[3] + (Xp + 0.5) * trans[4] + (Yp + 0.5) * trans[5]
+
+    band = file.GetRasterBand(1)
+
+    Z = band.ReadAsArray()
+
+    dx = np.abs(dx)
+    dy = np.abs(dy)
+
+    return X, Y, Z, dx, dy, proj
+
+
+def read_mask(fmask):
+    """Read raster mask: GeoTIFF or HDF5 grid with 'x', 'y' and 'mask'."""
+
+    if fmask.endswith(('.tif', '.tiff')):
+        X, Y, Z = geotiffread(fmask)[:3]
+        return X[0, :], Y[:, 0], Z
+    else:
+        with h5py.File(fmask, 'r') as f:
+            return f['x'][:], f['y'][:], f['mask'][:]
+
+
+def node_mask(xi, yi, Tree, dmax, fmask=None):
+    """Flag grid nodes with data within dmax and inside (raster) mask.
+
+    Nodes outside the mask extent, or where the mask is zero/NaN, are
+    flagged False. dmax can be a scalar or an array (one per node).
+    """
+
+    # Distance to closest observation for all nodes
+    d = Tree.query(np.c_[xi, yi], k=1, distance_upper_bound=np.max(dmax),
+                   workers=-1)[0]
+
+    # Nodes with data within search radius
+    keep = d <= dmax
+
+    if fmask:
+
+        # Read mask (same projection as grid)
+        xm, ym, zm = read_mask(fmask)
+
+        # Closest mask pixel for each node
+        j = np.round((xi - xm[0]) / (xm[1] - xm[0])).astype(int)
+        i = np.round((yi - ym[0]) / (ym[1] - ym[0])).astype(int)
+
+        # Nodes inside mask extent
+        inside = (i >= 0) & (i < len(ym)) & (j >= 0) & (j < len(xm))
+
+        # Nodes inside mask
+        keep &= inside
+        keep[inside] &= zm[i[inside], j[inside]] > 0
+
+    return keep
+
+
 def n_months(tc, hc, tstep=1/12.):
     """ Bin at monthly intervals to check temporal sampling => nmonths, tspan """
     t_b, h_binned = binning(tc, hc, dx=tstep, window=tstep)[:2]
@@ -401,8 +776,10 @@ def is_empty(ifile):
 # Main function for computing parameters
 def main(ifile, n='', robust_fit=True, n_iter=niter):
     
+    fname, tile = split_ref(ifile)
+
     # Check for empty file
-    if is_empty(ifile):
+    if is_empty(fname):
         print(('SKIP FILE: EMPTY OR CORRUPTED FILE:', ifile))
         return
 
@@ -413,14 +790,33 @@ def main(ifile, n='', robust_fit=True, n_iter=niter):
 
     xvar, yvar, tvar, zvar, svar, ivar, cvar = names
 
-    with h5py.File(ifile, 'r') as fi:
-        lon = fi[xvar][:]
-        lat = fi[yvar][:]
-        time = fi[tvar][:]
-        height = fi[zvar][:]
-        sigma = fi[svar][:] if svar in fi else np.ones(lon.shape)
-        id = fi[ivar][:] if ivar in fi else np.ones(lon.shape) * nmidx
-        cal = fi[cvar][:] if cvar in fi else np.zeros(lon.shape)
+    # Plain file, or tile of indexed file (data + buffer)
+    if tile is None:
+        fi = h5py.File(ifile, 'r')
+    else:
+        fi, _, bbox_tile, proj_tile = read_tile(ifile, names + [ovar])
+
+        # Tile not in index (e.g. split tile of adaptive index)
+        if not fi:
+            print(('SKIP FILE: TILE NOT IN INDEX:', ifile))
+            return
+
+        # Tile bbox must be in the grid projection
+        if proj_tile != projo:
+            print(('SKIP FILE: TILE PROJ (EPSG:%s) != GRID PROJ (EPSG:%s):'
+                   % (proj_tile, projo), ifile))
+            return
+
+    lon = fi[xvar][:]
+    lat = fi[yvar][:]
+    time = fi[tvar][:]
+    height = fi[zvar][:]
+    sigma = fi[svar][:] if svar in fi else np.ones(lon.shape)
+    id = fi[ivar][:] if ivar in fi else np.ones(lon.shape) * nmidx
+    cal = fi[cvar][:] if cvar in fi else np.zeros(lon.shape)
+    orb = fi[ovar][:] if ovar else np.zeros(lon.shape)
+
+    if tile is None: fi.close()
 
     # Filter in time
     if 1:
@@ -443,6 +839,7 @@ def main(ifile, n='', robust_fit=True, n_iter=niter):
         sigma = sigma[i_valid]
         id = id[i_valid]
         cal = cal[i_valid]
+        orb = orb[i_valid]
 
     projGeo = '4326'  # EPSG number for lon/lat proj
     projGrd = projo   # EPSG number for grid proj
@@ -450,7 +847,9 @@ def main(ifile, n='', robust_fit=True, n_iter=niter):
     print('converting lon/lat to x/y ...')
 
     # If no bbox was given
-    if bbox_ is None:
+    if bbox_ is None and tile is not None:
+        bbox = bbox_tile
+    elif bbox_ is None:
         try:
             bbox = get_bbox(ifile)  # Try reading bbox from file name
         except:
@@ -471,7 +870,7 @@ def main(ifile, n='', robust_fit=True, n_iter=niter):
 
         # Check bbox for obs.
         if len(x[Ig]) == 0:
-	    print(('SKIP FILE: NO DATA POINTS INSIDE BBOX:', ifile))
+            print(('SKIP FILE: NO DATA POINTS INSIDE BBOX:', ifile))
             return
             
         print(('Number of obs. edited by bbox!', 'before:', len(x), 'after:', len(x[Ig])))
@@ -483,6 +882,7 @@ def main(ifile, n='', robust_fit=True, n_iter=niter):
         time = time[Ig]
         height = height[Ig]
         sigma = sigma[Ig]
+        orb = orb[Ig]
     else:
         # Convert into stereographic coordinates
         x, y = transform_coord(projGeo, projGrd, lon, lat)
@@ -508,13 +908,31 @@ def main(ifile, n='', robust_fit=True, n_iter=niter):
         time = time[Itime]
         height = height[Itime]
         sigma = sigma[Itime]
+        orb = orb[Itime]
     else:
         # Time interval = all data
         t1lim, t2lim = time.min(), time.max()
 
+    # Thin data along track
+    if ovar:
+        n_obs = len(x)
+
+        # Tracks of each mission (same orbit number in different missions)
+        track = np.unique(np.c_[id, orb], axis=0, return_inverse=True)[1]
+
+        # Average or decimate data in along-track segments (id decimated)
+        x, y, sigma, time, height, id = thin_track(
+                track.ravel(), dl, x, y, sigma, time, height, ids=(id,),
+                mode=tmode)
+
+        print(('Number of obs. edited by thinning!', 'before:', n_obs, 'after:', len(x)))
+
     if mode == 'p':
         # Point solution - all points
         xi, yi = np.copy(x), np.copy(y)
+
+        # Process all points
+        i_nodes = np.arange(len(xi))
     else:
         # Grid solution - defined by nodes
         Xi, Yi = make_grid(xmin, xmax, ymin, ymax, dx, dy)
@@ -525,6 +943,11 @@ def main(ifile, n='', robust_fit=True, n_iter=niter):
         print('building the k-d tree ...')
         Tree = cKDTree(coord)
 
+        # Nodes with data within search radius and inside mask
+        i_nodes = np.flatnonzero(node_mask(xi, yi, Tree, dmax, fmask))
+
+        print(('Number of nodes with data/inside mask:', len(i_nodes), 'of', len(xi)))
+
     # Overall (fixed) mean time
     t_mean = np.round(np.nanmean(time), 2)
 
@@ -551,7 +974,11 @@ def main(ifile, n='', robust_fit=True, n_iter=niter):
 
     # Enter prediction loop
     print('predicting values ...')
-    for i in range(len(xi)):
+    for k, i in enumerate(i_nodes):
+
+        # Next block of nodes: search caps computed once per radius
+        if k % CHUNK == 0:
+            i_block, caps = i_nodes[k:k+CHUNK], {}
 
         xc, yc = xi[i], yi[i]  # Center coordinates
 
@@ -559,7 +986,11 @@ def main(ifile, n='', robust_fit=True, n_iter=niter):
         for rad in dr:
 
             # Get indices of data within search radius (after relocation)
-            i_cell, reloc_dist = get_radius_idx(x, y, xc, yc, rad, Tree, n_reloc=nreloc)
+            if rad not in caps:
+                caps[rad] = get_radius_idx_batch(x, y, xi[i_block], yi[i_block],
+                                                 rad, Tree, n_reloc=nreloc)
+
+            i_cell, reloc_dist = caps[rad][0][k % CHUNK], caps[rad][1][k % CHUNK]
 
             if len(i_cell) < nlim: continue  # use larger radius
 
@@ -812,7 +1243,7 @@ def main(ifile, n='', robust_fit=True, n_iter=niter):
     if ofile:
         outfile = ofile
     else:
-        outfile = ifile
+        outfile = tile_name(ifile)
 
     # Output file names - strings
     path, ext = os.path.splitext(outfile)
@@ -852,6 +1283,9 @@ def main(ifile, n='', robust_fit=True, n_iter=niter):
     print(('Time series errors -> ', ofile2))
 
 
+# Largest tiles first (load balancing)
+if fmanifest: files = sort_tiles(files, fmanifest)
+
 # Run main program
 if njobs == 1:
     print('running sequential code ...')
@@ -25,11 +25,24 @@ Notes:
     usually needed to center the data (depends on search radius)
 
     This program can be run in parallel to processes several files at the same
-    time (tiles or missions etc).
+    time (tiles or missions etc). Tiles of files indexed with "tile.py -i" are
+    passed as "file:tile", and only the tile rows (no buffer) are saved, with
+    all variables, to "file_tile_NNN_TOPO.h5". With a tile manifest from
+    "tile.py -a" (--manifest) the tiles are processed largest first.
 
     Good threshold ("-m" option) for switching from biquadratic to bilinear
     model is around 10-15 points.
 
+    By default nodes are solved in batches ("-e vec"): the caps of each batch
+    are padded into arrays and the robust (Huber) fits are done with batched
+    IRLS, giving the same solution as the node loop ("-e loop").
+
+    The solution of each node (centroid and surface coefficients) is saved
+    to a coefficient grid (*_TOPOGRD.h5). To remove the same topography from
+    new data, pass this file with "-g": the surface of the node with lowest
+    RMSE (or the nearest node, "-l nearest") within the search radius is
+    evaluated at each point, without any fitting.
+
 Example:
 
     python fittopo.py /path/to/files/*.h5 -v lon lat t_year h_cor \
@@ -94,6 +107,24 @@ NJOBS = 1
 # Maximum slope allowed from the solution, replaced by SLOPE
 SLOPE = 1.0
 
+# Default engine: batched nodes (vec) or node by node (loop)
+ENGINE = 'vec'
+
+# Default number of nodes per batch (vec engine)
+CHUNK = 100
+
+# Default node lookup when applying a coefficient grid: 'best' | 'nearest'
+LOOKUP = 'best'
+
+# Default tile manifest (tile.py -a) to process largest tiles first
+MANIFEST = None
+
+# Node solutions saved to the coefficient grid (_TOPOGRD): centroid,
+# surface coefficients (c_0 + c_1 dx + c_2 dy + c_3 dx dy + c_4 dx^2 +
+# c_5 dy^2, w.r.t. the centroid) and the solution parameters
+GRDVARS = ['x_c', 'y_c', 'c_0', 'c_1', 'c_2', 'c_3', 'c_4', 'c_5',
+           'h_mod', 'e_res', 'm_deg', 't_ref', 'slp_x', 'slp_y']
+
 # Output description of solution
 description = ('Compute surface elevation residuals '
                'from satellite/airborne altimetry.')
@@ -103,7 +134,8 @@ parser = argparse.ArgumentParser(description=description)
 
 parser.add_argument(
         'files', metavar='file', type=str, nargs='+',
-        help='file(s) to process (ASCII, HDF5 or Numpy)')
+        help=('file(s) to process (ASCII, HDF5 or Numpy), '
+              'or "file:tile" for files indexed with tile.py -i'))
 
 parser.add_argument(
         '-d', metavar=('dx','dy'), dest='dxy', type=float, nargs=2,
@@ -170,6 +202,31 @@ parser.add_argument(
         help="slope limit for x/y direction (deg)",
         default=[SLOPE],)
 
+parser.add_argument(
+        '-e', metavar=None, dest='engine', type=str, nargs=1,
+        help="solve nodes in batches or one by one (vec|loop)",
+        choices=('vec', 'loop'), default=[ENGINE],)
+
+parser.add_argument(
+        '-b', metavar=('chunk'), dest='chunk', type=int, nargs=1,
+        help="number of nodes per batch (vec engine)",
+        default=[CHUNK],)
+
+parser.add_argument(
+        '-g', metavar=('grid_file'), dest='fgrid', type=str, nargs=1,
+        help="apply coefficient grid (_TOPOGRD) instead of fitting, optional",
+        default=[None],)
+
+parser.add_argument(
+        '-l', metavar=None, dest='lookup', type=str, nargs=1,
+        help="node used for each point with a grid (best|nearest)",
+        choices=('best', 'nearest'), default=[LOOKUP],)
+
+parser.add_argument(
+        '--manifest', metavar=('file'), dest='manifest', type=str, nargs=1,
+        help="tile manifest (tile.py -a) to process largest tiles first",
+        default=[MANIFEST],)
+
 args = parser.parse_args()
 
 # Pass arguments
@@ -188,6 +245,11 @@ expr   = args.expr[0]                # expression to transform time
 njobs  = args.njobs[0]               # for parallel processing of tiles
 order  = args.order[0]               # max order of the surface fit model
 slplim = args.slplim[0]              # max allowed surface slope in deg.
+engine = args.engine[0]              # batched (vec) or node loop
+chunk  = args.chunk[0]               # number of nodes per batch
+fgrid  = args.fgrid[0]               # coefficient grid to apply (no fitting)
+lookup = args.lookup[0]              # node lookup for coefficient grid
+fmanifest = args.manifest[0]         # tile manifest for scheduling
 
 print('parameters:')
 for p in list(vars(args).items()):
@@ -218,6 +280,79 @@ def transform_coord(proj1, proj2, x, y):
     return pyproj.transform(proj1, proj2, x, y)
 
 
+def split_ref(fref):
+    """ Split 'file:tile' reference into file name and tile number. """
+    fname, sep, tile = fref.rpartition(':')
+    if sep and tile.isdigit():
+        return fname, int(tile)
+    return fref, None
+
+
+def tile_name(fref):
+    """ Name for outputs of 'file:tile' reference (file name if no tile). """
+    fname, tile = split_ref(fref)
+    if tile is None:
+        return fname
+    path, ext = os.path.splitext(fname)
+    return path + '_tile_%03d' % tile + ext
+
+
+def read_tile(fref, vnames=None):
+    """
+    Read data of 'file:tile' reference (file indexed with tile.py -i).
+
+    The rows of the tile and of its neighbours are read from the file
+    (sorted by tile), and the buffer is selected with the tile bbox.
+    Returns dict of 1d arrays (in original order), mask of the rows
+    of the tile itself (no buffer), bbox of the tile, and projection
+    (EPSG number) of the bbox. Data is empty if tile is not in index.
+    """
+    fname, tile = split_ref(fref)
+    path, ext = os.path.splitext(fname)
+
+    with h5py.File(path + '_INDEX' + ext, 'r') as fi, \
+         h5py.File(fname, 'r') as f:
+
+        tiles = fi['tile_num'][:]
+        bboxs = fi['bbox'][:]
+        i_start = fi['i_start'][:]
+        n_rows = fi['n_rows'][:]
+        buff, proj = fi.attrs['buff'], str(fi.attrs['proj'])
+        xvar, yvar = fi.attrs['xvar'], fi.attrs['yvar']
+
+        if tile not in tiles:
+            return {}, np.array([], dtype=bool), None, proj
+
+        bbox = list(bboxs[tiles == tile][0])
+        xmin, xmax, ymin, ymax = bbox
+
+        # Tiles overlapping the buffered bbox
+        k, = np.where( (bboxs[:,0] <= xmax+buff) & (bboxs[:,1] >= xmin-buff) &
+                       (bboxs[:,2] <= ymax+buff) & (bboxs[:,3] >= ymin-buff) )
+
+        def read(d):
+            return np.concatenate([d[i:i+n] for i, n in
+                                   zip(i_start[k], n_rows[k])])
+
+        if vnames is None: vnames = list(f.keys())
+        vnames = set([v for v in vnames if v and v in f] + [xvar, yvar])
+
+        data = {v: read(f[v]) for v in vnames}
+        row = read(fi['row'])
+        own = np.repeat(tiles[k] == tile, n_rows[k])
+
+    x, y = transform_coord('4326', proj, data[xvar], data[yvar])
+
+    # Select buffer and restore original order
+    i_buff, = np.where( (x >= xmin-buff) & (x <= xmax+buff) &
+                        (y >= ymin-buff) & (y <= ymax+buff) )
+    i_buff = i_buff[np.argsort(row[i_buff])]
+
+    data = {v: d[i_buff] for v, d in data.items()}
+
+    return data, own[i_buff], bbox, proj
+
+
 def mad_std(x, axis=None):
     """ Robust standard deviation (using MAD). """
     return 1.4826 * np.nanmedian(np.abs(x - np.nanmedian(x, axis)), axis)
@@ -277,6 +412,84 @@ def get_radius_idx(x, y, x0, y0, r, Tree, n_reloc=0,
     return idx
 
 
+def cap_median(arrs, caps):
+    """ Median of each array over the indices of each cap (NaN if empty). """
+    n = np.array([len(c) for c in caps])
+    valid = np.arange(max(n.max(), 1)) < n[:, None]
+    i_pad = np.zeros(valid.shape, dtype=int)
+    i_pad[valid] = np.concatenate(caps)
+    i_row = np.arange(len(caps))
+    i_lo, i_hi = np.maximum((n - 1) // 2, 0), np.maximum(n // 2, 0)
+    meds = []
+    for a in arrs:
+        A = np.sort(np.where(valid, a[i_pad], np.inf), axis=1)
+        med = 0.5 * (A[i_row, i_lo] + A[i_row, i_hi])
+        meds.append(np.where(n > 0, med, np.nan))
+    return meds
+
+
+def get_radius_idx_batch(x, y, x0, y0, r, Tree, n_reloc=0):
+    """
+    Get indices of all data points inside radius of each node.
+
+    Same as get_radius_idx for arrays of nodes (x0, y0): all nodes are
+    queried and relocated at once, and indices are in the same order as
+    for a single node. A node stops relocating when the total relocation
+    is larger than the search radius, or when its center no longer moves
+    (the cap would not change). The time-coverage check is not applied.
+
+    Returns the indices of each node, and the last relocation distance.
+    """
+    x0, y0 = np.asarray(x0, dtype=float), np.asarray(y0, dtype=float)
+
+    # Query the Tree from the nodes
+    idx = Tree.query_ball_point(
+        np.c_[x0, y0], r, workers=-1, return_sorted=False
+    )
+
+    reloc_dist = np.zeros(len(x0))
+
+    # Nodes with enough points to do relocation
+    active = np.array([len(i) >= 2 for i in idx], dtype=bool)
+    xc, yc = x0.copy(), y0.copy()
+
+    # Relocate center of search radius and query again
+    for k in range(n_reloc):
+
+        (i_act,) = np.where(active)
+
+        if len(i_act) == 0:
+            break
+
+        # Compute new search locations => median of each cap
+        x_new, y_new = cap_median([x, y], [idx[i] for i in i_act])
+
+        # Compute relocation distance
+        reloc_dist[i_act] = np.hypot(x_new - x0[i_act], y_new - y0[i_act])
+
+        # Do not allow total relocation to be larger than the search radius
+        move = ~(reloc_dist[i_act] > r) & ~np.isnan(x_new)
+        move &= (x_new != xc[i_act]) | (y_new != yc[i_act])
+
+        active[i_act[~move]] = False
+        i_act, x_new, y_new = i_act[move], x_new[move], y_new[move]
+
+        if len(i_act) == 0:
+            break
+
+        # Query from the new locations
+        idx_new = Tree.query_ball_point(
+            np.c_[x_new, y_new], r, workers=-1, return_sorted=False
+        )
+
+        for i, i_new in zip(i_act, idx_new):
+            idx[i] = i_new
+
+        xc[i_act], yc[i_act] = x_new, y_new
+
+    return list(idx), reloc_dist
+
+
 def rlsq(x, y, n=1):
     """ Fit a robust polynomial of n:th deg."""
 
@@ -344,11 +557,414 @@ def rlsq(x, y, n=1):
     return p[::-1], s
 
 
+def pad_series(arrs, caps):
+    """
+    Gather the data of each cap into padded (nodes x obs) arrays.
+
+    Entries beyond the number of obs in each cap are set to NaN.
+    """
+    n = np.array([len(c) for c in caps])
+    valid = np.arange(n.max()) < n[:, None]
+    i_pad = np.zeros(valid.shape, dtype=int)
+    i_pad[valid] = np.concatenate(caps)
+    return n, [np.where(valid, a[i_pad], np.nan) for a in arrs]
+
+
+def median_batch(X):
+    """ Median of each row, NaNs ignored (NaN if all NaN). """
+    X = np.sort(X, axis=1)
+    n = np.sum(~np.isnan(X), axis=1)
+    i_lo = np.maximum((n - 1) // 2, 0)[:, None]
+    i_hi = np.maximum(n // 2, 0)[:, None]
+    med = 0.5 * (np.take_along_axis(X, i_lo, 1) +
+                 np.take_along_axis(X, i_hi, 1))[:, 0]
+    return np.where(n > 0, med, np.nan)
+
+
+def mad_batch(X, center=True):
+    """ MAD of each row, as statsmodels' mad (NaNs ignored). """
+    med = median_batch(X)[:, None] if center else 0.0
+    return median_batch(np.abs(X - med)) / 0.6744897501960817
+
+
+def huber_weights(z, t=1.345):
+    """ Weights of Huber's T norm for standardized residuals. """
+    z = np.abs(z)
+    return np.where(z <= t, 1.0, t / np.where(z <= t, 1.0, z))
+
+
+def huber_rho(z, t=1.345):
+    """ Criterion function of Huber's T norm. """
+    z = np.abs(z)
+    return np.where(z <= t, 0.5 * z ** 2, z * t - 0.5 * t ** 2)
+
+
+def wls_batch(A, Y, W):
+    """ Weighted least-squares fit of each node (rows w/zero weight out). """
+    w = np.sqrt(W)
+    Aw = A * w[:, :, None]
+    Yw = (Y * w)[:, :, None]
+    return np.matmul(np.linalg.pinv(Aw), Yw)[:, :, 0]
+
+
+def rlm_batch(A, Y, maxiter=5, tol=0.001):
+    """
+    Robust (Huber) linear fit of each node, as sm.RLM().fit().
+
+    A is (nodes x obs x params) and Y is (nodes x obs), with NaNs for
+    missing obs (dropped). All nodes are solved at once by IRLS, and
+    each node stops iterating as RLM does (change in deviance <= tol,
+    or maxiter reached).
+    """
+    valid = ~np.isnan(Y) & ~np.any(np.isnan(A), axis=2)
+    A = np.where(valid[:, :, None], A, 0.0)
+    Y = np.where(valid, Y, 0.0)
+    df = valid.sum(axis=1) - A.shape[2]
+
+    def fit(i, W):
+        coef = wls_batch(A[i], Y[i], W)
+        res = Y[i] - np.sum(A[i] * coef[:, None, :], axis=2)
+        scale = mad_batch(np.where(valid[i], res, np.nan), center=False)
+        wls_scale = np.sum(W * res ** 2, axis=1) / df[i]
+        dev = np.sum(
+            valid[i] * huber_rho(res / wls_scale[:, None]), axis=1)
+        return coef, res, scale, dev
+
+    # Initial solution (OLS)
+    i_all = np.arange(len(Y))
+    coef, res, scale, dev = fit(i_all, valid.astype(float))
+
+    active = np.ones(len(Y), dtype=bool)
+    iteration = 1
+
+    while True:
+
+        # Perfect fit of the weighted data, no reweighting
+        active &= scale != 0
+
+        (i_act,) = np.where(active)
+
+        if len(i_act) == 0:
+            break
+
+        W = valid[i_act] * huber_weights(res[i_act] / scale[i_act, None])
+
+        coef[i_act], res[i_act], scale[i_act], dev_new = fit(i_act, W)
+
+        iteration += 1
+
+        # Converged nodes
+        i_conv = ~(np.abs(dev_new - dev[i_act]) > tol)
+        if iteration >= maxiter:
+            i_conv[:] = True
+
+        dev[i_act] = dev_new
+        active[i_act[i_conv]] = False
+
+    return coef
+
+
+def fit_batch(x, y, time, height, caps, t_mean, tref_, order, mlim,
+              niter, slp_lim):
+    """
+    Compute the topography solution of each cap, as the node loop in main().
+
+    Caps are gathered into padded arrays, grouped by model (biquadratic,
+    bilinear or mean) and solved at once. Returns for each cap: the
+    model identifier, RMSE, mean height, x/y slopes, ref time, surface
+    coefficients and centroid, and the residuals of all caps
+    (concatenated in cap order).
+    """
+    nb, (xcap, ycap, tcap, hcap) = pad_series((x, y, time, height), caps)
+    valid = np.arange(xcap.shape[1]) < nb[:, None]
+
+    # Centroid nodes
+    xc = median_batch(xcap)
+    yc = median_batch(ycap)
+
+    # If reference time not given, use fixed or variable mean
+    if tref_ == 'fixed':
+        tref = np.full(len(caps), t_mean)
+    elif tref_ == 'variable':
+        tref = np.nanmean(tcap, axis=1)
+    else:
+        tref = np.full(len(caps), float(tref_))
+
+    # Design matrix elements
+    c1 = xcap - xc[:, None]
+    c2 = ycap - yc[:, None]
+    c3 = c1 * c2
+    c4 = c1 * c1
+    c5 = c2 * c2
+    c6 = tcap - tref[:, None]
+
+    # Determine model order
+    mi = np.where((order == 2) & (nb >= mlim * 2), 1,
+                  np.where(nb >= mlim, 2, 3))
+
+    # Coefficients of surface models (mean height, x/y slopes, ...)
+    Cm = np.zeros((len(caps), 6))
+
+    # Biquadratic surface and linear trend
+    i1 = mi == 1
+    if np.any(i1):
+        Acap = np.stack((np.ones_like(c1), c1, c2, c3, c4, c5, c6), axis=2)
+        Cm[i1] = rlm_batch(Acap[i1], hcap[i1], maxiter=niter)[:, :6]
+
+    # Bilinear surface and linear trend
+    i2 = mi == 2
+    if np.any(i2):
+        Acap = np.stack((np.ones_like(c1), c1, c2, c6), axis=2)
+        Cm[i2, :3] = rlm_batch(Acap[i2], hcap[i2], maxiter=niter)[:, :3]
+
+    # Compute along and across track slope
+    sx = np.clip(Cm[:, 1], -slp_lim, slp_lim)
+    sy = np.clip(Cm[:, 2], -slp_lim, slp_lim)
+
+    # Mean height
+    h_avg = Cm[:, 0].copy()
+
+    # Biquadratic/bilinear surface
+    h_model = (Cm[:, 0, None] + Cm[:, 1, None] * c1 + Cm[:, 2, None] * c2 +
+               Cm[:, 3, None] * c3 + Cm[:, 4, None] * c4 +
+               Cm[:, 5, None] * c5)
+
+    # Mean surface and robust slopes
+    i3 = mi == 3
+    if np.any(i3):
+
+        # Mean surface from median (NaN if any NaN in cap)
+        h_3 = hcap[i3]
+        h_avg[i3] = np.where(np.any(np.isnan(h_3) & valid[i3], axis=1),
+                             np.nan, median_batch(h_3))
+
+        # Compute distance estimates from centroid
+        s_dx = c1[i3] + 1e-3
+        s_dy = c2[i3] + 1e-3
+
+        # Center surface height
+        dh_i = h_3 - h_avg[i3, None]
+
+        # Compute along and across-track slope (zero if not enough obs)
+        ok = np.sum(~np.isnan(dh_i), axis=1) > 2
+        s_xy = []
+        for s_d in (s_dx, s_dy):
+            p = np.zeros(len(dh_i))
+            if np.any(ok):
+                A = np.stack((np.ones_like(s_d[ok]), s_d[ok]), axis=2)
+                p[ok] = rlm_batch(A, dh_i[ok], maxiter=5)[:, 1]
+            s_xy.append(np.clip(p, -slp_lim, slp_lim))
+
+        sx[i3], sy[i3] = s_xy
+
+        # Compute the surface height correction
+        h_model[i3] = (h_avg[i3, None] + sx[i3, None] * s_dx +
+                       sy[i3, None] * s_dy)
+
+        # Same surface w.r.t. centroid
+        Cm[i3, 0] = h_avg[i3] + 1e-3 * (sx[i3] + sy[i3])
+        Cm[i3, 1], Cm[i3, 2] = sx[i3], sy[i3]
+
+    # Compute residual
+    dh = np.where(valid, hcap - h_model, np.nan)
+
+    # RMSE of the residuals (NaN if any NaN in cap)
+    RMSE = mad_batch(dh) / np.sqrt(nb)
+    RMSE[np.any(np.isnan(dh) & valid, axis=1)] = np.nan
+
+    return mi, RMSE, h_avg, sx, sy, tref, Cm, xc, yc, dh[valid]
+
+
+def reduce_nodes(caps, RMSE, n_pts):
+    """
+    Select the best node solution (lowest RMSE) for each data point.
+
+    Same result as updating the data points of each cap in node order,
+    only where the new RMSE is lower than the stored one: ties are
+    resolved in favor of the first node in node order.
+
+    Returns the data point and cap of each entry of the concatenated caps,
+    the entries of the best solution for each point (if any), and the
+    entries of the last cap covering each point.
+    """
+    i_sol = np.repeat(np.arange(len(caps)), [len(c) for c in caps])
+    i_data = np.concatenate(caps).astype(int)
+    e_sol = np.where(np.isnan(RMSE), np.inf, RMSE)[i_sol]
+
+    # Lowest RMSE for each data point
+    e_min = np.full(n_pts, np.inf)
+    np.minimum.at(e_min, i_data, e_sol)
+
+    # First node (in node order) w/lowest RMSE for each data point
+    is_min = (e_sol == e_min[i_data]) & (e_sol < 999999)
+    i_first = np.full(n_pts, len(caps))
+    np.minimum.at(i_first, i_data[is_min], i_sol[is_min])
+    (i_best,) = np.where(is_min & (i_sol == i_first[i_data]))
+
+    # Last node (in node order) for each data point
+    i_final = np.full(n_pts, -1)
+    np.maximum.at(i_final, i_data, i_sol)
+    (i_last,) = np.where(i_sol == i_final[i_data])
+
+    return i_data, i_sol, i_best, i_last
+
+
+def lookup_nodes(xg, yg, x, y, e_node, radius, lookup='best'):
+    """
+    Get the grid node used for each data point (-1 if none).
+
+    Only nodes w/a solution within the search radius of the point are
+    used: the one w/lowest RMSE (best) or the nearest one (nearest). Ties
+    are resolved in favor of the first node in node order. Nodes are
+    found from the regular grid (xg, yg), without a search tree.
+    """
+    nx, ny = len(xg), len(yg)
+
+    # Nearest node, and number of neighbour nodes within search radius
+    j0, nj = np.zeros(len(x), dtype=int), 0
+    i0, ni = np.zeros(len(y), dtype=int), 0
+
+    if nx > 1:
+        dxg = xg[1] - xg[0]
+        j0 = np.round((x - xg[0]) / dxg).astype(int)
+        nj = int(np.ceil(radius / dxg))
+
+    if ny > 1:
+        dyg = yg[1] - yg[0]
+        i0 = np.round((y - yg[0]) / dyg).astype(int)
+        ni = int(np.ceil(radius / dyg))
+
+    i_node = np.full(len(x), -1)
+    k_node = np.full(len(x), np.inf)
+
+    for di in range(-ni, ni + 1):
+        for dj in range(-nj, nj + 1):
+
+            i, j = i0 + di, j0 + dj
+
+            inside = (i >= 0) & (i < ny) & (j >= 0) & (j < nx)
+            i, j = np.clip(i, 0, ny - 1), np.clip(j, 0, nx - 1)
+
+            k = i * nx + j
+            d = np.hypot(x - xg[j], y - yg[i])
+            key = e_node[k] if lookup == 'best' else d
+
+            # Update if node w/solution and better (or same, but first)
+            ok = inside & (d <= radius) & (e_node[k] < 999999)
+            ok &= (key < k_node) | ((key == k_node) & (k < i_node))
+
+            i_node[ok] = k[ok]
+            k_node[ok] = key[ok]
+
+    return i_node
+
+
+def sort_tiles(files, fmanifest):
+    """
+    Sort tiles by number of points (tile.py -a manifest), largest first.
+
+    Tiles are given as tile files (*_tile_NNN*) or "file:tile" references.
+    Files without tile number (or not in the manifest) are left last.
+    """
+    with h5py.File(fmanifest, 'r') as fm:
+        n_pts = dict(zip(fm['tile_num'][:], fm['n_pts'][:]))
+
+    def size(fname):
+        fname, tile = split_ref(fname)
+        if tile is None:
+            name = os.path.splitext(os.path.basename(fname))[0].split('_')
+            if 'tile' not in name: return -1
+            tile = int(name[name.index('tile') + 1])
+        return n_pts.get(tile, -1)
+
+    return sorted(files, key=size, reverse=True)
+
+
+def save_vars(ifile, variables):
+    """ Append (or update) variables in file. """
+    with h5py.File(ifile, 'a') as fi:
+        for k, v in variables:
+            if k in fi:
+                fi[k][:] = v
+            else:
+                fi[k] = v
+
+
+def save_output(ifile, variables, tile_data=None):
+    """
+    Save new variables to file and rename it (_TOPO).
+
+    For "file:tile" references, tile_data=(data, own) from read_tile, and
+    the tile rows (no buffer) are saved with all variables to a new file.
+    """
+    if tile_data is None:
+        save_vars(ifile, variables)
+        os.rename(ifile, ifile.replace('.h5', '_TOPO.h5'))
+        return
+
+    data, own = tile_data
+    data = dict(list(data.items()) + list(variables))
+
+    with h5py.File(tile_name(ifile).replace('.h5', '_TOPO.h5'), 'w') as fo:
+        for k, v in data.items():
+            fo[k] = v[own]
+
+
+def apply_grid(ifile, fgrid, x, y, height, lookup='best', tile_data=None):
+    """
+    Remove topography with a previously saved coefficient grid (_TOPOGRD).
+
+    The surface model of one node (see lookup_nodes) is evaluated at each
+    data point, and the residuals and node parameters are saved as in
+    main(). No search tree or fitting is needed.
+    """
+    print(('applying coefficient grid:', fgrid))
+
+    with h5py.File(fgrid, 'r') as fg:
+
+        # Grid nodes and node solutions (flattened)
+        xg, yg = fg['x'][0, :], fg['y'][:, 0]
+        radius = fg.attrs['radius']
+        sol = dict((k, fg[k][:].ravel()) for k in GRDVARS)
+
+    i_node = lookup_nodes(xg, yg, x, y, sol['e_res'], radius, lookup)
+
+    (i_pts,) = np.where(i_node >= 0)
+    i_node = i_node[i_pts]
+
+    # Evaluate surface of each node w.r.t. its centroid
+    dxc = x[i_pts] - sol['x_c'][i_node]
+    dyc = y[i_pts] - sol['y_c'][i_node]
+
+    h_model = (sol['c_0'][i_node] + sol['c_1'][i_node] * dxc +
+               sol['c_2'][i_node] * dyc + sol['c_3'][i_node] * dxc * dyc +
+               sol['c_4'][i_node] * dxc * dxc + sol['c_5'][i_node] * dyc * dyc)
+
+    # Output containers (same as fitted solution)
+    dh_topo = np.full(height.shape, np.nan)
+    dh_topo[i_pts] = height[i_pts] - h_model
+
+    variables = [('h_res', dh_topo)]
+
+    for k in ['h_mod', 'e_res', 'm_deg', 't_ref', 'slp_x', 'slp_y']:
+        v = np.full(height.shape, 999999. if k == 'e_res' else np.nan)
+        v[i_pts] = sol[k][i_node]
+        variables.append((k, v))
+
+    # Save variables and rename file
+    save_output(ifile, variables, tile_data)
+
+    print(('Total NaNs (percent): %.2f' % \
+            (100 * float(len(dh_topo[np.isnan(dh_topo)])) / float(len(dh_topo)))))
+
+
 # Main function for computing parameters
 def main(ifile, n=''):
     
+    fname, tile = split_ref(ifile)
+
     # Check for empty file
-    if os.stat(ifile).st_size == 0:
+    if os.stat(fname).st_size == 0:
         print('input file is empty!')
         return
     
@@ -358,7 +974,7 @@ def main(ifile, n=''):
     print('loading data ...')
 
     # Determine input file type
-    if not ifile.endswith(('.h5', '.H5', '.hdf', '.hdf5')):
+    if not fname.endswith(('.h5', '.H5', '.hdf', '.hdf5')):
         print("Input file must be in hdf5-format")
         return
     
@@ -366,12 +982,30 @@ def main(ifile, n=''):
     xvar, yvar, tvar, zvar = icol
     
     # Load all 1d variables needed
-    with h5py.File(ifile, 'r') as fi:
+    if tile is None:
+        tile_data = None
 
-        lon = fi[xvar][:]
-        lat = fi[yvar][:]
-        time = fi[tvar][:]
-        height = fi[zvar][:]
+        with h5py.File(ifile, 'r') as fi:
+
+            lon = fi[xvar][:]
+            lat = fi[yvar][:]
+            time = fi[tvar][:]
+            height = fi[zvar][:]
+
+    else:
+        # Tile of indexed file (data + buffer), all variables
+        data, own, _, _ = read_tile(ifile)
+        tile_data = (data, own)
+
+        # Tile not in index (e.g. split tile of adaptive index)
+        if not data:
+            print(('SKIP FILE: TILE NOT IN INDEX:', ifile))
+            return
+
+        lon = data[xvar]
+        lat = data[yvar]
+        time = data[tvar]
+        height = data[zvar]
 
     # EPSG number for lon/lat proj
     projGeo = '4326'
@@ -390,6 +1024,12 @@ def main(ifile, n=''):
     # Apply transformation to time
     if expr: time = eval(expr.replace('t', 'time'))
 
+    # Remove topography with a previously saved coefficient grid (no fitting)
+    if fgrid:
+        apply_grid(ifile, fgrid, x, y, height, lookup, tile_data)
+        print(('Execution time: '+ str(datetime.now()-startTime)))
+        return
+
     # Overall (fixed) mean time
     t_mean = np.round(np.nanmean(time), 2)
 
@@ -409,206 +1049,279 @@ def main(ifile, n=''):
 
     # Create output containers
     dh_topo = np.full(height.shape, np.nan)
-    de_topo = np.full(height.shape, 999999)
+    de_topo = np.full(height.shape, 999999.)
     mi_topo = np.full(height.shape, np.nan)
     hm_topo = np.full(height.shape, np.nan)
     sx_topo = np.full(height.shape, np.nan)
     sy_topo = np.full(height.shape, np.nan)
     tr_topo = np.full(height.shape, np.nan)
+
+    # Create container for node solutions (see GRDVARS)
+    node_sol = np.full((len(GRDVARS), len(xi)), np.nan)
     
     # Set slope limit
     slp_lim = np.tan(np.deg2rad(slplim))
     
     # Enter prediction loop
     print('predicting values ...')
-    for i in range(len(xi)):
+    if engine == 'vec':
 
-        x0, y0 = xi[i], yi[i]
+        # Caps and solutions of all nodes w/enough data
+        nodes, caps, sols = [], [], []
 
-        # Get indexes of data within search radius or cell bbox
-        idx = get_radius_idx(
-                x, y, x0, y0, dmax, Tree, n_reloc=nreloc,
-                min_months=18, max_reloc=3, time=None, height=None)
+        for i in range(0, len(xi), chunk):
 
-        # Length of data in search cap
-        nobs = len(x[idx])
-            
-        # Check data density
-        if (nobs < nlim): continue
-
-        # Parameters for model-solution
-        xcap = x[idx]
-        ycap = y[idx]
-        tcap = time[idx]
-        hcap = height[idx]
-
-        # Copy original height vector
-        h_org = hcap.copy()
-
-        # Centroid node
-        xc = np.median(xcap)
-        yc = np.median(ycap)
-
-        # If reference time not given, use fixed or variable mean
-        if tref_ == 'fixed':
-            tref = t_mean
-        elif tref_ == 'variable':
-            tref = np.nanmean(tcap)
-        else:
-            tref = np.float(tref_)
+            print(('Solving nodes', i, '-', min(i + chunk, len(xi)),
+                   'of', len(xi), '...'))
+
+            # Get indexes of data within search radius of each node
+            k_nodes = np.arange(i, min(i + chunk, len(xi)))
+            idxs = get_radius_idx_batch(
+                    x, y, xi[k_nodes], yi[k_nodes], dmax, Tree, n_reloc=nreloc)[0]
 
-        # Design matrix elements
-        c0 = np.ones(len(xcap))
-        c1 = xcap - xc
-        c2 = ycap - yc
-        c3 = c1 * c2
-        c4 = c1 * c1
-        c5 = c2 * c2
-        c6 = tcap - tref
+            # Check data density
+            nodes_i, caps_i = [], []
+            for k, idx in zip(k_nodes, idxs):
+                if len(idx) >= nlim:
+                    nodes_i.append(k)
+                    caps_i.append(idx)
 
-        # Length before editing
-        nb = len(hcap)
+            if len(caps_i) == 0: continue
 
-        # Determine model order
-        if order == 2 and nb >= mlim * 2:
+            nodes.extend(nodes_i)
+            caps.extend(caps_i)
+            sols.append(fit_batch(x, y, time, height, caps_i, t_mean, tref_,
+                                  order, mlim, niter, slp_lim))
 
-            # Biquadratic surface and linear trend
-            Acap = np.vstack((c0, c1, c2, c3, c4, c5, c6)).T
+        if len(caps) > 0:
 
-            # Model identifier
-            mi = 1
+            # Stack the solutions of all batches
+            mi, RMSE, h_avg, sx, sy, tref, Cm, xc, yc, dh = \
+                    [np.concatenate([s[j] for s in sols]) for j in range(10)]
 
-        # Set model order
-        elif nb >= mlim:
+            # Keep the best solution for each data point
+            i_data, i_sol, i_best, i_last = reduce_nodes(caps, RMSE, len(x))
 
-            # Bilinear surface and linear trend
-            Acap = np.vstack((c0, c1, c2, c6)).T
+            i_pts, i_cap = i_data[i_best], i_sol[i_best]
+
+            dh_topo[i_pts] = dh[i_best]
+            de_topo[i_pts] = RMSE[i_cap]
+            hm_topo[i_pts] = h_avg[i_cap]
+            mi_topo[i_pts] = mi[i_cap]
+            tr_topo[i_pts] = tref[i_cap]
+
+            # Slopes are from the last node covering each data point
+            i_pts, i_cap = i_data[i_last], i_sol[i_last]
+
+            sx_topo[i_pts] = np.arctan(sx[i_cap]) * (180 / np.pi)
+            sy_topo[i_pts] = np.arctan(sy[i_cap]) * (180 / np.pi)
+
+            # Node solutions
+            node_sol[:, nodes] = np.vstack((xc, yc, Cm.T, h_avg, RMSE, mi,
+                    tref, np.arctan([sx, sy]) * (180 / np.pi)))
+
+    else:
+
+        for i in range(len(xi)):
+
+            x0, y0 = xi[i], yi[i]
+
+            # Get indexes of data within search radius or cell bbox
+            idx = get_radius_idx(
+                    x, y, x0, y0, dmax, Tree, n_reloc=nreloc,
+                    min_months=18, max_reloc=3, time=None, height=None)
+
+            # Length of data in search cap
+            nobs = len(x[idx])
+            
+            # Check data density
+            if (nobs < nlim): continue
+
+            # Parameters for model-solution
+            xcap = x[idx]
+            ycap = y[idx]
+            tcap = time[idx]
+            hcap = height[idx]
+
+            # Copy original height vector
+            h_org = hcap.copy()
+
+            # Centroid node
+            xc = np.median(xcap)
+            yc = np.median(ycap)
+
+            # If reference time not given, use fixed or variable mean
+            if tref_ == 'fixed':
+                tref = t_mean
+            elif tref_ == 'variable':
+                tref = np.nanmean(tcap)
+            else:
+                tref = np.float(tref_)
+
+            # Design matrix elements
+            c0 = np.ones(len(xcap))
+            c1 = xcap - xc
+            c2 = ycap - yc
+            c3 = c1 * c2
+            c4 = c1 * c1
+            c5 = c2 * c2
+            c6 = tcap - tref
+
+            # Length before editing
+            nb = len(hcap)
+
+            # Determine model order
+            if order == 2 and nb >= mlim * 2:
+
+                # Biquadratic surface and linear trend
+                Acap = np.vstack((c0, c1, c2, c3, c4, c5, c6)).T
+
+                # Model identifier
+                mi = 1
+
+            # Set model order
+            elif nb >= mlim:
+
+                # Bilinear surface and linear trend
+                Acap = np.vstack((c0, c1, c2, c6)).T
             
-            # Model identifier
-            mi = 2
+                # Model identifier
+                mi = 2
 
-        else:
+            else:
 
-            # Model identifier
-            mi = 3
+                # Model identifier
+                mi = 3
         
-        # Modelled topography
-        if mi == 1:
+            # Modelled topography
+            if mi == 1:
             
-            # Construct model object
-            linear_model = sm.RLM(hcap, Acap, M=sm.robust.norms.HuberT(), missing='drop')
+                # Construct model object
+                linear_model = sm.RLM(hcap, Acap, M=sm.robust.norms.HuberT(), missing='drop')
 
-            # Fit the model to the data,
-            linear_model_fit = linear_model.fit(maxiter=niter, tol=0.001)
+                # Fit the model to the data,
+                linear_model_fit = linear_model.fit(maxiter=niter, tol=0.001)
            
-            # Coefficients
-            Cm = linear_model_fit.params
+                # Coefficients
+                Cm = linear_model_fit.params
 
-            # Biquadratic surface
-            h_model = np.dot(np.vstack((c0, c1, c2, c3, c4, c5)).T, Cm[[0, 1, 2, 3, 4, 5]])
+                # Biquadratic surface
+                h_model = np.dot(np.vstack((c0, c1, c2, c3, c4, c5)).T, Cm[[0, 1, 2, 3, 4, 5]])
 
-            # Compute along and across track slope
-            sx = np.sign(Cm[1]) * slp_lim if np.abs(Cm[1]) > slp_lim else Cm[1]
-            sy = np.sign(Cm[2]) * slp_lim if np.abs(Cm[2]) > slp_lim else Cm[2]
+                # Compute along and across track slope
+                sx = np.sign(Cm[1]) * slp_lim if np.abs(Cm[1]) > slp_lim else Cm[1]
+                sy = np.sign(Cm[2]) * slp_lim if np.abs(Cm[2]) > slp_lim else Cm[2]
 
-            # Mean height
-            h_avg = Cm[0]
+                # Mean height
+                h_avg = Cm[0]
         
-        elif mi == 2:
+            elif mi == 2:
             
-            # Construct model object
-            linear_model = sm.RLM(hcap, Acap, M=sm.robust.norms.HuberT(), missing='drop')
+                # Construct model object
+                linear_model = sm.RLM(hcap, Acap, M=sm.robust.norms.HuberT(), missing='drop')
 
-            # Fit the model to the data,
-            linear_model_fit = linear_model.fit(maxiter=niter, tol=0.001)
+                # Fit the model to the data,
+                linear_model_fit = linear_model.fit(maxiter=niter, tol=0.001)
            
-            # Coefficients
-            Cm = linear_model_fit.params
+                # Coefficients
+                Cm = linear_model_fit.params
             
-            # Bilinear surface
-            h_model = np.dot(np.vstack((c0, c1, c2)).T, Cm[[0, 1, 2]])
+                # Bilinear surface
+                h_model = np.dot(np.vstack((c0, c1, c2)).T, Cm[[0, 1, 2]])
 
-            # Compute along and across track slope
-            sx = np.sign(Cm[1]) * slp_lim if np.abs(Cm[1]) > slp_lim else Cm[1]
-            sy = np.sign(Cm[2]) * slp_lim if np.abs(Cm[2]) > slp_lim else Cm[2]
+                # Compute along and across track slope
+                sx = np.sign(Cm[1]) * slp_lim if np.abs(Cm[1]) > slp_lim else Cm[1]
+                sy = np.sign(Cm[2]) * slp_lim if np.abs(Cm[2]) > slp_lim else Cm[2]
 
-            # Mean height
-            h_avg = Cm[0]
+                # Mean height
+                h_avg = Cm[0]
     
-        else:
+            else:
                         
-            # Mean surface from median
-            h_avg = np.median(hcap)
+                # Mean surface from median
+                h_avg = np.median(hcap)
 
-            # Compute distance estimates from centroid
-            s_dx = (xcap - xc) + 1e-3
-            s_dy = (ycap - yc) + 1e-3
+                # Compute distance estimates from centroid
+                s_dx = (xcap - xc) + 1e-3
+                s_dy = (ycap - yc) + 1e-3
 
-            # Center surface height
-            dh_i = h_org - h_avg
+                # Center surface height
+                dh_i = h_org - h_avg
         
-            # Compute along-track slope
-            px, rms_x = rlsq(s_dx, dh_i, 1)
-            py, rms_x = rlsq(s_dy, dh_i, 1)
+                # Compute along-track slope
+                px, rms_x = rlsq(s_dx, dh_i, 1)
+                py, rms_x = rlsq(s_dy, dh_i, 1)
 
-            # Set along-track slope
-            s_x = 0 if np.isnan(px[0]) else px[0]
+                # Set along-track slope
+                s_x = 0 if np.isnan(px[0]) else px[0]
                 
-            # Set across-track slope to zero
-            s_y = 0 if np.isnan(py[0]) else py[0]
+                # Set across-track slope to zero
+                s_y = 0 if np.isnan(py[0]) else py[0]
             
-            # Compute along and across track slope
-            sx = np.sign(s_x) * slp_lim if np.abs(s_x) > slp_lim else s_x
-            sy = np.sign(s_y) * slp_lim if np.abs(s_y) > slp_lim else s_y
+                # Compute along and across track slope
+                sx = np.sign(s_x) * slp_lim if np.abs(s_x) > slp_lim else s_x
+                sy = np.sign(s_y) * slp_lim if np.abs(s_y) > slp_lim else s_y
             
-            # Compute the surface height correction
-            h_model = h_avg + (sx * s_dx) + (sy * s_dy)
+                # Compute the surface height correction
+                h_model = h_avg + (sx * s_dx) + (sy * s_dy)
 
-        # Compute full slope
-        slope = np.arctan(np.sqrt(sx**2 + sy**2)) * (180 / np.pi)
+            # Compute full slope
+            slope = np.arctan(np.sqrt(sx**2 + sy**2)) * (180 / np.pi)
 
-        # Compute residual
-        dh = h_org - h_model
+            # Compute residual
+            dh = h_org - h_model
 
-        # Number of observations
-        na = len(dh)
+            # Number of observations
+            na = len(dh)
 
-        # RMSE of the residuals
-        RMSE = mad(dh) / np.sqrt(na)
+            # RMSE of the residuals
+            RMSE = mad(dh) / np.sqrt(na)
 
-        # Overwrite errors
-        iup = RMSE < de_topo[idx]
+            # Overwrite errors
+            iup = RMSE < de_topo[idx]
 
-        # Create temporary variables
-        dh_cap = dh_topo[idx].copy()
-        de_cap = de_topo[idx].copy()
-        hm_cap = hm_topo[idx].copy()
-        mi_cap = mi_topo[idx].copy()
-        tr_cap = tr_topo[idx].copy()
+            # Create temporary variables
+            dh_cap = dh_topo[idx].copy()
+            de_cap = de_topo[idx].copy()
+            hm_cap = hm_topo[idx].copy()
+            mi_cap = mi_topo[idx].copy()
+            tr_cap = tr_topo[idx].copy()
 
-        # Update variables
-        dh_cap[iup] = dh[iup]
-        de_cap[iup] = RMSE
-        hm_cap[iup] = h_avg 
-        mi_cap[iup] = mi
-        tr_cap[iup] = tref
+            # Update variables
+            dh_cap[iup] = dh[iup]
+            de_cap[iup] = RMSE
+            hm_cap[iup] = h_avg 
+            mi_cap[iup] = mi
+            tr_cap[iup] = tref
         
-        # Update with current solution
-        dh_topo[idx] = dh_cap
-        de_topo[idx] = de_cap
-        hm_topo[idx] = hm_cap
-        mi_topo[idx] = mi_cap
-        tr_topo[idx] = tr_cap
-        sx_topo[idx] = np.arctan(sx) * (180 / np.pi)
-        sy_topo[idx] = np.arctan(sy) * (180 / np.pi)
-
-        # Print progress (every N iterations)
-        if (i % 100) == 0:
-
-            # Print message every i:th solution
-            print(('%s %i %s %2i %s %i %s %03d %s %.3f %s %.3f' % \
-                    ('#',i,'/',len(xi),'Model:',mi,'Nobs:',nb,'Slope:',\
-                    np.around(slope,3),'Residual:',np.around(mad_std(dh),3))))
+            # Update with current solution
+            dh_topo[idx] = dh_cap
+            de_topo[idx] = de_cap
+            hm_topo[idx] = hm_cap
+            mi_topo[idx] = mi_cap
+            tr_topo[idx] = tr_cap
+            sx_topo[idx] = np.arctan(sx) * (180 / np.pi)
+            sy_topo[idx] = np.arctan(sy) * (180 / np.pi)
+
+            # Surface coefficients w.r.t. centroid
+            if mi == 1:
+                cm = Cm[:6]
+            elif mi == 2:
+                cm = np.r_[Cm[:3], 0, 0, 0]
+            else:
+                cm = np.r_[h_avg + 1e-3 * (sx + sy), sx, sy, 0, 0, 0]
+
+            # Node solution
+            node_sol[:, i] = np.r_[xc, yc, cm, h_avg, RMSE, mi, tref,
+                    np.arctan([sx, sy]) * (180 / np.pi)]
+
+            # Print progress (every N iterations)
+            if (i % 100) == 0:
+
+                # Print message every i:th solution
+                print(('%s %i %s %2i %s %i %s %03d %s %.3f %s %.3f' % \
+                        ('#',i,'/',len(xi),'Model:',mi,'Nobs:',nb,'Slope:',\
+                        np.around(slope,3),'Residual:',np.around(mad_std(dh),3))))
 
     # Print percentage of not filled
     print(('Total NaNs (percent): %.2f' % \
@@ -623,34 +1336,22 @@ def main(ifile, n=''):
     print(('Model types (percent): 1 = %.2f, 2 = %.2f, 3 = %.2f' % \
             (100 * one/N, 100 * two/N, 100 * tre/N)))
 
-    # Append new columns to original file
-    with h5py.File(ifile, 'a') as fi:
+    # Save node solutions to coefficient grid
+    with h5py.File(tile_name(ifile).replace('.h5', '_TOPOGRD.h5'), 'w') as fo:
 
-        # Check if we have variables in file
-        try:
-            
-            # Save variables
-            fi['h_res'] = dh_topo
-            fi['h_mod'] = hm_topo
-            fi['e_res'] = de_topo
-            fi['m_deg'] = mi_topo
-            fi['t_ref'] = tr_topo
-            fi['slp_x'] = sx_topo
-            fi['slp_y'] = sy_topo
-
-        except:
-            
-            # Update variables
-            fi['h_res'][:] = dh_topo
-            fi['h_mod'][:] = hm_topo
-            fi['e_res'][:] = de_topo
-            fi['m_deg'][:] = mi_topo
-            fi['t_ref'][:] = tr_topo
-            fi['slp_x'][:] = sx_topo
-            fi['slp_y'][:] = sy_topo
+        fo['x'] = Xi
+        fo['y'] = Yi
+
+        for k, v in zip(GRDVARS, node_sol):
+            fo[k] = v.reshape(Xi.shape)
 
-    # Rename file
-    os.rename(ifile, ifile.replace('.h5', '_TOPO.h5'))
+        fo.attrs['radius'] = dmax
+
+    # Append (or update) new columns to original file and rename it
+    save_output(ifile, [('h_res', dh_topo), ('h_mod', hm_topo),
+                        ('e_res', de_topo), ('m_deg', mi_topo),
+                        ('t_ref', tr_topo), ('slp_x', sx_topo),
+                        ('slp_y', sy_topo)], tile_data)
 
     # Print some statistics
     print(('*' * 75))
@@ -667,6 +1368,9 @@ def main(ifile, n=''):
     # Print execution time of algorithm
     print(('Execution time: '+ str(datetime.now()-startTime)))
 
+# Largest tiles first (load balancing)
+if fmanifest: files = sort_tiles(files, fmanifest)
+
 if njobs == 1:
     print('running sequential code ...')
     [main(f, n) for n,f in enumerate(files)]
@@ -0,0 +1,457 @@
+#!/usr/bin/env python
+"""
+Leave-one-out cross-validation of interpolation parameters
+
+Evaluates the held-out prediction error of the gaussian (interpgaus.py) and
+kriging/collocation (interpkrig.py) interpolators on a random sample of
+observation locations, for all combinations of a list of parameters
+(nobs, alpha and rms noise), in a single run.
+
+The nearest neighbors of the sampled locations are found once (for the
+largest nobs) and reused for all parameter combinations. The sector
+selection (four quadrants for gaus, eight sectors for krig) is done from
+the distance-sorted neighbor matrix, for all sampled locations at once.
+
+For kriging, the closed-form leave-one-out residuals (Dubrule, 1983)
+
+    r_j = [K^-1 (z - m0)]_j / [K^-1]_jj
+
+are obtained for all observations in each local neighborhood from one
+inversion of the covariance matrix K = Cxx + N. The standardized residuals
+r_j * sqrt([K^-1]_jj) should have unit std if the covariance model and the
+noise level are consistent with the data.
+
+Output consists of a text file with a score table (one line per parameter
+combination): nobs, alpha (km), rms noise, number of residuals, rmse, mad,
+bias and the std of the standardized residuals (krig only).
+
+Notes:
+    The parameters are the same as in the interpolators (-n, -a, -e) but
+    take a list of values. The rms noise (-e) is only used by krig.
+
+    For krig the residuals of all observations in the local neighborhood
+    (not only the sampled location) are used in the scores. The local
+    median (m0) is computed from the neighbors of the sampled location.
+
+Example:
+
+    python interpcv.py ifile.h5 scores.txt -t krig -n 10 25 -a 10 25 50 \
+        -e 0 0.1 -r 50 -p 3031 -s 500 -v lon lat dhdt rmse
+
+Credits:
+    captoolkit - JPL Cryosphere Altimetry Processing Toolkit
+
+    Johan Nilsson (johan.nilsson@jpl.nasa.gov)
+    Fernando Paolo (paolofer@jpl.nasa.gov)
+    Alex Gardner (alex.s.gardner@jpl.nasa.gov)
+
+    Jet Propulsion Laboratory, California Institute of Technology
+
+"""
+
+import h5py
+import pyproj
+import argparse
+import itertools
+import numpy as np
+from scipy import stats
+from scipy.spatial import cKDTree
+
+
+def transform_coord(proj1, proj2, x, y):
+    """Transform coordinates from proj1 to proj2 (EPSG num)."""
+
+    # Set full EPSG projection strings
+    proj1 = pyproj.Proj("+init=EPSG:" + proj1)
+    proj2 = pyproj.Proj("+init=EPSG:" + proj2)
+
+    # Convert coordinates
+    return pyproj.transform(proj1, proj2, x, y)
+
+
+def spatial_filter(x, y, z, dx, dy, sigma=5.0):
+    """ Cleaning of spatial data """
+
+    # Grid dimensions
+    Nn = int((np.abs(y.max() - y.min())) / dy) + 1
+    Ne = int((np.abs(x.max() - x.min())) / dx) + 1
+
+    # Bin data
+    f_bin = stats.binned_statistic_2d(x, y, z, bins=(Ne, Nn))
+
+    # Get bin numbers for the data
+    index = f_bin.binnumber
+
+    # Unique indexes
+    ind = np.unique(index)
+
+    # Create output
+    zo = z.copy()
+
+    # Number of unique index
+    for i in range(len(ind)):
+
+        # index for each bin
+        idx, = np.where(index == ind[i])
+
+        # Get data
+        zb = z[idx]
+
+        # Make sure we have enough
+        if len(zb[~np.isnan(zb)]) == 0:
+            continue
+
+        # Set to median of values
+        dh = zb - np.nanmedian(zb)
+
+        # Identify outliers
+        foo = np.abs(dh) > sigma * np.nanstd(dh)
+
+        # Set to nan-value
+        zb[foo] = np.nan
+
+        # Replace data
+        zo[idx] = zb
+
+    # Return filtered array
+    return zo
+
+
+def sector_select(dx, dy, valid, nobs, nsec):
+    """Select the 'nobs' closest neighbors in each of 'nsec' sectors.
+
+    dx, dy and valid are (n_points, k) arrays with the offsets to the
+    neighbors sorted by distance (as returned by cKDTree.query).
+    """
+
+    # Compute angle to data points
+    theta = (180.0 / np.pi) * np.arctan2(dy, dx) + 180
+
+    # Sector number of each neighbor
+    sec = np.minimum((theta / (360.0 / nsec)).astype(int), nsec - 1)
+
+    # One-hot sector membership of valid neighbors
+    onehot = (sec[:, :, None] == np.arange(nsec)) & valid[:, :, None]
+
+    # Rank of each neighbor within its sector (neighbors sorted by distance)
+    rank = np.take_along_axis(np.cumsum(onehot, axis=1),
+                              sec[:, :, None], axis=2)[:, :, 0] - 1
+
+    return valid & (rank < nobs)
+
+
+def gauss_markov(d, c0, a):
+    """Third-order Gauss-Markov covariance model."""
+
+    return c0 * (1 + (d / a) - 0.5 * (d / a) ** 2) * np.exp(-d / a)
+
+
+def cv_gaus(z0, z, s, d, sel, alpha):
+    """Leave-one-out residuals for the gaussian weighted average."""
+
+    # Compute the weighting factor
+    w = (1. / s ** 2) * np.exp(-(d ** 2) / (2 * alpha ** 2))
+
+    # Add something small to avoid division by zero
+    w = np.where(sel, w + 1e-6, 0)
+
+    # Predicted value
+    zi = np.sum(w * z, axis=1) / np.sum(w, axis=1)
+
+    return z0 - zi, np.full(len(zi), np.nan)
+
+
+def cv_krig(x, y, z, c, valid, c0, alpha, crms, err, chunk=100):
+    """Closed-form leave-one-out residuals for kriging/collocation.
+
+    x, y, z and c (noise var) are (n_points, m) arrays with the local
+    neighborhoods (first column is the sampled location), valid marks
+    the entries used (padding is excluded).
+    """
+
+    # Markov-model parameter
+    a = 0.9132 * alpha
+
+    # Noise handling (as in interpkrig)
+    if err:
+        c = np.maximum(c, crms)
+    else:
+        c = np.full(c.shape, crms)
+
+    # Output residuals and standardized residuals
+    res = np.full(z.shape, np.nan)
+    std = np.full(z.shape, np.nan)
+
+    # Loop through chunks of neighborhoods
+    for k in range(0, len(z), chunk):
+
+        # Chunk of neighborhoods
+        xc, yc, zc = x[k:k + chunk], y[k:k + chunk], z[k:k + chunk]
+        cc, vc = c[k:k + chunk], valid[k:k + chunk]
+
+        # Local median (robust) from the neighbors of sampled location
+        m0 = np.nanmedian(np.where(vc[:, 1:], zc[:, 1:], np.nan), axis=1)
+
+        # Compute pair-wise distances
+        Dxx = np.hypot(xc[:, :, None] - xc[:, None, :],
+                       yc[:, :, None] - yc[:, None, :])
+
+        # Covariance matrix plus measurement noise
+        K = gauss_markov(Dxx, c0, a)
+        K[:, np.arange(K.shape[1]), np.arange(K.shape[1])] += cc
+
+        # Uncouple padded entries (identity rows/columns)
+        pair = vc[:, :, None] & vc[:, None, :]
+        K = np.where(pair, K, 0)
+        K[:, np.arange(K.shape[1]), np.arange(K.shape[1])] = np.where(
+            vc, np.diagonal(K, axis1=1, axis2=2), 1)
+
+        # Centered data (zero for padding)
+        zm = np.where(vc, zc - m0[:, None], 0)
+
+        # One inversion per neighborhood
+        Ki = np.linalg.inv(K)
+
+        # Diagonal of the inverse
+        kii = np.diagonal(Ki, axis1=1, axis2=2)
+
+        # Closed-form leave-one-out residuals
+        r = np.einsum('ijk,ik->ij', Ki, zm) / kii
+
+        # Keep valid entries
+        res[k:k + chunk] = np.where(vc, r, np.nan)
+        std[k:k + chunk] = np.where(vc, r * np.sqrt(kii), np.nan)
+
+    return res, std
+
+
+# Description of algorithm
+des = 'Leave-one-out cross-validation of interpolation parameters'
+
+# Define command-line arguments
+parser = argparse.ArgumentParser(description=des)
+
+parser.add_argument(
+    'ifile', metavar='ifile', type=str, nargs='+',
+    help='name of input file (h5-format)')
+
+parser.add_argument(
+    'ofile', metavar='ofile', type=str, nargs='+',
+    help='name of ouput file with score table (txt-format)')
+
+parser.add_argument(
+    '-t', metavar=None, dest='method', type=str, nargs=1,
+    help=('interpolation method: gaussian (gaus) or kriging (krig)'),
+    choices=('gaus', 'krig'), default=['krig'], )
+
+parser.add_argument(
+    '-n', metavar='nobs', dest='nobs', type=int, nargs='+',
+    help=('number(s) of obs. for each quadrant'),
+    default=[None], )
+
+parser.add_argument(
+    '-a', metavar='alpha', dest='alpha', type=float, nargs='+',
+    help=('correlation length(s) (km)'),
+    default=[None], )
+
+parser.add_argument(
+    '-e', metavar='sigma', dest='sigma', type=float, nargs='+',
+    help=('constant rms noise value(s), krig only'),
+    default=[0], )
+
+parser.add_argument(
+    '-r', metavar='radius', dest='radius', type=float, nargs=1,
+    help=('cut off distance cutoff in (km)'),
+    default=[None], )
+
+parser.add_argument(
+    '-s', metavar='nsamp', dest='nsamp', type=int, nargs=1,
+    help=('number of sampled observation locations'),
+    default=[500], )
+
+parser.add_argument(
+    '-p', metavar=('epsg_num'), dest='proj', type=str, nargs=1,
+    help=('EPSG proj number (AnIS=3031, GrIS=3413)'),
+    default=['3031'], )
+
+parser.add_argument(
+    '-c', metavar=('dim', 'thres'), dest='filter', type=float, nargs=2,
+    help=('dim. of filter in km and sigma thres'),
+    default=[0, 0], )
+
+parser.add_argument(
+    '-v', metavar=('x', 'y', 'z', 's'), dest='vnames', type=str, nargs=4,
+    help=('name of varibales in the HDF5-file'),
+    default=['lon', 'lat', 'h_cor', 'h_rms'], )
+
+parser.add_argument(
+    '-x', metavar='seed', dest='seed', type=int, nargs=1,
+    help=('seed for random sampling'),
+    default=[None], )
+
+# Parser argument to variable
+args = parser.parse_args()
+
+# Read input from terminal
+ifile = args.ifile[0]
+ofile = args.ofile[0]
+method = args.method[0]
+nobs_list = args.nobs[:]
+alpha_list = [a * 1e3 for a in args.alpha]
+sigma_list = args.sigma[:] if method == 'krig' else [0]
+dmax = args.radius[0] * 1e3
+nsamp = args.nsamp[0]
+proj = args.proj[0]
+dxy = args.filter[0] * 1e3
+thres = args.filter[1]
+seed = args.seed[0]
+vicol = args.vnames[:]
+
+# Print parameters to screen
+print('parameters:')
+for p in list(vars(args).items()): print(p)
+
+# Set seed for reproducibility
+np.random.seed(seed)
+
+# Get variable names
+xvar, yvar, zvar, svar = vicol
+
+print('reading data ...')
+
+# Load all 1d variables needed
+with h5py.File(ifile, 'r') as fi:
+
+    # Get variables
+    lon = fi[xvar][:]
+    lat = fi[yvar][:]
+    zp = fi[zvar][:]
+    sp = fi[svar][:] if svar in fi else np.ones(lon.shape)
+
+    # Remove data with NaN's
+    lon, lat, zp, sp = lon[~np.isnan(zp)], lat[~np.isnan(zp)], \
+                       zp[~np.isnan(zp)], sp[~np.isnan(zp)]
+
+# Transform coordinates to wanted projection
+xp, yp = transform_coord('4326', proj, lon, lat)
+
+# Check if we should filter
+if dxy != 0:
+
+    print('-> cleaning data ...')
+
+    # Clean the data in the spatial domain
+    zp = spatial_filter(xp.copy(), yp.copy(), zp.copy(), dxy, dxy, sigma=thres)
+
+    # Remove data with NaN's
+    xp, yp, zp, sp = xp[~np.isnan(zp)], yp[~np.isnan(zp)], zp[~np.isnan(zp)], \
+        sp[~np.isnan(zp)]
+
+# Test if a-priori errors were provided
+err = not np.all(sp == 1)
+
+# Signal variance of entire field
+c0 = np.nanvar(zp)
+
+# Number of sectors and search factor (as in the interpolators)
+nsec, nfac = (8, 8) if method == 'krig' else (4, 5)
+
+print("-> creating KDTree ...")
+
+# Construct cKDTree
+TreeP = cKDTree(np.c_[xp, yp])
+
+# Random sample of observation locations
+isamp = np.random.choice(len(xp), min(nsamp, len(xp)), replace=False)
+
+# Find closest observations once (largest nobs, plus the point itself)
+dr, idx = TreeP.query(np.c_[xp[isamp], yp[isamp]],
+                      max(nobs_list) * nfac + 1, workers=-1)
+
+# Valid neighbors (not the left-out point itself, inside the data)
+valid = (idx != isamp[:, None]) & (idx < len(xp))
+
+# Remove missing neighbors from the index
+idx = np.where(idx < len(xp), idx, 0)
+
+# Test if closest point to far away
+near = np.min(np.where(valid, dr, np.inf), axis=1) <= dmax
+
+# Offsets from sampled location to neighbors
+dxn = xp[idx] - xp[isamp][:, None]
+dyn = yp[idx] - yp[isamp][:, None]
+
+# Output score table
+scores = []
+
+print('-> cross-validating', len(list(itertools.product(
+    nobs_list, alpha_list, sigma_list))), 'parameter combinations ...')
+
+# Loop through number of observations
+for nobs in nobs_list:
+
+    # Sector selection (reused for all alpha and sigma)
+    sel = sector_select(dxn, dyn, valid, nobs, nsec) & near[:, None]
+
+    # Sampled locations with data
+    ok = np.any(sel, axis=1)
+
+    if method == 'krig':
+
+        # Move the selected neighbors to the front of each row
+        order = np.argsort(~sel[ok], axis=1, kind='stable')
+        m = np.max(np.sum(sel[ok], axis=1))
+        isel = np.take_along_axis(idx[ok], order, axis=1)[:, :m]
+        vsel = np.take_along_axis(sel[ok], order, axis=1)[:, :m]
+
+        # Local neighborhoods with the sampled location first
+        iloc = np.c_[isamp[ok], isel]
+        vloc = np.c_[np.ones(len(iloc), dtype=bool), vsel]
+
+    # Loop through parameter combinations
+    for alpha, sigma in itertools.product(alpha_list, sigma_list):
+
+        if method == 'krig':
+
+            # Closed-form leave-one-out residuals
+            res, std = cv_krig(xp[iloc], yp[iloc], zp[iloc], sp[iloc] ** 2,
+                               vloc, c0, alpha, sigma * sigma, err)
+
+        else:
+
+            # Leave-one-out residuals of sampled locations
+            res, std = cv_gaus(zp[isamp][ok], zp[idx][ok], sp[idx][ok],
+                               dr[ok], sel[ok], alpha)
+
+        # Valid residuals
+        res = res[np.isfinite(res)]
+        std = std[np.isfinite(std)]
+
+        # Score statistics
+        nres = len(res)
+        rmse = np.sqrt(np.mean(res ** 2)) if nres else np.nan
+        mad = 1.4826 * np.median(np.abs(res - np.median(res))) \
+            if nres else np.nan
+        bias = np.mean(res) if nres else np.nan
+        zstd = np.std(std) if len(std) else np.nan
+
+        scores.append([nobs, alpha * 1e-3, sigma, nres, rmse, mad, bias,
+                       zstd])
+
+        print('nobs: %d alpha: %g sigma: %g n: %d rmse: %.4f mad: %.4f '
+              'bias: %.4f zstd: %.4f' % tuple(scores[-1]))
+
+# Score table
+scores = np.array(scores)
+
+# Best combination
+ibest = np.nanargmin(scores[:, 4])
+
+print('best (min rmse): nobs: %d alpha: %g sigma: %g' %
+      tuple(scores[ibest, :3]))
+
+print('-> saving scores to file...')
+
+# Save score table to file
+np.savetxt(ofile, scores, fmt='%d %g %g %d %.6f %.6f %.6f %.6f',
+           header='nobs alpha sigma nres rmse mad bias zstd')
@@ -23,12 +23,24 @@ Notes:
     If the error/std.dev is provided as input the prediction rmse is the RSS of
     the a-priori error and the variability of the data used for the prediction
     (if no a-priori error provided the array is set to zero before RSS).
+
+    To reduce the number of (highly correlated) along-track observations
+    in each neighborhood, the data can be thinned along track before the
+    neighbor search (-t orbit dim), by averaging (-u mean) or decimating
+    (-u dec) the observations of each orbit/track in segments of length
+    dim. The errors of the averaged observations are propagated.
+
+    Grid nodes without data within the cutoff distance are skipped before
+    the prediction loop. Nodes can also be restricted to a raster mask
+    (--mask file, GeoTIFF or HDF5 with x/y/mask in the grid projection).
  
 Example:
     python interpgaus.py ifile.h5 ofile.h5 -d 10 10 -n 25 -r 50 -a 25 -p 3031\
         -c 50 10 -v lon lat dhdt dummy
     python interpgaus.py ifile.h5 ofile.h5 -d 10 10 -n 25 -r 50 -a 25 -p 3031\
         -c 50 10 -v lon lat dhdt rmse
+    python interpgaus.py ifile.h5 ofile.h5 -d 10 10 -n 25 -r 50 -a 25 -p 3031\
+        -c 50 10 -v lon lat dhdt rmse -t orbit 1 -u mean
  
 Credits:
     captoolkit - JPL Cryosphere Altimetry Processing Toolkit
@@ -115,6 +127,154 @@ def spatial_filter(x, y, z, dx, dy, sigma=5.0):
     return zo
 
 
+def thin_track(orb, dl, x, y, s, *var, mode='mean', ids=()):
+    """Along-track thinning of observations (by orbit/track id).
+
+    Observations are binned along each track (in the order they are
+    stored) into segments of length 'dl', and each segment is replaced
+    by its mean (mode='mean') or its middle observation (mode='dec').
+
+    Returns thinned x, y, sigma and any other variables passed. Labels
+    in 'ids' (e.g. mission id, constant along a track) are always taken
+    from the middle observation and returned last. For the mean, sigma
+    is propagated as sqrt(sum(s**2))/n, unless no a-priori errors are
+    given (all ones). Observations with NaNs are not used.
+    """
+
+    # Use only valid observations
+    i_valid = np.all(np.isfinite(np.vstack((x, y, s) + var)), axis=0)
+
+    # Sort by track keeping the along-track order
+    i_sort = np.flatnonzero(i_valid)[np.argsort(orb[i_valid], kind='stable')]
+
+    # Coordinates and tracks in sorted order
+    xs, ys, ts = x[i_sort], y[i_sort], orb[i_sort]
+
+    # Flag start of new track
+    new = np.r_[True, ts[1:] != ts[:-1]]
+
+    # Along-track distance (reset at the start of each track)
+    step = np.r_[0, np.hypot(np.diff(xs), np.diff(ys))]
+    step[new] = 0
+    dist = np.cumsum(step)
+    dist -= dist[np.flatnonzero(new)][np.cumsum(new) - 1]
+
+    # Segment number along each track
+    seg = np.floor(dist / dl).astype(np.int64)
+
+    # Flag start of new segment and label segments
+    new |= np.r_[True, seg[1:] != seg[:-1]]
+    label = np.cumsum(new) - 1
+
+    # Number of obs. per segment
+    n = np.bincount(label)
+
+    # Middle observation of each segment
+    i_keep = i_sort[np.flatnonzero(new) + n // 2]
+
+    if mode == 'dec':
+
+        # Decimated variables
+        xo, yo, so = x[i_keep], y[i_keep], s[i_keep]
+        var = [v[i_keep] for v in var]
+
+    else:
+
+        # Mean of each segment
+        xo, yo = [np.bincount(label, weights=v[i_sort]) / n for v in (x, y)]
+        var = [np.bincount(label, weights=v[i_sort]) / n for v in var]
+
+        # Error of the mean (keep ones if no a-priori errors)
+        if np.all(s == 1):
+            so = np.ones(len(n))
+        else:
+            so = np.sqrt(np.bincount(label, weights=s[i_sort] ** 2)) / n
+
+    return (xo, yo, so) + tuple(var) + tuple(v[i_keep] for v in ids)
+
+
+def geotiffread(ifile):
+    """ Read Geotiff file """
+
+    from osgeo import gdal, osr
+
+    file = gdal.Open(ifile, gdal.GA_ReadOnly)
+
+    projection = file.GetProjection()
+    src = osr.SpatialReference()
+    src.ImportFromWkt(projection)
+    proj = src.ExportToWkt()
+
+    Nx = file.RasterXSize
+    Ny = file.RasterYSize
+
+    trans = file.GetGeoTransform()
+
+    dx = trans[1]
+    dy = trans[5]
+
+    Xp = np.arange(Nx)
+    Yp = np.arange(Ny)
+
+    (Xp, Yp) = np.meshgrid(Xp, Yp)
+
+    X = trans[0] + (Xp + 0.5) * trans[1] + (Yp + 0.5) * trans[2]
+    Y = trans[3] + (Xp + 0.5) * trans[4] + (Yp + 0.5) * trans[5]
+
+    band = file.GetRasterBand(1)
+
+    Z = band.ReadAsArray()
+
+    dx = np.abs(dx)
+    dy = np.abs(dy)
+
+    return X, Y, Z, dx, dy, proj
+
+
+def read_mask(fmask):
+    """Read raster mask: GeoTIFF or HDF5 grid with 'x', 'y' and 'mask'."""
+
+    if fmask.endswith(('.tif', '.tiff')):
+        X, Y, Z = geotiffread(fmask)[:3]
+        return X[0, :], Y[:, 0], Z
+    else:
+        with h5py.File(fmask, 'r') as f:
+            return f['x'][:], f['y'][:], f['mask'][:]
+
+
+def node_mask(xi, yi, Tree, dmax, fmask=None):
+    """Flag grid nodes with data within dmax and inside (raster) mask.
+
+    Nodes outside the mask extent, or where the mask is zero/NaN, are
+    flagged False. dmax can be a scalar or an array (one per node).
+    """
+
+    # Distance to closest observation for all nodes
+    d = Tree.query(np.c_[xi, yi], k=1, distance_upper_bound=np.max(dmax),
+                   workers=-1)[0]
+
+    # Nodes with data within search radius
+    keep = d <= dmax
+
+    if fmask:
+
+        # Read mask (same projection as grid)
+        xm, ym, zm = read_mask(fmask)
+
+        # Closest mask pixel for each node
+        j = np.round((xi - xm[0]) / (xm[1] - xm[0])).astype(int)
+        i = np.round((yi - ym[0]) / (ym[1] - ym[0])).astype(int)
+
+        # Nodes inside mask extent
+        inside = (i >= 0) & (i < len(ym)) & (j >= 0) & (j < len(xm))
+
+        # Nodes inside mask
+        keep &= inside
+        keep[inside] &= zm[i[inside], j[inside]] > 0
+
+    return keep
+
+
 # Description of algorithm
 des = 'Distance weighted interpolation of scattered data using a gaussian ' \
       'kernel'
@@ -170,6 +330,21 @@ parser.add_argument(
         help=('name of varibales in the HDF5-file'),
         default=['lon','lat','h_cor','h_rms'],)
 
+parser.add_argument(
+        '-t', metavar=('orbit','dim'), dest='thin', type=str, nargs=2,
+        help=('name of orbit/track variable and length (km) for thinning'),
+        default=[None, 0],)
+
+parser.add_argument(
+        '-u', metavar=None, dest='tmode', type=str, nargs=1,
+        help=('along-track thinning: average (mean) or decimate (dec)'),
+        choices=('mean','dec'), default=['mean'],)
+
+parser.add_argument(
+        '--mask', metavar='file', dest='mask', type=str, nargs=1,
+        help=('raster mask (GeoTIFF or HDF5 x/y/mask) to select grid nodes'),
+        default=[None],)
+
 
 # Parser argument to variable
 args = parser.parse_args()
@@ -187,6 +362,10 @@ alpha = args.alpha[0] * 1e3
 vicol = args.vnames[:]
 dxy   = args.filter[0] * 1e3
 thres =  args.filter[1]
+ovar  = args.thin[0]
+dl    = float(args.thin[1]) * 1e3
+tmode = args.tmode[0]
+fmask = args.mask[0]
 
 # Print parameters to screen
 print('parameters:')
@@ -205,10 +384,11 @@ with h5py.File(ifile, 'r') as fi:
     lat = fi[yvar][:]
     zp  = fi[zvar][:]
     sp  = fi[svar][:] if svar in fi else np.ones(lon.shape)
+    op  = fi[ovar][:] if ovar else np.zeros(lon.shape)
 
     # Remove data wiht NaN's
-    lon, lat, zp, sp = lon[~np.isnan(zp)],lat[~np.isnan(zp)],\
-                zp[~np.isnan(zp)], sp[~np.isnan(zp)]
+    lon, lat, zp, sp, op = lon[~np.isnan(zp)],lat[~np.isnan(zp)],\
+                zp[~np.isnan(zp)], sp[~np.isnan(zp)], op[~np.isnan(zp)]
 
 # Transform coordinates to wanted projection
 xp, yp = transform_coord('4326', proj, lon, lat)
@@ -232,11 +412,6 @@ Xi, Yi = make_grid(xmin, xmax, ymin, ymax, dx, dy)
 xi = Xi.ravel()
 yi = Yi.ravel()
 
-print("-> creating KDTree ...")
-
-# Construct cKDTree
-TreeP = cKDTree(np.c_[xp, yp])
-
 # Output vectors
 zi = np.ones(len(xi)) * np.nan
 ei = np.ones(len(xi)) * np.nan
@@ -250,8 +425,28 @@ if dxy != 0:
     # Clean the data in the spatial domain
     zp = spatial_filter(xp.copy(), yp.copy(), zp.copy(), dxy, dxy, sigma=thres)
 
+# Check if we should thin along track
+if ovar:
+
+    print('-> thinning data along track ...')
+
+    # Average or decimate data in along-track segments
+    xp, yp, sp, zp = thin_track(op, dl, xp, yp, sp, zp, mode=tmode)
+
+    print('number of obs. after thinning:', len(zp))
+
+print("-> creating KDTree ...")
+
+# Construct cKDTree
+TreeP = cKDTree(np.c_[xp, yp])
+
+# Nodes with data within search radius and inside mask
+i_nodes = np.flatnonzero(node_mask(xi, yi, TreeP, dmax * 1e3, fmask))
+
+print('number of nodes with data/inside mask:', len(i_nodes), 'of', len(xi))
+
 # Enter prediction loop
-for i in range(len(zi)):
+for i in i_nodes:
 
     # Find closest observations
     (d, idx) = TreeP.query((xi[i],yi[i]), nobs * 5)
@@ -25,12 +25,29 @@ Notes:
     the a-priori error and the variability of the data used for the
     prediction (if no a-priori error provided the array is set to zero
     before RSS).
+
+    The default (vectorized) prediction processes chunks of nodes at once
+    from the matrix of nearest neighbors, and uses the MAD-based std as a
+    robust estimate of the data variability. The original node loop, using
+    the std, can be selected with '-m loop'.
+
+    To reduce the number of (highly correlated) along-track observations
+    in each neighborhood, the data can be thinned along track before the
+    neighbor search (-t orbit dim), by averaging (-u mean) or decimating
+    (-u dec) the observations of each orbit/track in segments of length
+    dim. The errors of the averaged observations are propagated.
+
+    Grid nodes without data within the cutoff distance are skipped before
+    the prediction loop. Nodes can also be restricted to a raster mask
+    (--mask file, GeoTIFF or HDF5 with x/y/mask in the grid projection).
  
 Example:
     python interpmed.py ifile.h5 ofile.h5 -d 10 10 -n 25 -r 50 -a 25 -p 3031\
         -c 50 10 -v lon lat dhdt dummy
     python interpmed.py ifile.h5 ofile.h5 -d 10 10 -n 25 -r 50 -a 25 -p 3031\
         -c 50 10 -v lon lat dhdt rmse
+    python interpmed.py ifile.h5 ofile.h5 -d 10 10 -n 25 -r 50 -p 3031\
+        -c 50 10 -v lon lat dhdt rmse -t orbit 1 -u mean
  
 Credits:
     captoolkit - JPL Cryosphere Altimetry Processing Toolkit
@@ -118,6 +135,233 @@ def spatial_filter(x, y, z, dx, dy, sigma=5.0):
     return zo
 
 
+def thin_track(orb, dl, x, y, s, *var, mode='mean', ids=()):
+    """Along-track thinning of observations (by orbit/track id).
+
+    Observations are binned along each track (in the order they are
+    stored) into segments of length 'dl', and each segment is replaced
+    by its mean (mode='mean') or its middle observation (mode='dec').
+
+    Returns thinned x, y, sigma and any other variables passed. Labels
+    in 'ids' (e.g. mission id, constant along a track) are always taken
+    from the middle observation and returned last. For the mean, sigma
+    is propagated as sqrt(sum(s**2))/n, unless no a-priori errors are
+    given (all ones). Observations with NaNs are not used.
+    """
+
+    # Use only valid observations
+    i_valid = np.all(np.isfinite(np.vstack((x, y, s) + var)), axis=0)
+
+    # Sort by track keeping the along-track order
+    i_sort = np.flatnonzero(i_valid)[np.argsort(orb[i_valid], kind='stable')]
+
+    # Coordinates and tracks in sorted order
+    xs, ys, ts = x[i_sort], y[i_sort], orb[i_sort]
+
+    # Flag start of new track
+    new = np.r_[True, ts[1:] != ts[:-1]]
+
+    # Along-track distance (reset at the start of each track)
+    step = np.r_[0, np.hypot(np.diff(xs), np.diff(ys))]
+    step[new] = 0
+    dist = np.cumsum(step)
+    dist -= dist[np.flatnonzero(new)][np.cumsum(new) - 1]
+
+    # Segment number along each track
+    seg = np.floor(dist / dl).astype(np.int64)
+
+    # Flag start of new segment and label segments
+    new |= np.r_[True, seg[1:] != seg[:-1]]
+    label = np.cumsum(new) - 1
+
+    # Number of obs. per segment
+    n = np.bincount(label)
+
+    # Middle observation of each segment
+    i_keep = i_sort[np.flatnonzero(new) + n // 2]
+
+    if mode == 'dec':
+
+        # Decimated variables
+        xo, yo, so = x[i_keep], y[i_keep], s[i_keep]
+        var = [v[i_keep] for v in var]
+
+    else:
+
+        # Mean of each segment
+        xo, yo = [np.bincount(label, weights=v[i_sort]) / n for v in (x, y)]
+        var = [np.bincount(label, weights=v[i_sort]) / n for v in var]
+
+        # Error of the mean (keep ones if no a-priori errors)
+        if np.all(s == 1):
+            so = np.ones(len(n))
+        else:
+            so = np.sqrt(np.bincount(label, weights=s[i_sort] ** 2)) / n
+
+    return (xo, yo, so) + tuple(var) + tuple(v[i_keep] for v in ids)
+
+
+def sorted_median(z, n):
+    """Median of rows with NaNs sorted last and n valid values per row."""
+
+    # Middle positions of the valid values in each row
+    i1 = np.maximum((n - 1) // 2, 0)[:, None]
+    i2 = np.maximum(n // 2, 0)[:, None]
+
+    # Average of the middle values
+    zm = 0.5 * (np.take_along_axis(z, i1, axis=1) +
+                np.take_along_axis(z, i2, axis=1))[:, 0]
+
+    # No valid values
+    zm[n == 0] = np.nan
+
+    return zm
+
+
+def median_chunk(xc, yc, Tree, xp, yp, zp, sp, nobs, dmax):
+    """Quadrant-limited median for a chunk of nodes (vectorized).
+
+    Returns the median, the robust error (MAD-based std combined with
+    the a-priori error) and the number of obs. used for each node.
+    """
+
+    # Find closest observations for all nodes
+    (d, idx) = Tree.query(np.c_[xc, yc], nobs * 5, workers=-1)
+
+    # Valid neighbors (missing neighbors are flagged with index n)
+    valid = idx < len(xp)
+    idx = np.where(valid, idx, 0)
+
+    # Compute angle to data points
+    theta = (180.0 / np.pi) * np.arctan2(yp[idx] - yc[:, None],
+                                         xp[idx] - xc[:, None]) + 180
+
+    # Quadrant of each neighbor (data on quadrant limits is not used)
+    quad = np.minimum((theta // 90).astype(int), 3)
+    valid &= (theta % 90) != 0
+
+    # Rank of each neighbor within its quadrant (sorted by distance)
+    onehot = (quad[:, :, None] == np.arange(4)) & valid[:, :, None]
+    rank = np.take_along_axis(np.cumsum(onehot, axis=1),
+                              quad[:, :, None], axis=2)[:, :, 0]
+
+    # Select the nobs closest in each quadrant
+    sel = valid & (rank <= nobs)
+
+    # Test if closest point to far away
+    sel &= (d[:, 0] <= dmax)[:, None]
+
+    # Selected data (NaN otherwise)
+    z = np.where(sel, zp[idx], np.nan)
+    s = np.where(sel, sp[idx], np.nan)
+
+    # Number of (valid) obs. in solution
+    ni = np.sum(sel, axis=1).astype('f8')
+    nz = np.sum(~np.isnan(z), axis=1)
+
+    # Predicted value (masked partition with NaNs last)
+    zi = sorted_median(np.sort(z, axis=1), nz)
+
+    # Compute random error (MAD-based std)
+    sigma_r = 1.4826 * sorted_median(np.sort(np.abs(z - zi[:, None]),
+                                             axis=1), nz)
+
+    # Compute systematic error
+    ns = np.sum(~np.isnan(s), axis=1)
+    sigma_s = np.nansum(s, axis=1) / np.maximum(ns, 1)
+    sigma_s[np.all((s == 1) | ~sel, axis=1)] = 0
+
+    # Prediction error at grid node
+    ei = np.sqrt(sigma_r ** 2 + sigma_s ** 2)
+
+    # Nodes without solution
+    ni[ni == 0] = np.nan
+
+    return zi, ei, ni
+
+
+def geotiffread(ifile):
+    """ Read Geotiff file """
+
+    from osgeo import gdal, osr
+
+    file = gdal.Open(ifile, gdal.GA_ReadOnly)
+
+    projection = file.GetProjection()
+    src = osr.SpatialReference()
+    src.ImportFromWkt(projection)
+    proj = src.ExportToWkt()
+
+    Nx = file.RasterXSize
+    Ny = file.RasterYSize
+
+    trans = file.GetGeoTransform()
+
+    dx = trans[1]
+    dy = trans[5]
+
+    Xp = np.arange(Nx)
+    Yp = np.arange(Ny)
+
+    (Xp, Yp) = np.meshgrid(Xp, Yp)
+
+    X = trans[0] + (Xp + 0.5) * trans[1] + (Yp + 0.5) * trans[2]
+    Y = trans[3] + (Xp + 0.5) * trans[4] + (Yp + 0.5) * trans[5]
+
+    band = file.GetRasterBand(1)
+
+    Z = band.ReadAsArray()
+
+    dx = np.abs(dx)
+    dy = np.abs(dy)
+
+    return X, Y, Z, dx, dy, proj
+
+
+def read_mask(fmask):
+    """Read raster mask: GeoTIFF or HDF5 grid with 'x', 'y' and 'mask'."""
+
+    if fmask.endswith(('.tif', '.tiff')):
+        X, Y, Z = geotiffread(fmask)[:3]
+        return X[0, :], Y[:, 0], Z
+    else:
+        with h5py.File(fmask, 'r') as f:
+            return f['x'][:], f['y'][:], f['mask'][:]
+
+
+def node_mask(xi, yi, Tree, dmax, fmask=None):
+    """Flag grid nodes with data within dmax and inside (raster) mask.
+
+    Nodes outside the mask extent, or where the mask is zero/NaN, are
+    flagged False. dmax can be a scalar or an array (one per node).
+    """
+
+    # Distance to closest observation for all nodes
+    d = Tree.query(np.c_[xi, yi], k=1, distance_upper_bound=np.max(dmax),
+                   workers=-1)[0]
+
+    # Nodes with data within search radius
+    keep = d <= dmax
+
+    if fmask:
+
+        # Read mask (same projection as grid)
+        xm, ym, zm = read_mask(fmask)
+
+        # Closest mask pixel for each node
+        j = np.round((xi - xm[0]) / (xm[1] - xm[0])).astype(int)
+        i = np.round((yi - ym[0]) / (ym[1] - ym[0])).astype(int)
+
+        # Nodes inside mask extent
+        inside = (i >= 0) & (i < len(ym)) & (j >= 0) & (j < len(xm))
+
+        # Nodes inside mask
+        keep &= inside
+        keep[inside] &= zm[i[inside], j[inside]] > 0
+
+    return keep
+
+
 # Description of algorithm
 des = 'Interpolation of scattered data using the median'
 
@@ -167,6 +411,31 @@ parser.add_argument(
         help=('name of vars in the HDF5-file'),
         default=['lon','lat','h_cor','h_rms'],)
 
+parser.add_argument(
+        '-t', metavar=('orbit','dim'), dest='thin', type=str, nargs=2,
+        help=('name of orbit/track variable and length (km) for thinning'),
+        default=[None, 0],)
+
+parser.add_argument(
+        '-u', metavar=None, dest='tmode', type=str, nargs=1,
+        help=('along-track thinning: average (mean) or decimate (dec)'),
+        choices=('mean','dec'), default=['mean'],)
+
+parser.add_argument(
+        '--mask', metavar='file', dest='mask', type=str, nargs=1,
+        help=('raster mask (GeoTIFF or HDF5 x/y/mask) to select grid nodes'),
+        default=[None],)
+
+parser.add_argument(
+        '-m', metavar=None, dest='method', type=str, nargs=1,
+        help=('prediction: vectorized in chunks (vec) or node loop (loop)'),
+        choices=('vec','loop'), default=['vec'],)
+
+parser.add_argument(
+        '-k', metavar='chunk', dest='chunk', type=int, nargs=1,
+        help=('number of nodes per chunk for vectorized prediction'),
+        default=[10000],)
+
 # Parser argument to variable
 args = parser.parse_args()
 
@@ -182,6 +451,12 @@ dmax  = args.radius[0]
 vicol = args.vnames[:]
 dxy   = args.filter[0] * 1e3
 thres =  args.filter[1]
+ovar  = args.thin[0]
+dl    = float(args.thin[1]) * 1e3
+tmode = args.tmode[0]
+fmask = args.mask[0]
+method = args.method[0]
+chunk = args.chunk[0]
 
 # Print parameters to screen
 print('parameters:')
@@ -200,10 +475,11 @@ with h5py.File(ifile, 'r') as fi:
     lat = fi[yvar][:]
     zp  = fi[zvar][:]
     sp  = fi[svar][:] if svar in fi else np.ones(lon.shape)
+    op  = fi[ovar][:] if ovar else np.zeros(lon.shape)
 
     # Remove data wiht NaN's
-    lon, lat, zp, sp = lon[~np.isnan(zp)],lat[~np.isnan(zp)],\
-                zp[~np.isnan(zp)], sp[~np.isnan(zp)]
+    lon, lat, zp, sp, op = lon[~np.isnan(zp)],lat[~np.isnan(zp)],\
+                zp[~np.isnan(zp)], sp[~np.isnan(zp)], op[~np.isnan(zp)]
 
 # Transform coordinates to wanted projection
 xp, yp = transform_coord('4326', proj, lon, lat)
@@ -227,11 +503,6 @@ Xi, Yi = make_grid(xmin, xmax, ymin, ymax, dx, dy)
 xi = Xi.ravel()
 yi = Yi.ravel()
 
-print("-> creating KDTree ...")
-
-# Construct cKDTree
-TreeP = cKDTree(np.c_[xp, yp])
-
 # Output vectors
 zi = np.ones(len(xi)) * np.nan
 ei = np.ones(len(xi)) * np.nan
@@ -245,106 +516,143 @@ if dxy != 0:
     # Clean the data in the spatial domain
     zp = spatial_filter(xp.copy(), yp.copy(), zp.copy(), dxy, dxy, sigma=thres)
 
-# Enter prediction loop
-for i in range(len(zi)):
+# Check if we should thin along track
+if ovar:
 
-    # Find closest observations
-    (d, idx) = TreeP.query((xi[i],yi[i]), nobs * 5)
+    print('-> thinning data along track ...')
 
-    # Test if closest point to far away
-    if np.min(d) > dmax * 1e3: continue
+    # Average or decimate data in along-track segments
+    xp, yp, sp, zp = thin_track(op, dl, xp, yp, sp, zp, mode=tmode)
 
-    # Extract data for solution
-    x = xp[idx]
-    y = yp[idx]
-    z = zp[idx]
-    s = sp[idx]
+    print('number of obs. after thinning:', len(zp))
 
-    # Test if cell is empty
-    if len(z) == 0: continue
+print("-> creating KDTree ...")
 
-    # Compute angle to data points
-    theta = (180.0 / np.pi) * np.arctan2(y - yi[i], x - xi[i]) + 180
+# Construct cKDTree
+TreeP = cKDTree(np.c_[xp, yp])
 
-    # Get index for data in four sectors
-    IQ1 = (theta > 00) & (theta < 90)
-    IQ2 = (theta > 90) & (theta < 180)
-    IQ3 = (theta > 180) & (theta < 270)
-    IQ4 = (theta > 270) & (theta < 360)
+# Nodes with data within search radius and inside mask
+i_nodes = np.flatnonzero(node_mask(xi, yi, TreeP, dmax * 1e3, fmask))
 
-    # Merge data in different sectors
-    Q1 = np.vstack((x[IQ1], y[IQ1], z[IQ1], s[IQ1], d[IQ1])).T
-    Q2 = np.vstack((x[IQ2], y[IQ2], z[IQ2], s[IQ2], d[IQ2])).T
-    Q3 = np.vstack((x[IQ3], y[IQ3], z[IQ3], s[IQ3], d[IQ3])).T
-    Q4 = np.vstack((x[IQ4], y[IQ4], z[IQ4], s[IQ4], d[IQ4])).T
+print('number of nodes with data/inside mask:', len(i_nodes), 'of', len(xi))
 
-    # Sort according to distance
-    I1 = np.argsort(Q1[:, 4])
-    I2 = np.argsort(Q2[:, 4])
-    I3 = np.argsort(Q3[:, 4])
-    I4 = np.argsort(Q4[:, 4])
+# Vectorized prediction in chunks of nodes
+if method == 'vec':
 
-    # Select only the nobs closest
-    if len(Q1) >= nobs:
+    print('-> predicting values ...')
 
-        Q1 = Q1[I1, :]
-        Q1 = Q1[:nobs, :]
+    # Loop through chunks of nodes
+    for k in range(0, len(i_nodes), chunk):
 
-    else:
+        # Nodes in chunk
+        ik = i_nodes[k:k+chunk]
 
-        Q1 = Q1[I1, :]
+        # Predict all nodes in chunk
+        zi[ik], ei[ik], ni[ik] = median_chunk(xi[ik], yi[ik], TreeP, xp, yp,
+                                              zp, sp, nobs, dmax * 1e3)
 
-    if len(Q2) >= nobs:
+else:
 
-        Q2 = Q2[I2, :]
-        Q2 = Q2[:nobs, :]
+    # Enter prediction loop
+    for i in i_nodes:
 
-    else:
+        # Find closest observations
+        (d, idx) = TreeP.query((xi[i],yi[i]), nobs * 5)
 
-        Q2 = Q2[I2, :]
+        # Test if closest point to far away
+        if np.min(d) > dmax * 1e3: continue
 
-    if len(Q3) >= nobs:
+        # Extract data for solution
+        x = xp[idx]
+        y = yp[idx]
+        z = zp[idx]
+        s = sp[idx]
 
-        Q3 = Q3[I3, :]
-        Q3 = Q3[:nobs, :]
+        # Test if cell is empty
+        if len(z) == 0: continue
 
-    else:
+        # Compute angle to data points
+        theta = (180.0 / np.pi) * np.arctan2(y - yi[i], x - xi[i]) + 180
 
-        Q3 = Q3[I3, :]
+        # Get index for data in four sectors
+        IQ1 = (theta > 00) & (theta < 90)
+        IQ2 = (theta > 90) & (theta < 180)
+        IQ3 = (theta > 180) & (theta < 270)
+        IQ4 = (theta > 270) & (theta < 360)
 
-    if len(Q4) >= nobs:
+        # Merge data in different sectors
+        Q1 = np.vstack((x[IQ1], y[IQ1], z[IQ1], s[IQ1], d[IQ1])).T
+        Q2 = np.vstack((x[IQ2], y[IQ2], z[IQ2], s[IQ2], d[IQ2])).T
+        Q3 = np.vstack((x[IQ3], y[IQ3], z[IQ3], s[IQ3], d[IQ3])).T
+        Q4 = np.vstack((x[IQ4], y[IQ4], z[IQ4], s[IQ4], d[IQ4])).T
 
-        Q4 = Q4[I4, :]
-        Q4 = Q4[:nobs, :]
+        # Sort according to distance
+        I1 = np.argsort(Q1[:, 4])
+        I2 = np.argsort(Q2[:, 4])
+        I3 = np.argsort(Q3[:, 4])
+        I4 = np.argsort(Q4[:, 4])
 
-    else:
+        # Select only the nobs closest
+        if len(Q1) >= nobs:
+
+            Q1 = Q1[I1, :]
+            Q1 = Q1[:nobs, :]
 
-        Q14 = Q4[I4, :]
+        else:
 
-    # Stack the data
-    Q14 = np.vstack((Q1, Q2, Q3, Q4))
+            Q1 = Q1[I1, :]
 
-    # Extract sectored data
-    x = Q14[:, 0]
-    y = Q14[:, 1]
-    z = Q14[:, 2]
-    s = Q14[:, 3]
-    d = Q14[:, 4]
+        if len(Q2) >= nobs:
+
+            Q2 = Q2[I2, :]
+            Q2 = Q2[:nobs, :]
+
+        else:
+
+            Q2 = Q2[I2, :]
+
+        if len(Q3) >= nobs:
+
+            Q3 = Q3[I3, :]
+            Q3 = Q3[:nobs, :]
+
+        else:
+
+            Q3 = Q3[I3, :]
+
+        if len(Q4) >= nobs:
+
+            Q4 = Q4[I4, :]
+            Q4 = Q4[:nobs, :]
+
+        else:
+
+            Q14 = Q4[I4, :]
+
+        # Stack the data
+        Q14 = np.vstack((Q1, Q2, Q3, Q4))
+
+        # Extract sectored data
+        x = Q14[:, 0]
+        y = Q14[:, 1]
+        z = Q14[:, 2]
+        s = Q14[:, 3]
+        d = Q14[:, 4]
           
-    # Predicted value
-    zi[i] = np.nanmedian(z)
+        # Predicted value
+        zi[i] = np.nanmedian(z)
 
-    # Compute random error
-    sigma_r = np.nanstd(z)
+        # Compute random error
+        sigma_r = np.nanstd(z)
 
-    # Compute systematic error
-    sigma_s = 0 if np.all(s == 1) else np.nanmean(s)
+        # Compute systematic error
+        sigma_s = 0 if np.all(s == 1) else np.nanmean(s)
 
-    # Prediction error at grid node
-    ei[i] = np.sqrt(sigma_r ** 2 + sigma_s ** 2)
+        # Prediction error at grid node
+        ei[i] = np.sqrt(sigma_r ** 2 + sigma_s ** 2)
 
-    # Number of obs. in solution
-    ni[i] = len(z)
+        # Number of obs. in solution
+        ni[i] = len(z)
 
  # Converte back to arrays
 Zi = np.flipud(zi.reshape(Xi.shape))
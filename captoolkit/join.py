@@ -48,6 +48,11 @@ def get_args():
             help=('compress joined file(s)'),
             choices=('lzf', 'gzip'), default=[None],)
 
+    parser.add_argument(
+            '-p', metavar=('x','y'), dest='xyproj', type=str, nargs=2,
+            help=('name of projected x/y variables (if stored) for bbox'),
+            default=None,)
+
     parser.add_argument(
             '-k', metavar=('keyword'), dest='key', type=str, nargs=1,
             help=('keyword in file name for sorting by tile number (<tile>_N.h5)'),
@@ -86,34 +91,35 @@ def get_proj(fname):
     return fname[i+1]
 
 
-def remove_empty(ifiles, xvar, yvar):
-    """ Remove all files from list with no points inside bbox. """
+def get_mask(ifile, xvar, yvar, xyproj=None):
+    """
+    Get mask of points inside bbox (from file name) and number of points.
 
-    # Do nothing if keyword '_bbox' not in file name 
-    if '_bbox' not in ifiles[0]:
-        return ifiles
+    Mask is None if all points are merged (no bbox or all inside bbox).
+    Projected coordinates are read from 'xyproj' vars if given, otherwise
+    lon/lat are transformed to the projection in the file name.
+    """
+    with h5py.File(ifile, 'r') as fi:
 
-    ifiles_ = []
-    for ifile in ifiles:
+        # Merge all points if keyword '_bbox' not in file name
+        if '_bbox' not in ifile:
+            return None, list(fi.values())[0].shape[0]
 
-        with h5py.File(ifile, 'r') as fi:
-            lon = fi[xvar][:]
-            lat = fi[yvar][:]
+        if xyproj:
+            x, y = fi[xyproj[0]][:], fi[xyproj[1]][:]
+        else:
+            lon, lat = fi[xvar][:], fi[yvar][:]
 
-        bbox = get_bbox(ifile)
-        proj = get_proj(ifile)
+    xmin, xmax, ymin, ymax = get_bbox(ifile)
 
-        xmin, xmax, ymin, ymax = bbox
+    if not xyproj:
+        x, y = transform_coord('4326', get_proj(ifile), lon, lat)
 
-        x, y = transform_coord('4326', proj, lon, lat)
+    mask = (x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)
 
-        idx, = np.where( (x >= xmin) & (x <= xmax) & 
-                         (y >= ymin) & (y <= ymax) )
-        
-        if len(idx) > 0:
-            ifiles_.append(ifile)
+    n = np.count_nonzero(mask)
 
-    return ifiles_
+    return (None if n == len(mask) else mask), n
 
 
 # Pass arguments 
@@ -123,6 +129,7 @@ ofile = args.ofile[0]  # output file
 xvar = args.vnames[0]  # lon variable names
 yvar = args.vnames[1]  # lat variable names
 comp = args.comp[0]
+xyproj = args.xyproj   # projected x/y variable names
 key = args.key[0]      # keyword for sorting 
 
 print_args(args)
@@ -135,91 +142,42 @@ if key:
     natkey = lambda s: int(re.findall(key+'_\d+', s)[0].split('_')[-1])
     ifiles.sort(key=natkey)
 
-# Assert file in list are not empty inside bbox
-ifiles = remove_empty(ifiles, xvar, yvar)
-
-print(('joining %d tiles ...' % len(ifiles)))
+# Counting pre-pass: mask of points inside bbox and length of each file
+print('computing bbox masks ...')
+masks, lengths = list(zip(*[get_mask(f, xvar, yvar, xyproj) for f in ifiles]))
 
+# Remove all files with no points inside bbox
+ifiles, masks, lengths = list(zip(*[(f, m, n) for f, m, n in
+                                    zip(ifiles, masks, lengths) if n > 0]))
 
-with h5py.File(ofile, 'w') as fo:
+N = sum(lengths)
 
-    # Create resizable output file using info from first input file
-    first_file = ifiles.pop(0)
-
-    with h5py.File(first_file, 'r') as fi:
+print(('joining %d tiles ...' % len(ifiles)))
 
-        # Get index for points inside bbox
-        if '_bbox' in first_file:
-            print('merging only points within bbox ...')
 
-            bbox = get_bbox(first_file)
-            proj = get_proj(first_file)
+with h5py.File(ofile, 'w') as fo:
 
-            xmin, xmax, ymin, ymax = bbox
-            lon, lat = fi[xvar][:], fi[yvar][:]
+    # Create output containers using info from first input file
+    # The arrays can be of any shape, the first dim is the total length
+    with h5py.File(ifiles[0], 'r') as fi:
+        for key, val in list(fi.items()):
+            fo.create_dataset(key, (N,) + val.shape[1:], dtype=val.dtype,
+                              compression=comp)
 
-            x, y = transform_coord('4326', proj, lon, lat)
+    k = 0  # output row
 
-            idx, = np.where( (x >= xmin) & (x <= xmax) & 
-                             (y >= ymin) & (y <= ymax) )
-            
-        # Get all points (no index)
-        else:
-            print('merging all points in tile ...')
-            idx = None
+    # Iterate over the input files (single pass)
+    for ifile, mask, n in zip(ifiles, masks, lengths):
 
-        # Create resizable arrays for all variables in the input file
-        # The arrays can be of any shape, the first dim will be resizeable
-        for key,val in list(fi.items()):
-            maxshape = (None,) + fi[key][:][idx].shape[1:]
-            fo.create_dataset(key, data=val[:][idx],
-                    maxshape=maxshape, compression=comp)
+        print(ifile)
 
-    print(first_file)
+        with h5py.File(ifile, 'r') as fi:
 
-    # Iterate over the remaining input files
-    for ifile in ifiles:
-    
-        print(ifile)
-    
-        fi = h5py.File(ifile)
-    
-        if '_bbox' in ifile:
-    
-            bbox = get_bbox(ifile)
-            proj = get_proj(ifile)
-
-            xmin, xmax, ymin, ymax = bbox
-            lon, lat = fi[xvar][:], fi[yvar][:]
-    
-            x, y = transform_coord('4326', proj, lon, lat)
-    
-            idx, = np.where( (x >= xmin) & (x <= xmax) & 
-                             (y >= ymin) & (y <= ymax) )
-            
-            if len(idx) == 0:
-                continue
+            # Read each variable once and write its points inside bbox
+            for key in fo:
+                data = fi[key][:]
+                fo[key][k:k+n] = data if mask is None else data[mask]
 
-        else:
-            idx = None
-    
-        # Loop through each variable and append chunk
-        # to first dim of output container.
-        for key, val in list(fi.items()):
+        k += n
 
-            # Get lengths of input chunk and output (updated) container
-            length_next = fi[key][:][idx].shape[0]
-            length = fo[key].shape[0]
-
-            # Resize the dataset to accommodate next chunk
-            fo[key].resize(length + length_next, axis=0)
-    
-            # Write next chunk
-            fo[key][length:] = val[:][idx]
-            fo.flush()
-
-            length += length_next
-    
-        fi.close()
-    
 print(('output ->', ofile))
@@ -12,6 +12,12 @@ Notes:
     - For joining data points into a single large file see 'join.py'.
     - If several mosaics (i.e. 1 grid per time step), joins each in parallel.
     - Groups input files with same 'time_key' (see below) for multiple mosaics.
+    - Tile positions are computed first, the output is opened once (chunks
+      = tile shape), and tiles are read by a pool of threads (-t) feeding
+      a single writer. Flipping (-u) is applied to each tile as written.
+    - With --memmap the grids are contiguous (uncompressed) HDF5 datasets
+      written through np.memmap, so they can also be memory-mapped
+      downstream (offset from h5py 'dataset.id.get_offset()').
 
     Bedmap boundaries: -b -3333000 3333000 -3333000 3333000
     Ross boundaries: -b -600000 410000 -1400000 -400000
@@ -30,6 +36,8 @@ import argparse
 import itertools
 import tables as tb
 import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 time_key = 'time'
 
@@ -70,6 +78,14 @@ def get_args():
             '-n', metavar=('njobs'), dest='njobs', type=int, nargs=1,
             help='for parallel processing of multiple grids, optional',
             default=[1],)
+    parser.add_argument(
+            '-t', metavar=('nthreads'), dest='nthreads', type=int, nargs=1,
+            help='number of threads to read tiles',
+            default=[8],)
+    parser.add_argument(
+            '--memmap', dest='memmap', action='store_true',
+            help=('write contiguous grids through np.memmap (no compression)'),
+            default=False)
     return parser.parse_args()
 
 
@@ -127,9 +143,31 @@ def get_grid_names(fname):
     return vnames
 
 
-def create_output_grids(ofile, grid_shape, vnames):
+def create_output_grids(ofile, grid_shape, vnames, tile_shape=None,
+                        comp=None):
+    """ Create empty grids, chunked with the tile shape if given. """
+    with h5py.File(ofile, 'w') as f:
+        [f.create_dataset(v, grid_shape, 'f', fillvalue=np.nan,
+                          chunks=tile_shape, compression=comp) for v in vnames]
+
+
+def create_contiguous_grids(ofile, grid_shape, vnames):
+    """
+    Create empty contiguous grids allocated (and filled) on creation.
+
+    Returns the offset of each grid in the file (for np.memmap).
+    """
+    dcpl = h5py.h5p.create(h5py.h5p.DATASET_CREATE)
+    dcpl.set_alloc_time(h5py.h5d.ALLOC_TIME_EARLY)
+    dcpl.set_fill_time(h5py.h5d.FILL_TIME_ALLOC)
+    dcpl.set_fill_value(np.array(np.nan, 'f'))
+
     with h5py.File(ofile, 'w') as f:
-        [f.create_dataset(v, grid_shape, 'f', fillvalue=np.nan) for v in vnames]
+        for v in vnames:
+            space = h5py.h5s.create_simple(grid_shape)
+            h5py.h5d.create(f.id, v.encode(), h5py.h5t.NATIVE_FLOAT,
+                            space, dcpl=dcpl)
+        return [f[v].id.get_offset() for v in vnames]
 
 
 def save_output_coord(ofile, xy, vnames):
@@ -163,10 +201,33 @@ def group_by_key(files, key='bin'):
             .groupby(files_sorted, key=lambda f: get_key_num(f, key=key))]
 
 
-def flipud(fname, vnames):
-    with h5py.File(fname, 'a') as f:
-        for v in vnames: f[v][:] = np.flipud(f[v][:])
-        print('final grids flipped upside-down')
+def read_tile(ifile, vnames, flip=False):
+    """ Read subgrids of tile (flipped upside-down if requested). """
+    with h5py.File(ifile, 'r') as f:
+        return [np.flipud(f[v][:]) if flip else f[v][:] for v in vnames]
+
+
+def prefetch(ifiles, vnames, flip=False, nthreads=8):
+    """
+    Read tiles in order, while threads read the next tiles.
+
+    At most 2*nthreads tiles are read ahead (bounded memory).
+    Yields (file name, list of subgrids).
+    """
+    with ThreadPoolExecutor(nthreads) as pool:
+
+        queue = deque()
+
+        for ifile in ifiles:
+            queue.append((ifile, pool.submit(read_tile, ifile, vnames, flip)))
+
+            if len(queue) > 2 * nthreads:
+                ifile_, data = queue.popleft()
+                yield ifile_, data.result()
+
+        while queue:
+            ifile_, data = queue.popleft()
+            yield ifile_, data.result()
 
 
 def join(ifiles, suffix=''):
@@ -190,20 +251,40 @@ def join(ifiles, suffix=''):
     tile_shape = get_tile_shape(ifiles[0], vnames[0])
     grid_shape = get_grid_shape(tile_shape, num_tiles)
     x_grid, y_grid = get_grid_coord(grid_bbox, grid_shape)
-    create_output_grids(ofile_, grid_shape, vnames)
-    save_output_coord(ofile_, (x_grid, y_grid), (xvar, yvar))
 
-    # Iterate over tiles
+    # Position of all tiles in grid (mirrored in y if flipping)
+    ny = grid_shape[0]
+    position = {}
     for ifile in ifiles:
+        i1,i2,j1,j2 = get_tile_position(x_grid, y_grid, get_tile_bbox(ifile))
+        position[ifile] = (ny-i2, ny-i1, j1, j2) if flipy else (i1, i2, j1, j2)
+
+    if memmap:
+        offsets = create_contiguous_grids(ofile_, grid_shape, vnames)
+        fo = [np.memmap(ofile_, 'f', 'r+', offset, grid_shape)
+              for offset in offsets]
+    else:
+        create_output_grids(ofile_, grid_shape, vnames, tile_shape, comp)
+        f = h5py.File(ofile_, 'a')
+        fo = [f[v] for v in vnames]
+
+    # Iterate over tiles (read ahead), single writer
+    for ifile, data in prefetch(ifiles, vnames, flipy, nthreads):
         print(('tile:', ifile))
-        
-        tile_bbox = get_tile_bbox(ifile)
-        i1,i2,j1,j2 = get_tile_position(x_grid, y_grid, tile_bbox)
 
-        with h5py.File(ifile, 'r') as fi, h5py.File(ofile_, 'a') as fo:
-            for v in vnames: fo[v][i1:i2,j1:j2] = fi[v][:]
+        i1,i2,j1,j2 = position[ifile]
+
+        for grid, tile in zip(fo, data): grid[i1:i2,j1:j2] = tile
+
+    if memmap:
+        [grid.flush() for grid in fo]
+        del fo
+    else:
+        f.close()
+
+    save_output_coord(ofile_, (x_grid, y_grid), (xvar, yvar))
 
-    if flipy: flipud(ofile_, vnames) 
+    if flipy: print('final grids flipped upside-down')
 
     print(('joined tiles:', len(ifiles)))
     print(('out ->', ofile_))
@@ -221,6 +302,8 @@ flipy = args.flipy        # flip final grid upside-down
 key = args.key[0]         # keyword for sorting 
 comp = args.comp[0]
 njobs = args.njobs[0]
+nthreads = args.nthreads[0]
+memmap = args.memmap
 
 print_args(args)
 
@@ -233,7 +316,7 @@ multiple_grids = len(allfiles) > 1
 
 if njobs == 1 or not multiple_grids:
     print('Running sequential code ...')
-    [join(ifiles) for ifiles in allfiles]
+    [join(ifiles, time_key if multiple_grids else '') for ifiles in allfiles]
 
 else:
     print(('Running parallel code (%d jobs) ...' % njobs))
@@ -5,11 +5,25 @@ Merges several HDF5 files into a single file or multiple larger files.
 Example
     merge.py ifiles_*.h5 -o ofile.h5
     merge.py ifiles_*.h5 -o ofile.h5 -m 5 -n 5
+    merge.py ifiles_*.h5 -o ofile.h5 --virtual
+    merge.py ifiles_*.h5 -o ofile.h5 -s t_year
+    merge.py ofile.h5 -o ofile_copy.h5 --materialize
 
 Notes
     - The parallel option (-n) only works for multiple outputs (-m)!
     - If no 'key' is given, it merges files in the order they are passed/read.
     - If receive "Argument list too long", pass a string.
+    - With --virtual no data is copied: the output holds HDF5 virtual
+      datasets mapping the rows of each input file (which must be kept)
+      into a single array. The row offsets come from a parallel scan of
+      the input lengths (-t threads).
+    - With --materialize the virtual datasets of a (merged) file are
+      copied to a physical file, in blocks of rows. The output can be
+      the same file.
+    - With -s the inputs, each sorted by the given variable (e.g. t_year),
+      are merged into a globally sorted output (k-way merge). Only a block
+      of rows per input is held in memory, so no sort.py pass is needed.
+      The order of each input is verified as it is read.
     - See complementary program: split.py
 
 Use case:
@@ -23,6 +37,17 @@ import h5py
 import argparse
 import numpy as np
 from glob import glob
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Number of rows per block written to output (multiple of CHUNK)
+BLOCK = 2**20
+
+# Number of rows per HDF5 chunk of compressed outputs
+CHUNK = 2**16
+
+# Minimum number of rows per input buffer in sorted merge (-s)
+MINROWS = 2**12
 
 
 def get_args():
@@ -52,20 +77,52 @@ def get_args():
             '-k', metavar='key', dest='key', type=str, nargs=1,
             help=('sort files by numbers after `key` in file name'),
             default=[None],)
+    parser.add_argument(
+            '-s', metavar='sortvar', dest='sortvar', type=str, nargs=1,
+            help=('merge inputs sorted by `sortvar` into sorted output'),
+            default=[None],)
     parser.add_argument(
             '-n', metavar='njobs', dest='njobs', type=int, nargs=1,
             help=('number of jobs for parallel processing when using -m'),
             default=[1],)
+    parser.add_argument(
+            '-t', metavar='nthreads', dest='nthreads', type=int, nargs=1,
+            help=('number of threads to scan and read input files'),
+            default=[8],)
+    parser.add_argument(
+            '--virtual', dest='virtual', action='store_true',
+            help=('merge into virtual datasets (no copy of the data)'),
+            default=False)
+    parser.add_argument(
+            '--materialize', dest='materialize', action='store_true',
+            help=('copy virtual datasets of merged file to output file'),
+            default=False)
     return parser.parse_args()
 
 
-def get_total_len(ifiles):
-    """ Get total output length from all input files. """
-    N = 0
-    for fn in ifiles:
-        with h5py.File(fn) as f:
-            N += list(f.values())[0].shape[0]
-    return N
+def get_schema(ifile):
+    """ Get length (first var/first dim) and {var: (dtype, shape)}. """
+    with h5py.File(ifile, 'r') as f:
+        length = list(f.values())[0].shape[0]
+        schema = dict((k, (d.dtype, d.shape[1:])) for k, d in f.items())
+    return length, schema
+
+
+def scan_files(ifiles, nthreads=8):
+    """
+    Get length of all input files and the variable schema, scanning
+    files in parallel. Dtypes are promoted over all files.
+    """
+    with ThreadPoolExecutor(nthreads) as pool:
+        lengths, schemas = list(zip(*pool.map(get_schema, ifiles)))
+
+    schema = {}
+    for sch in schemas:
+        for k, (dtype, shape) in sch.items():
+            dtype0 = schema.get(k, (dtype, shape))[0]
+            schema[k] = (np.promote_types(dtype0, dtype), shape)
+
+    return np.array(lengths, dtype='i8'), schema
 
 
 def get_var_names(ifile):
@@ -85,44 +142,235 @@ def get_multi_io(ifiles, ofile, nfiles):
     return ifiles, ofiles
 
 
-def merge(ifiles, ofile, vnames, comp):
+def read_file(ifile, vnames, i1=None, i2=None):
+    """ Read variables of input file (rows i1:i2) into memory. """
+    with h5py.File(ifile, 'r') as f:
+        return [f[key][i1:i2] for key in vnames]
+
+
+def prefetch(ifiles, vnames, nthreads=8):
+    """
+    Read input files in order, while threads read the next files.
+
+    At most 2*nthreads files are read ahead (bounded memory).
+    Yields (file name, list of arrays).
+    """
+    with ThreadPoolExecutor(nthreads) as pool:
+
+        queue = deque()
+
+        for ifile in ifiles:
+            queue.append((ifile, pool.submit(read_file, ifile, vnames)))
+
+            if len(queue) > 2 * nthreads:
+                ifile_, data = queue.popleft()
+                yield ifile_, data.result()
+
+        while queue:
+            ifile_, data = queue.popleft()
+            yield ifile_, data.result()
+
+
+def create_dsets(f, vnames, schema, N, comp):
+    """ Create empty output containers (w/compression optimized for speed). """
+    dsets = []
+    for key in vnames:
+        dtype, shape = schema[key]
+        chunks = (min(CHUNK, N),) + shape if comp and N else None
+        dsets.append(f.create_dataset(key, (N,) + shape, dtype=dtype,
+                                      compression=comp, chunks=chunks))
+    return dsets
+
+
+def merge(ifiles, ofile, vnames, comp, nthreads=8):
     """
     Merge variables from several input files into a single file.
 
+    Output datasets are preallocated from a parallel scan of the input
+    lengths and schema. Input files are prefetched by reader threads,
+    and the output is written in blocks of BLOCK rows (chunk aligned).
+
     Args:
         ifiles (list): input file names.
         ofile (str): output file name.
         vnames (list): name of vars to merge.
     """
     # Get length of output containers (from all input files)
-    print('Calculating lenght of output from all input files ...')
-    N = get_total_len(ifiles)
+    print('Scanning lenght and variables of all input files ...')
+    lengths, schema = scan_files(ifiles, nthreads)
+    N = lengths.sum()
 
     with h5py.File(ofile, 'w') as f:
 
-        # Create empty output containers (w/compression optimized for speed)
-        [f.create_dataset(key, (N,), dtype='float64', compression=comp)
-            for key in vnames]
+        dsets = create_dsets(f, vnames, schema, N, comp)
 
-        # Iterate over the input files
-        k1 = 0
-        for ifile in ifiles:
+        # Output blocks (buffers) of BLOCK rows
+        blocks = [np.empty((BLOCK,) + schema[key][1], dtype=schema[key][0])
+                  for key in vnames]
+
+        k = 0  # output row of block
+        n = 0  # rows filled in block
+
+        # Iterate over the input files (read ahead)
+        for ifile, data in prefetch(ifiles, vnames, nthreads):
             print(('reading', ifile))
-    
-            # Write next chunk (the input file)
-            with h5py.File(ifile) as f2:
-                k2 = k1 + list(f2.values())[0].shape[0]  # first var/first dim
 
-                # Iterate over all variables
-                for key in vnames:
-                    f[key][k1:k2] = f2[key][:]
+            i, m = 0, len(data[0])
 
-            k1 = k2
+            # Fill block(s) with the input file
+            while i < m:
+
+                j = min(m, i + BLOCK - n)
+
+                for b, d in zip(blocks, data): b[n:n+j-i] = d[i:j]
+
+                n += j - i
+                i = j
+
+                # Write full block
+                if n == BLOCK:
+                    for ds, b in zip(dsets, blocks): ds[k:k+n] = b
+                    k += n
+                    n = 0
+
+        # Write last (partial) block
+        if n > 0:
+            for ds, b in zip(dsets, blocks): ds[k:k+n] = b[:n]
     
     print(('merged', len(ifiles), 'files'))
     print(('output ->', ofile))
 
 
+def merge_sorted(ifiles, ofile, vnames, comp, sortvar, nthreads=8):
+    """
+    Merge input files sorted by 'sortvar' into a single sorted file.
+
+    Streaming k-way merge: a buffer of rows is read from each input, and
+    all rows up to the smallest last value of the buffers (of inputs not
+    fully read) are sorted and written out. Emptied buffers are refilled.
+    Total memory is about BLOCK rows (at least MINROWS per input).
+
+    Raises ValueError if an input is not sorted by 'sortvar'.
+    """
+    print('Scanning lenght and variables of all input files ...')
+    lengths, schema = scan_files(ifiles, nthreads)
+    N = lengths.sum()
+
+    # Read sort variable even if not merged (last in list)
+    rvars = [v for v in vnames if v != sortvar] + [sortvar]
+    i_var = [rvars.index(v) for v in vnames]
+
+    nrows = max(BLOCK // len(ifiles), MINROWS)  # rows per input buffer
+
+    n_read = np.zeros(len(ifiles), dtype='i8')  # rows read per input
+    buffers = [None] * len(ifiles)
+    last = [[] for f in ifiles]  # last value read per input
+
+    def refill(j):
+        """ Read next rows of input j, checking they are sorted. """
+        i1, i2 = n_read[j], min(n_read[j] + nrows, lengths[j])
+        data = read_file(ifiles[j], rvars, i1, i2)
+        t = data[-1]
+        if np.any(np.diff(np.append(last[j], t)) < 0):
+            raise ValueError('input not sorted by %s: %s' % (sortvar, ifiles[j]))
+        buffers[j] = data
+        last[j] = t[-1:]
+        n_read[j] = i2
+
+    with h5py.File(ofile, 'w') as f:
+
+        dsets = create_dsets(f, vnames, schema, N, comp)
+
+        for j in range(len(ifiles)):
+            if lengths[j] > 0: refill(j)
+
+        k = 0  # output row
+
+        while k < N:
+
+            # Inputs with rows in buffer
+            jj = [j for j in range(len(ifiles))
+                  if buffers[j] is not None and len(buffers[j][-1]) > 0]
+
+            # Rows up to this value can be written (no smaller value left)
+            tmax = min([buffers[j][-1][-1] for j in jj
+                        if n_read[j] < lengths[j]] or [np.inf])
+
+            chunks = []
+
+            for j in jj:
+                n = np.searchsorted(buffers[j][-1], tmax, side='right')
+                chunks.append([d[:n] for d in buffers[j]])
+                buffers[j] = [d[n:] for d in buffers[j]]
+
+                if len(buffers[j][-1]) == 0 and n_read[j] < lengths[j]:
+                    refill(j)
+
+            # Sort rows of all inputs (stable) and write
+            data = [np.concatenate(d) for d in zip(*chunks)]
+            i_sort = np.argsort(data[-1], kind='mergesort')
+            n = len(i_sort)
+
+            for ds, i in zip(dsets, i_var): ds[k:k+n] = data[i][i_sort]
+
+            k += n
+
+    print(('merged (sorted by %s)' % sortvar, len(ifiles), 'files'))
+    print(('output ->', ofile))
+
+
+def merge_virtual(ifiles, ofile, vnames, nthreads=8):
+    """
+    Merge variables from several input files into virtual datasets.
+
+    The rows of each input file are mapped (not copied) into a single
+    array per variable. Dtypes are promoted over all files.
+    """
+    print('Scanning lenght and variables of all input files ...')
+    lengths, schema = scan_files(ifiles, nthreads)
+    offsets = np.append(0, np.cumsum(lengths))
+
+    with h5py.File(ofile, 'w') as f:
+
+        for key in vnames:
+
+            dtype, shape = schema[key]
+
+            layout = h5py.VirtualLayout(shape=(offsets[-1],) + shape,
+                                        dtype=dtype)
+
+            for ifile, k1, k2 in zip(ifiles, offsets[:-1], offsets[1:]):
+                shape = (k2 - k1,) + schema[key][1]
+                layout[k1:k2] = h5py.VirtualSource(os.path.abspath(ifile),
+                                                   key, shape=shape)
+
+            f.create_virtual_dataset(key, layout)
+
+    print(('merged (virtual)', len(ifiles), 'files'))
+    print(('output ->', ofile))
+
+
+def materialize(ifile, ofile, vnames=None, comp=None):
+    """ Copy (virtual) datasets in file to a physical file (can be same). """
+    path, ext = os.path.splitext(ofile)
+    tmpfile = path + '_tmp' + ext
+
+    with h5py.File(ifile, 'r') as fi, h5py.File(tmpfile, 'w') as fo:
+
+        for key in (vnames if vnames else list(fi.keys())):
+
+            d = fi[key]
+            fo.create_dataset(key, d.shape, dtype=d.dtype, compression=comp)
+
+            # Copy in blocks of rows
+            for k1 in range(0, d.shape[0], BLOCK):
+                fo[key][k1:k1+BLOCK] = d[k1:k1+BLOCK]
+
+    os.replace(tmpfile, ofile)
+
+    print(('materialized ->', ofile))
+
+
 # Sort input files by key 
 def sort_files(ifiles, key=None):
     """ Sort files by numbers *after* the key in the file name. """
@@ -143,11 +391,19 @@ if __name__ == '__main__':
     comp = args.comp[0]
     key = args.key[0]
     njobs = args.njobs[0]
+    nthreads = args.nthreads[0]
+    sortvar = args.sortvar[0]
+    virtual = args.virtual
 
     # In case a string is passed to avoid "Argument list too long"
     if len(ifile) == 1:
         ifile = glob(ifile[0])
 
+    # Physical copy of virtual datasets (no merging)
+    if args.materialize:
+        materialize(ifile[0], ofile, vnames, comp)
+        sys.exit()
+
     # Sort files before merging
     sort_files(ifile, key=key)
 
@@ -160,13 +416,23 @@ if __name__ == '__main__':
     else:
         ifile, ofile = [ifile], [ofile]
 
-    if njobs > 1 and nfiles > 1:
+    if virtual:
+        print('Building virtual datasets ...')
+        [merge_virtual(fi, fo, vnames, nthreads)
+                for fi,fo in zip(ifile, ofile)]
+
+    elif sortvar:
+        print(('Merging sorted by %s ...' % sortvar))
+        [merge_sorted(fi, fo, vnames, comp, sortvar, nthreads)
+                for fi,fo in zip(ifile, ofile)]
+
+    elif njobs > 1 and nfiles > 1:
         print(('Running parallel code (%d jobs) ...' % njobs))
         from joblib import Parallel, delayed
         Parallel(n_jobs=njobs, verbose=5)(
-                delayed(merge)(fi, fo, vnames, comp) \
+                delayed(merge)(fi, fo, vnames, comp, nthreads) \
                         for fi,fo in zip(ifile, ofile))
     else:
         print('Running sequential code ...')
-        [merge(fi, fo, vnames, comp) for fi,fo in zip(ifile, ofile)]
+        [merge(fi, fo, vnames, comp, nthreads) for fi,fo in zip(ifile, ofile)]
 
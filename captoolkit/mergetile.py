@@ -6,6 +6,17 @@ Set of tiles can be located in different folders.
 
 Merge set of tiles in parallel (optional).
 
+With --virtual no data is copied: each merged tile holds HDF5 virtual
+datasets mapping the rows of its input tiles (which must be kept).
+Use "merge.py tile.h5 -o copy.h5 --materialize" for a physical copy.
+
+Input lengths are counted first (in parallel), so the merged tiles are
+created with their final size and filled with chunked block copies
+(chunk rows -c, compression -z). Tiles are merged largest first.
+
+With -s the input tiles, each sorted by the given variable (e.g. t_year),
+are merged into sorted tiles (k-way merge, bounded memory).
+
 Example:
     python mergetile.py /input/files1/*.h5 /input/files2/*.h5 \
             -o /output/file.h5 -v orbit lon lat t_year h_cor satid -n 4
@@ -18,11 +29,21 @@ import h5py
 import argparse
 import numpy as np
 from glob import glob
+from concurrent.futures import ThreadPoolExecutor
 
 
 # Set keyword referent to 'tile_num' that is present in file name.
 key = 'tile'
 
+# Number of rows per block copied, and held in memory in sorted merge (-s)
+BLOCK = 2**20
+
+# Number of rows per HDF5 chunk of merged tiles
+CHUNK = 2**16
+
+# Minimum number of rows per input buffer in sorted merge (-s)
+MINROWS = 2**12
+
 
 def get_tile_num(fname, key='tile'):
     """ Given 'key' extract 'num' from 'key_num' in string. """ 
@@ -56,6 +77,172 @@ def add_suffix(fname, suffix=''):
     return path + suffix + ext
 
 
+def get_len(ifile, vname=None):
+    """ Get length of variable (first dim) in file, first var if None. """
+    with h5py.File(ifile, 'r') as f:
+        return (f[vname] if vname else list(f.values())[0]).shape[0]
+
+
+def get_lengths(ifiles, nthreads=8, vname=None):
+    """ Get length of all input files, scanning files in parallel. """
+    with ThreadPoolExecutor(nthreads) as pool:
+        lengths = pool.map(lambda f: get_len(f, vname), ifiles)
+        return np.array(list(lengths), dtype='i8')
+
+
+def get_schema(ifile, vnames=None):
+    """ Get var names (all if not given), and dtype and shape of each. """
+    with h5py.File(ifile, 'r') as f:
+        vnames = vnames if vnames else list(f.keys())
+        dtypes = dict((k, f[k].dtype) for k in vnames)
+        shapes = dict((k, f[k].shape[1:]) for k in vnames)
+    return vnames, dtypes, shapes
+
+
+def create_dsets(f, vnames, dtypes, shapes, N, comp=None, chunk=CHUNK):
+    """ Create empty output containers with chunks of 'chunk' rows. """
+    chunks = lambda k: (min(chunk, N),) + shapes[k] if N else None
+    return [f.create_dataset(k, (N,) + shapes[k], dtype=dtypes[k],
+                             chunks=chunks(k), compression=comp)
+            for k in vnames]
+
+
+def merge(ifiles, ofile, vnames, comp=None, chunk=CHUNK, nthreads=8):
+    """
+    Merge variables from several input files into a single file.
+
+    Output datasets are created with the total length (counting pre-pass)
+    and filled by copying blocks of BLOCK rows. Dtype and shape are taken
+    from the first file.
+    """
+    vnames, dtypes, shapes = get_schema(ifiles[0], vnames)
+
+    lengths = get_lengths(ifiles, nthreads, vnames[0])
+    offsets = np.append(0, np.cumsum(lengths))
+
+    with h5py.File(ofile, 'w') as f:
+
+        dsets = create_dsets(f, vnames, dtypes, shapes, offsets[-1],
+                             comp, chunk)
+
+        for ifile, k1, k2 in zip(ifiles, offsets[:-1], offsets[1:]):
+
+            print(ifile)
+
+            with h5py.File(ifile, 'r') as fi:
+
+                # Copy in blocks of rows
+                for ds, key in zip(dsets, vnames):
+                    for i in range(0, k2 - k1, BLOCK):
+                        j = min(i + BLOCK, k2 - k1)
+                        ds[k1+i:k1+j] = fi[key][i:j]
+
+
+def merge_virtual(ifiles, ofile, vnames, nthreads=8):
+    """
+    Merge variables from several input files into virtual datasets.
+
+    The rows of each input file are mapped (not copied) into a single
+    array per variable. Dtype and shape are taken from the first file.
+    """
+    vnames, dtypes, shapes = get_schema(ifiles[0], vnames)
+
+    lengths = get_lengths(ifiles, nthreads, vnames[0])
+    offsets = np.append(0, np.cumsum(lengths))
+
+    with h5py.File(ofile, 'w') as f:
+
+        for key in vnames:
+
+            layout = h5py.VirtualLayout(shape=(offsets[-1],) + shapes[key],
+                                        dtype=dtypes[key])
+
+            for ifile, k1, k2 in zip(ifiles, offsets[:-1], offsets[1:]):
+                shape = (k2 - k1,) + shapes[key]
+                layout[k1:k2] = h5py.VirtualSource(os.path.abspath(ifile),
+                                                   key, shape=shape)
+
+            f.create_virtual_dataset(key, layout)
+
+
+def merge_sorted(ifiles, ofile, vnames, sortvar, comp=None, chunk=CHUNK,
+                 nthreads=8):
+    """
+    Merge input files sorted by 'sortvar' into a single sorted file.
+
+    Streaming k-way merge: a buffer of rows is read from each input, and
+    all rows up to the smallest last value of the buffers (of inputs not
+    fully read) are sorted and written out. Emptied buffers are refilled.
+    Dtype and shape are taken from the first file.
+
+    Raises ValueError if an input is not sorted by 'sortvar'.
+    """
+    vnames, dtypes, shapes = get_schema(ifiles[0], vnames)
+
+    lengths = get_lengths(ifiles, nthreads, sortvar)
+    N = lengths.sum()
+
+    # Read sort variable even if not merged (last in list)
+    rvars = [v for v in vnames if v != sortvar] + [sortvar]
+    i_var = [rvars.index(v) for v in vnames]
+
+    nrows = max(BLOCK // len(ifiles), MINROWS)  # rows per input buffer
+
+    n_read = np.zeros(len(ifiles), dtype='i8')  # rows read per input
+    buffers = [None] * len(ifiles)
+    last = [[] for f in ifiles]  # last value read per input
+
+    def refill(j):
+        """ Read next rows of input j, checking they are sorted. """
+        i1, i2 = n_read[j], min(n_read[j] + nrows, lengths[j])
+        with h5py.File(ifiles[j], 'r') as fi:
+            data = [fi[k][i1:i2] for k in rvars]
+        t = data[-1]
+        if np.any(np.diff(np.append(last[j], t)) < 0):
+            raise ValueError('input not sorted by %s: %s' % (sortvar, ifiles[j]))
+        buffers[j] = data
+        last[j] = t[-1:]
+        n_read[j] = i2
+
+    with h5py.File(ofile, 'w') as f:
+
+        dsets = create_dsets(f, vnames, dtypes, shapes, N, comp, chunk)
+
+        for j in range(len(ifiles)):
+            if lengths[j] > 0: refill(j)
+
+        k = 0  # output row
+
+        while k < N:
+
+            # Inputs with rows in buffer
+            jj = [j for j in range(len(ifiles))
+                  if buffers[j] is not None and len(buffers[j][-1]) > 0]
+
+            # Rows up to this value can be written (no smaller value left)
+            tmax = min([buffers[j][-1][-1] for j in jj
+                        if n_read[j] < lengths[j]] or [np.inf])
+
+            chunks = []
+
+            for j in jj:
+                n = np.searchsorted(buffers[j][-1], tmax, side='right')
+                chunks.append([d[:n] for d in buffers[j]])
+                buffers[j] = [d[n:] for d in buffers[j]]
+
+                if len(buffers[j][-1]) == 0 and n_read[j] < lengths[j]:
+                    refill(j)
+
+            # Sort rows of all inputs (stable) and write
+            data = [np.concatenate(d) for d in zip(*chunks)]
+            i_sort = np.argsort(data[-1], kind='mergesort')
+            n = len(i_sort)
+
+            for ds, i in zip(dsets, i_var): ds[k:k+n] = data[i][i_sort]
+
+            k += n
+
+
 # Pass command-line arguments
 parser = argparse.ArgumentParser(
         description='Merge tiles in time keeping the original tiling.')
@@ -79,12 +266,42 @@ parser.add_argument(
         help=('number of jobs for parallel processing'),
         default=[1],)
 
+parser.add_argument(
+        '-t', metavar='nthreads', dest='nthreads', type=int, nargs=1,
+        help=('number of threads to scan input files'),
+        default=[8],)
+
+parser.add_argument(
+        '-c', metavar='chunk', dest='chunk', type=int, nargs=1,
+        help=('number of rows per HDF5 chunk of merged tiles'),
+        default=[CHUNK],)
+
+parser.add_argument(
+        '-z', metavar=None, dest='comp', type=str, nargs=1,
+        help=('compress merged tiles'),
+        choices=('lzf', 'gzip'), default=[None],)
+
+parser.add_argument(
+        '-s', metavar='sortvar', dest='sortvar', type=str, nargs=1,
+        help=('merge tiles sorted by `sortvar` into sorted tiles'),
+        default=[None],)
+
+parser.add_argument(
+        '--virtual', dest='virtual', action='store_true',
+        help=('merge into virtual datasets (no copy of the data)'),
+        default=False)
+
 # Global variables
 args = parser.parse_args()
 ifiles = args.files[:]
 ofile = args.ofile[0]
 vnames = args.vnames[:]
 njobs = args.njobs[0]
+nthreads = args.nthreads[0]
+chunk = args.chunk[0]
+comp = args.comp[0]
+sortvar = args.sortvar[0]
+virtual = args.virtual
 
 # If single string with multiple paths
 if len(ifiles) == 1:
@@ -117,49 +334,32 @@ def main(tile_num, files, ofile):
     ofile = add_suffix(ofile, suffix='_'+tile_num) 
 
     print(('merging tile:', tile_num, '(%d files)' % len(files), '...'))
-    
-    with h5py.File(ofile, 'w') as f:
-    
-        # Create resizable output file using info from first input file
-        file0 = files.pop(0)
-        print(file0)
-        
-        # Merge specific vars if given, otherwise merge all
-        with h5py.File(file0, 'r') as f2:
-            maxshape = (None,) + list(f2.values())[0].shape[1:]
-            variables = vnames if vnames else list(f2.keys())
-            [f.create_dataset(k, data=f2[k], maxshape=maxshape) \
-                    for k in variables]
-    
-        # Iterate over the remaining input files
-        for ifile in files:
-    
-            print(ifile)
-    
-            f2 = h5py.File(ifile)
-            length_next = list(f2.values())[0].shape[0]  # first var
-            length = list(f.values())[0].shape[0]
-    
-            for key in variables:
-                # Resize the datasets to accommodate next chunk
-                f[key].resize(length + length_next, axis=0)
-    
-                # Write next chunk
-                f[key][length:] = f2[key]
-                f.flush()
-    
-            f2.close()
-            length += length_next
-    
+
+    # Map rows of input files, no copy
+    if virtual:
+        merge_virtual(files, ofile, vnames, nthreads)
+        print(('out ->', ofile))
+        return
+
+    # Streaming k-way merge of sorted tiles
+    if sortvar:
+        merge_sorted(files, ofile, vnames, sortvar, comp, chunk, nthreads)
+    else:
+        merge(files, ofile, vnames, comp, chunk, nthreads)
+
     print(('out ->', ofile))
 
 
+# Schedule largest tiles first (total size of input files)
+tiles = sorted(list(tiles.items()),
+               key=lambda kf: -sum(os.path.getsize(f) for f in kf[1]))
+
 if njobs == 1:
     print('Running sequential code ...')
-    [main(k,fs,ofile) for k,fs in list(tiles.items())]
+    [main(k,fs,ofile) for k,fs in tiles]
 
 else:
     print(('Running parallel code (%d jobs) ...' % njobs))
     from joblib import Parallel, delayed
     Parallel(n_jobs=njobs, verbose=5)(
-            delayed(main)(k,fs,ofile) for k,fs in list(tiles.items()))
+            delayed(main)(k,fs,ofile) for k,fs in tiles)
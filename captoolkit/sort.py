@@ -3,41 +3,249 @@
 Sort (in place) all 1d variables in HDF5 file(s).
 
 Args:
-    varname: name of variable to use for sorting.
-    file: file(s) to sort. 
+    varname: name of variable(s) to use for sorting, comma separated
+        for a compound key (primary first). The name 'morton' stands for
+        the Morton code (Z-order) of the coordinates given with -x.
+    file: file(s) to sort.
 
 Example:
     sorttime.py varname file1 file2 ...
+    sort.py orbit,t_year file1 file2 ...
+    sort.py tile,morton file1 -x lon lat -n 1000000
+
+Notes:
+    Files larger than -n rows are sorted out of core (external sort):
+    runs of -n rows are sorted in memory and written to a temporary file,
+    then all runs are merged back into the file. Only about 2 x -n rows
+    (of all variables) are held in memory, and all I/O is sequential.
 
 """
-import sys
+import os
 import h5py
+import argparse
 import numpy as np
 
+# Number of rows (of all variables) sorted in memory per run
+NROWS = 2**22
+
+# Minimum number of rows per run buffer when merging runs
+MINROWS = 2**12
+
+
+def get_args():
+    """ Pass command-line arguments. """
+    parser = argparse.ArgumentParser(
+            description='Sort (in place) all 1d variables in HDF5 file(s).')
+    parser.add_argument(
+            'varname', metavar='varname', type=str,
+            help=('var(s) to sort by, comma separated (primary first)'))
+    parser.add_argument(
+            'files', metavar='file', type=str, nargs='+',
+            help='HDF5 file(s) to sort')
+    parser.add_argument(
+            '-x', metavar=('xvar', 'yvar'), dest='xyvar', type=str, nargs=2,
+            help=('coordinate vars for the Morton code (key "morton")'),
+            default=['lon', 'lat'],)
+    parser.add_argument(
+            '-n', metavar='nrows', dest='nrows', type=int, nargs=1,
+            help=('number of rows to sort in memory (per run)'),
+            default=[NROWS],)
+    return parser.parse_args()
+
+
+def part1by1(x):
+    """ Spread the lower 32 bits of x to the even bits (uint64). """
+    x = x.astype('u8') & np.uint64(0x00000000FFFFFFFF)
+    x = (x | (x << np.uint64(16))) & np.uint64(0x0000FFFF0000FFFF)
+    x = (x | (x << np.uint64(8))) & np.uint64(0x00FF00FF00FF00FF)
+    x = (x | (x << np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    x = (x | (x << np.uint64(2))) & np.uint64(0x3333333333333333)
+    x = (x | (x << np.uint64(1))) & np.uint64(0x5555555555555555)
+    return x
+
+
+def morton(x, y, bounds):
+    """ Morton code (Z-order) of x/y quantized to 32 bits within bounds. """
+    xmin, xmax, ymin, ymax = bounds
+    qmax = 2**32 - 1
+
+    def quantize(v, vmin, vmax):
+        v = (v - vmin) / ((vmax - vmin) or 1) * qmax
+        return np.nan_to_num(v, nan=qmax).clip(0, qmax)
+
+    return (part1by1(quantize(x, xmin, xmax)) |
+            (part1by1(quantize(y, ymin, ymax)) << np.uint64(1)))
+
+
+def get_bounds(f, xyvar, nrows):
+    """ Get min/max of x/y vars reading in blocks of rows. """
+    x, y = f[xyvar[0]], f[xyvar[1]]
+    bounds = [np.inf, -np.inf, np.inf, -np.inf]
+
+    for k in range(0, x.shape[0], nrows):
+        xk, yk = x[k:k+nrows], y[k:k+nrows]
+        if np.all(np.isnan(xk)) or np.all(np.isnan(yk)): continue
+        bounds = [min(bounds[0], np.nanmin(xk)), max(bounds[1], np.nanmax(xk)),
+                  min(bounds[2], np.nanmin(yk)), max(bounds[3], np.nanmax(yk))]
 
-def sort_file(fname, varname):
-    """ 
+    return bounds
+
+
+def get_keys(f, keys, i1, i2, xyvar=None, bounds=None):
+    """ Read sort keys for rows i1:i2 (primary first). """
+    out = []
+    for key in keys:
+        if key == 'morton':
+            out.append(morton(f[xyvar[0]][i1:i2], f[xyvar[1]][i1:i2], bounds))
+        else:
+            out.append(f[key][i1:i2])
+    return out
+
+
+def argsort_keys(keys):
+    """ Indices that sort compound keys (primary first), stable. """
+    return np.lexsort(keys[::-1])
+
+
+def sort_file(fname, varname, xyvar=('lon', 'lat'), nrows=NROWS):
+    """
     Sort all 1d variables in an HDF5.
 
     Args:
-        fname: HDF5 file with equal lenght 1d variables. 
-        varname: name of variable to use for sorting.
+        fname: HDF5 file with equal lenght 1d variables.
+        varname: name of variable(s) to use for sorting, comma separated
+            for a compound key (primary first), 'morton' for Morton code.
+        xyvar: name of coordinate variables for the Morton code.
+        nrows: number of rows to sort in memory (larger files are sorted
+            out of core).
     """
+    keys = varname.split(',') if isinstance(varname, str) else list(varname)
+
     with h5py.File(fname, 'a') as f:
 
-        # Sort time 
-        i_sort = f[varname][:].argsort()
+        # Length from first key
+        key0 = xyvar[0] if keys[0] == 'morton' else keys[0]
+        N = f[key0].shape[0]
+
+        # Variables to sort (all of the same length)
+        variables = [k for k, d in f.items() if d.shape[:1] == (N,)]
+
+        bounds = get_bounds(f, xyvar, nrows) if 'morton' in keys else None
+
+        # Sort in memory
+        if N <= nrows:
+            i_sort = argsort_keys(get_keys(f, keys, 0, N, xyvar, bounds))
+
+            for var in variables:
+                f[var][:] = f[var][:][i_sort]
+
+            return
 
-        for var in list(f.values()):
-            var[:] = var[:][i_sort]
+        # Sort out of core
+        runsfile = os.path.splitext(fname)[0] + '_RUNS.h5'
+
+        try:
+            sort_runs(f, runsfile, keys, variables, N, nrows, xyvar, bounds)
+        finally:
+            if os.path.exists(runsfile): os.remove(runsfile)
+
+
+def sort_runs(f, runsfile, keys, variables, N, nrows, xyvar, bounds):
+    """
+    External sort: write sorted runs of 'nrows' to 'runsfile' and merge
+    them back into 'f' (k-way merge, bounded memory).
+    """
+    runs = list(range(0, N, nrows))
+    ends = [min(r + nrows, N) for r in runs]
+    knames = ['_key_%d' % i for i in range(len(keys))]
+
+    with h5py.File(runsfile, 'w') as fr:
+
+        # Sorted runs (keys stored along the variables)
+        for r1, r2 in zip(runs, ends):
+
+            kk = get_keys(f, keys, r1, r2, xyvar, bounds)
+            i_sort = argsort_keys(kk)
+
+            for name, k in zip(knames, kk):
+                if name not in fr:
+                    fr.create_dataset(name, (N,), dtype=k.dtype)
+                fr[name][r1:r2] = k[i_sort]
+
+            for var in variables:
+                d = f[var]
+                if var not in fr:
+                    fr.create_dataset(var, d.shape, dtype=d.dtype)
+                fr[var][r1:r2] = d[r1:r2][i_sort]
+
+        # Merge runs back into file
+        names = knames + variables
+        nk = len(knames)
+        bufrows = max(nrows // len(runs), MINROWS)
+
+        n_read = list(runs)  # next row to read per run
+        buffers = [None] * len(runs)
+
+        def refill(j):
+            """ Read next rows of run j. """
+            i1, i2 = n_read[j], min(n_read[j] + bufrows, ends[j])
+            buffers[j] = [fr[name][i1:i2] for name in names]
+            n_read[j] = i2
+
+        for j in range(len(runs)):
+            refill(j)
+
+        k = 0  # output row
+
+        while k < N:
+
+            # Runs with rows in buffer, and runs not fully read
+            jj = [j for j in range(len(runs)) if len(buffers[j][0]) > 0]
+            jr = [j for j in jj if n_read[j] < ends[j]]
+
+            # Keys of all buffered rows, and buffer of each row
+            kk = [np.concatenate([buffers[j][i] for j in jj])
+                  for i in range(nk)]
+            nb = np.array([len(buffers[j][0]) for j in jj])
+            i_buf = np.repeat(np.arange(len(jj)), nb)
+            i_sort = argsort_keys(kk)
+
+            # Rows up to the smallest last row of runs not fully read
+            # (no smaller row left to read), a prefix of each buffer
+            if jr:
+                i_last = (np.cumsum(nb) - 1)[[jj.index(j) for j in jr]]
+                i_min = i_last[argsort_keys([k_[i_last] for k_ in kk])[0]]
+                n = np.where(i_sort == i_min)[0][0] + 1
+            else:
+                n = len(i_sort)
+
+            counts = np.bincount(i_buf[i_sort[:n]], minlength=len(jj))
+
+            # Rows taken from each buffer, in output order
+            data = [np.concatenate([buffers[j][i][:c]
+                                    for j, c in zip(jj, counts)])
+                    for i in range(len(names))]
+            i_out = argsort_keys(data[:nk])
+
+            for var, d in zip(variables, data[nk:]):
+                f[var][k:k+n] = d[i_out]
+
+            k += n
+
+            for j, c in zip(jj, counts):
+                buffers[j] = [d[c:] for d in buffers[j]]
+                if len(buffers[j][0]) == 0 and n_read[j] < ends[j]:
+                    refill(j)
 
 
 if __name__ == "__main__":
 
-    varname = sys.argv[1]
-    files = sys.argv[2:]
+    args = get_args()
+    varname = args.varname
+    files = args.files
+    xyvar = args.xyvar
+    nrows = args.nrows[0]
 
     for fname in files:
         print(('sorting file:', fname, '...'))
-        sort_file(fname, varname)
-
+        sort_file(fname, varname, xyvar, nrows)
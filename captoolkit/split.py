@@ -4,11 +4,22 @@ Splits large 1d HDF5 file(s) into smaller ones.
 Example:
 
     python split.py file.h5 -k 16
+    python split.py file.h5 -k 16 -v orbit
+    python split.py file.h5 -k 8 -v t_year -d 1
 
 To see available options:
 
     python split.py -h
 
+With -v the file is split by the values of a key variable (e.g. orbit,
+cycle, tile), so all rows with the same key (e.g. a whole track) go to the
+same output. Consecutive key values are assigned to the same output with
+(approximately) balanced sizes. With -d the key is binned first (e.g. -v
+t_year -d 1 for whole years).
+
+The input is read once, in blocks of rows, and each block is written to
+all outputs it falls in (-t threads).
+
 Also see complementary program: 'merge.py'
 
 """
@@ -17,6 +28,7 @@ import sys
 import h5py
 import argparse
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
 
 # Default number of smaller files to split to
@@ -25,6 +37,9 @@ KFILES = 2
 # Default njobs for sequential/parallel run
 NJOBS = 1
 
+# Number of rows per block read from input
+BLOCK = 2**20
+
 
 # Pass command-line arguments
 parser = argparse.ArgumentParser(
@@ -44,48 +59,120 @@ parser.add_argument(
         default=[NJOBS],
         help=('number of jobs for parallel processing (-n 1)'))
 
+parser.add_argument(
+        '-v', metavar='key', dest='key', type=str, nargs=1,
+        default=[None],
+        help=('split by values of key variable (e.g. orbit), keep them whole'))
+
+parser.add_argument(
+        '-d', metavar='dkey', dest='dkey', type=float, nargs=1,
+        default=[None],
+        help=('bin width of key values (e.g. -v t_year -d 1 for years)'))
+
+parser.add_argument(
+        '-t', metavar='nthreads', dest='nthreads', type=int, nargs=1,
+        default=[8],
+        help=('number of threads to write output files (-t 8)'))
+
 # Global variables
 args = parser.parse_args()
 files = args.files
 nfiles = args.nfiles[0]
 njobs = args.njobs[0]
+key = args.key[0]
+dkey = args.dkey[0]
+nthreads = args.nthreads[0]
 
 
 def partition(length, parts):
     """Partitions 'length' into (approximately) equal 'parts'."""
-    sublengths = [length/parts] * parts
+    sublengths = [length//parts] * parts
     for i in range(length % parts):  # treatment of remainder
         sublengths[i] += 1
     return sublengths
 
 
+def partition_by_key(keys, parts, dkey=None):
+    """
+    Partitions rows into 'parts' keeping rows with same key together.
+
+    Consecutive (sorted) key values are assigned to the same part, with
+    (approximately) balanced number of rows. Returns part of each row.
+    """
+    if dkey: keys = np.floor(keys / dkey)
+
+    values, i_value, counts = np.unique(keys, return_inverse=True,
+                                        return_counts=True)
+
+    # Part of each key value from the rows before its middle
+    middle = np.cumsum(counts) - 0.5 * counts
+    part = np.minimum((middle * parts / len(keys)).astype(int), parts - 1)
+
+    # Remove empty parts (fewer key values than parts)
+    part = np.unique(part, return_inverse=True)[1]
+
+    return part[i_value.ravel()]
+
+
+def write_rows(dsets, data, rows, i1):
+    """ Write rows of block 'data' (list of arrays) at row 'i1'. """
+    for ds, d in zip(dsets, data):
+        ds[i1:i1+len(rows)] = d[rows]
+
+
 def main(infile):
 
     print(('input <- ', infile))
 
-    with h5py.File(infile) as f:
+    with h5py.File(infile, 'r') as f:
+
+        variables = list(f.keys())
 
         # Determine the total legth of input file
         total_legth = list(f.values())[0].shape[0]
 
+        # Determine the output file of each row
+        if key:
+            part = partition_by_key(f[key][:], nfiles, dkey)
+        else:
+            part = np.repeat(np.arange(nfiles),
+                             partition(total_legth, nfiles))
+
         # Determine the length of output files
-        lengths = partition(total_legth, nfiles)
+        lengths = np.bincount(part)
 
         # Determine the names of output files
         fname = os.path.splitext(infile)[0] + '_%03d.h5'
         outfiles = [(fname % k) for k in range(len(lengths))]
 
-        i1, i2 = 0, 0
-        for outfile, length in zip(outfiles, lengths):
+        fo = [h5py.File(outfile, 'w') for outfile in outfiles]
+
+        # Create output containers with their final length
+        dsets = [[f2.create_dataset(k, (n,) + f[k].shape[1:], f[k].dtype)
+                  for k in variables] for f2, n in zip(fo, lengths)]
+
+        n_out = np.zeros(len(lengths), dtype=int)  # rows written per output
+
+        # Read input once, write each block to the output(s) it falls in
+        with ThreadPoolExecutor(nthreads) as pool:
+
+            for i1 in range(0, total_legth, BLOCK):
+
+                data = [f[k][i1:i1+BLOCK] for k in variables]
+                part_ = part[i1:i1+BLOCK]
+
+                jobs = []
 
-            i2 += length
+                for k in np.unique(part_):
+                    rows, = np.where(part_ == k)
+                    jobs.append(pool.submit(write_rows, dsets[k], data,
+                                            rows, n_out[k]))
+                    n_out[k] += len(rows)
 
-            # Save chunks of each variable from f -> f2 
-            with h5py.File(outfile, 'w') as f2:
-                for key in list(f.keys()):
-                    f2[key] = f[key][i1:i2]
+                [job.result() for job in jobs]
 
-            i1 = i2
+        for f2, outfile in zip(fo, outfiles):
+            f2.close()
             print(('output ->', outfile))
 
 
@@ -6,11 +6,27 @@ Takes as input tile size, overlap (km), and projection used to make
 the tiles (EPSG-format).
 
 The code can deal with very-large files by reading/searching/saving
-in chunks from/to disk.
+in chunks from/to disk. Each file is read only once: the tile(s) of
+each point (including buffer duplicates) are computed once per chunk,
+and the chunk is appended to all its tiles.
 
 Large files may slowdown the tiling process, but it's "guarantee" to
 complete the tilling.
 
+With -i (indexed tiling) no tile files are created: each file is
+reordered by tile (*_TILED.h5) and an index with the row offset and
+bbox of each tile is saved (*_TILED_INDEX.h5). Tiles are then passed
+to the processing scripts as "file_TILED.h5:tile_num", and the buffer
+is read from the neighbouring tiles, so storage does not grow with
+the buffer size and outputs hold no duplicates (no join needed).
+
+With -a (adaptive tiling) tiles are split recursively (quadtree, up
+to maxlevel times) until each has at most max_pts points, counting
+the points of all files. The tile tree (number, parent, level, bbox
+and #points of each tile) is saved to a manifest, that fitsec.py,
+fittopo.py and xover.py use (--manifest) to process the largest
+tiles first. Child tiles are numbered after the uniform tiles.
+
 Notes:
     Bedmap boundaries: -b -3333000 3333000 -3333000 3333000
     Ross boundaries: -b -600000 410000 -1400000 -400000
@@ -40,6 +56,9 @@ from glob import glob
 # Optimal chunk size
 chunks = 100000
 
+# Max number of (quadtree) splits of a tile for adaptive tiling
+maxlevel = 4
+
 
 def get_args():
     """ Get command-line arguments. """
@@ -70,8 +89,23 @@ def get_args():
             default=['3031'],)
     parser.add_argument(
             '-n', metavar=('njobs'), dest='njobs', type=int, nargs=1,
-            help="for parallel writing of multiple tiles, optional",
+            help="for parallel tiling of multiple files, optional",
             default=[1],)
+    parser.add_argument(
+            '-i', dest='index', action='store_true',
+            help=('reorder file(s) by tile and save tile index, '
+                  'instead of tile files (use as "file:tile")'),
+            default=False)
+    parser.add_argument(
+            '-a', metavar=('max_pts'), dest='maxpts', type=int, nargs=1,
+            help=('adaptive tiling: split tiles (quadtree) until each '
+                  'has at most max_pts (all files), optional'),
+            default=[None],)
+    parser.add_argument(
+            '-m', metavar=('manifest'), dest='manifest', type=str, nargs=1,
+            help=('tile manifest for adaptive tiling (HDF5), '
+                  'default: tile_manifest.h5 next to the first file'),
+            default=[None],)
     return parser.parse_args()
 
 
@@ -102,8 +136,8 @@ def add_suffix(fname, suffix=''):
     return path + suffix + ext
 
 
-def get_tile_bboxs(grid_bbox, dxy):
-    """ Define bbox of tiles given bbox of grid and tile size. """
+def get_tile_edges(grid_bbox, dxy):
+    """ Define coord of tile edges given bbox of grid and tile size. """
     
     xmin, xmax, ymin, ymax = grid_bbox
 
@@ -114,6 +148,14 @@ def get_tile_bboxs(grid_bbox, dxy):
     # Coord of tile edges for each dimension
     xg = np.linspace(xmin, xmax, New)
     yg = np.linspace(ymin, ymax, Nns)
+
+    return xg, yg
+
+
+def get_tile_bboxs(grid_bbox, dxy):
+    """ Define bbox of tiles given bbox of grid and tile size. """
+    
+    xg, yg = get_tile_edges(grid_bbox, dxy)
     
     # Vector of bbox for each tile   ##NOTE: Nested loop!
     bboxs = [(w,e,s,n) for w,e in zip(xg[:-1], xg[1:]) 
@@ -123,10 +165,205 @@ def get_tile_bboxs(grid_bbox, dxy):
     return bboxs
 
 
-def get_tile_data(ifile, x, y, bbox, buff=1, proj='3031', tile_num=0):
-    """ Extract data within bbox and save to individual file. """
+def get_tile_ids(x, y, xg, yg, buff=1):
+    """
+    Get the tile(s) of each point, including buffer duplicates.
+
+    Tiles are defined by their edges (xg, yg) and numbered as in
+    get_tile_bboxs (from 0). Returns (point, tile) index pairs sorted
+    by tile, and by point within each tile.
+    """
+    nx, ny = len(xg) - 1, len(yg) - 1
+
+    # Range of candidate tiles for each point (one extra on each side)
+    jx = np.clip(np.searchsorted(xg, x - buff) - 2, 0, nx - 1)
+    jy = np.clip(np.searchsorted(yg, y - buff) - 2, 0, ny - 1)
+    kx = np.clip(np.searchsorted(xg, x + buff) + 1, 0, nx - 1)
+    ky = np.clip(np.searchsorted(yg, y + buff) + 1, 0, ny - 1)
+
+    i_pts, i_tiles = [], []
+
+    for dx in range(np.max(kx - jx, initial=0) + 1):
+        for dy in range(np.max(ky - jy, initial=0) + 1):
+
+            ix, iy = np.minimum(jx + dx, nx - 1), np.minimum(jy + dy, ny - 1)
+
+            # Same test as for a single tile bbox
+            idx, = np.where( (jx + dx <= kx) & (jy + dy <= ky) &
+                             (x >= xg[ix]-buff) & (x <= xg[ix+1]+buff) &
+                             (y >= yg[iy]-buff) & (y <= yg[iy+1]+buff) )
+
+            i_pts.append(idx)
+            i_tiles.append(ix[idx] * ny + iy[idx])
+
+    i_pts, i_tiles = np.concatenate(i_pts), np.concatenate(i_tiles)
+
+    i_sort = np.lexsort((i_pts, i_tiles))
+
+    return i_pts[i_sort], i_tiles[i_sort]
+
+
+def get_tile_tree(ifiles, grid_bbox, dxy, max_pts, vnames=['lon', 'lat'],
+                  proj='3031'):
+    """
+    Split tiles recursively (quadtree) until each has at most max_pts.
+
+    Points of all files are counted once on the grid of the smallest
+    tiles (maxlevel splits), so all files get the same tiles. Nodes are
+    numbered from 0: first the tiles of get_tile_bboxs, then the child
+    tiles (w/s, w/n, e/s, e/n). Returns dict of node arrays.
+    """
+    xg, yg = get_tile_edges(grid_bbox, dxy)
+
+    nx, ny = len(xg) - 1, len(yg) - 1
+    m = 2 ** maxlevel
+
+    # Number of points in each of the smallest tiles
+    xf = np.linspace(xg[0], xg[-1], nx * m + 1)
+    yf = np.linspace(yg[0], yg[-1], ny * m + 1)
+
+    counts = np.zeros((nx * m + 1, ny * m + 1), 'i8')
+
+    for f in ifiles:
+        x, y = get_xy(f, vnames, proj)
+        counts[1:,1:] += np.histogram2d(x, y, bins=[xf, yf])[0].astype('i8')
+
+    # Cumulative counts, for the number of points of any node
+    counts = counts.cumsum(0).cumsum(1)
+
+    # Nodes as (x/y offset and size on the grid of smallest tiles)
+    nodes = [(ix*m, iy*m, m) for ix in range(nx) for iy in range(ny)]
+    bboxs = get_tile_bboxs(grid_bbox, dxy)
+    level = [0] * len(nodes)
+    parent = [-1] * len(nodes)
+    n_pts = []
+
+    k = 0
+    while k < len(nodes):
+
+        i, j, size = nodes[k]
+
+        n_pts.append(counts[i+size,j+size] - counts[i,j+size] -
+                     counts[i+size,j] + counts[i,j])
+
+        if n_pts[k] > max_pts and level[k] < maxlevel:
+
+            w, e, s, n = bboxs[k]
+            xm, ym, h = (w + e) / 2., (s + n) / 2., size // 2
+
+            nodes.extend([(i, j, h), (i, j+h, h), (i+h, j, h), (i+h, j+h, h)])
+            bboxs.extend([(w, xm, s, ym), (w, xm, ym, n),
+                          (xm, e, s, ym), (xm, e, ym, n)])
+            level.extend([level[k] + 1] * 4)
+            parent.extend([k] * 4)
+
+        k += 1
+
+    tree = {'parent': np.array(parent), 'level': np.array(level),
+            'bbox': np.array(bboxs), 'n_pts': np.array(n_pts)}
+
+    # Children of each node (-1 if leaf), and root tile of each node
+    child = np.full((len(nodes), 4), -1)
+    k, = np.where(tree['parent'] >= 0)
+    child[tree['parent'][k], np.arange(len(k)) % 4] = k
+
+    root = np.arange(len(nodes))
+    for _ in range(maxlevel):
+        root = np.where(tree['parent'][root] >= 0, tree['parent'][root], root)
+
+    tree.update(child=child, root=root, leaf=child[:,0] < 0)
+
+    return tree
+
+
+def save_manifest(fname, tree, buff=1, proj='3031'):
+    """ Save tile tree (nodes numbered from 1, parent=0 if none). """
+    with h5py.File(fname, 'w') as fo:
+        fo['tile_num'] = np.arange(len(tree['leaf'])) + 1
+        fo['parent'] = tree['parent'] + 1
+        fo['level'] = tree['level']
+        fo['bbox'] = tree['bbox']
+        fo['n_pts'] = tree['n_pts']
+        fo['leaf'] = tree['leaf']
+        fo.attrs['buff'] = buff
+        fo.attrs['proj'] = proj
+
+    leaf = tree['leaf']
+    print(('number of adaptive tiles:', int(leaf.sum()), '(max #points: %d)' %
+           tree['n_pts'][leaf].max(), '->', fname))
+
+
+def get_leaf_ids(x, y, i_pts, i_tiles, tree, buff=1):
+    """
+    Replace (point, tile) pairs of split tiles by (point, leaf) pairs.
+
+    The buffered bbox of a leaf is inside the one of its tile, so only
+    the points of the tile are tested. Returns pairs sorted as in
+    get_tile_ids, with node numbers of the tree.
+    """
+    split = ~tree['leaf'][i_tiles]
+
+    i_pts_, i_tiles_ = [i_pts[~split]], [i_tiles[~split]]
+
+    for t in np.unique(i_tiles[split]):
 
+        i_t = i_pts[i_tiles == t]
+
+        for k in np.flatnonzero(tree['leaf'] & (tree['root'] == t)):
+
+            w, e, s, n = tree['bbox'][k]
+
+            idx = i_t[ (x[i_t] >= w-buff) & (x[i_t] <= e+buff) &
+                       (y[i_t] >= s-buff) & (y[i_t] <= n+buff) ]
+
+            i_pts_.append(idx)
+            i_tiles_.append(np.full(len(idx), k))
+
+    i_pts, i_tiles = np.concatenate(i_pts_), np.concatenate(i_tiles_)
+
+    i_sort = np.lexsort((i_pts, i_tiles))
+
+    return i_pts[i_sort], i_tiles[i_sort]
+
+
+def get_leaf(x, y, i_tiles, tree):
+    """ Get leaf (node) containing each point, given its tile. """
+    i_node = i_tiles.copy()
+
+    for _ in range(maxlevel):
+
+        k, = np.where(~tree['leaf'][i_node])
+
+        w, e, s, n = tree['bbox'][i_node[k]].T
+
+        # Quadrant of point in node (as child order)
+        q = 2 * (x[k] >= (w + e) / 2.) + (y[k] >= (s + n) / 2.)
+
+        i_node[k] = tree['child'][i_node[k], q]
+
+    return i_node
+
+
+def get_tile_suffix(bbox, buff=1, proj='3031', tile_num=0):
+    """ Suffix of output file name for tile. """
     xmin, xmax, ymin, ymax = bbox
+    return ('_bbox_%d_%d_%d_%d_buff_%g_epsg_%s_tile_%03d' % \
+            (xmin, xmax, ymin, ymax, buff/1e3, proj, tile_num))
+
+
+def get_tiles_data(ifile, grid_bbox, dxy, buff=1, proj='3031',
+                   vnames=['lon', 'lat'], tree=None):
+    """
+    Extract data of all tiles and save to individual files.
+
+    Single pass over the file: the tile(s) of each point are computed
+    once per chunk, and the chunk is appended to each of its tiles.
+    If a tile tree is given (adaptive tiling), the tiles are its leaves.
+    """
+    xg, yg = get_tile_edges(grid_bbox, dxy)
+    bboxs = get_tile_bboxs(grid_bbox, dxy) if tree is None else tree['bbox']
+
+    x, y = get_xy(ifile, vnames, proj)
 
     # Open input file (out-of-core)
     fi = tb.open_file(ifile)
@@ -134,23 +371,21 @@ def get_tile_data(ifile, x, y, bbox, buff=1, proj='3031', tile_num=0):
     # Get all 1d variables into a list (out-of-core)
     points = [fi.get_node('/', v.name) for v in fi.list_nodes('/')]
 
-    npts = 0
+    npts = np.zeros(len(bboxs), 'i8')
     nrow = x.shape[0]
-    first_iter = True
 
     # Read and write in chunks
     for i in range(0, nrow, chunks):
 
         k = min(i+chunks, nrow)
 
-        x_chunk = x[i:k]
-        y_chunk = y[i:k]
+        # Get the (point, tile) pairs, sorted by tile
+        idx, i_tile = get_tile_ids(x[i:k], y[i:k], xg, yg, buff)
 
-        # Get the tile indices
-        idx, = np.where( (x_chunk >= xmin-buff) & (x_chunk <= xmax+buff) & 
-                         (y_chunk >= ymin-buff) & (y_chunk <= ymax+buff) )
+        if tree is not None:
+            idx, i_tile = get_leaf_ids(x[i:k], y[i:k], idx, i_tile, tree, buff)
         
-        # Leave chunk if outside tile
+        # Leave chunk if outside all tiles
         if len(idx) == 0: continue
 
         # Get chunk of data in-memory, and
@@ -158,37 +393,120 @@ def get_tile_data(ifile, x, y, bbox, buff=1, proj='3031', tile_num=0):
         points_chunk = [d[i:k] for d in points]  # -> list of 1d chunks
         points_chunk = [d[idx] for d in points_chunk]
 
-        # Create output file on first iteration
-        if first_iter:
+        tiles, i_first = np.unique(i_tile, return_index=True)
+        i_last = np.append(i_first[1:], len(i_tile))
 
-            # Define file name
-            suffix = ('_bbox_%d_%d_%d_%d_buff_%g_epsg_%s_tile_%03d' % \
-                     (xmin, xmax, ymin, ymax, buff/1e3, proj, tile_num))
+        for t, i1, i2 in zip(tiles, i_first, i_last):
+
+            suffix = get_tile_suffix(bboxs[t], buff, proj, t+1)
 
             ofile = add_suffix(ifile, suffix)
 
-            fo = tb.open_file(ofile, 'w')
+            # Create output file on first chunk of tile
+            with tb.open_file(ofile, 'a' if npts[t] else 'w') as fo:
 
-            # Initialize containers (lenght=0)
-            out = [fo.create_earray('/', v.name, tb.Float64Atom(), shape=(0,))
-                   for v in points]
+                if npts[t] == 0:
+                    # Initialize containers (lenght=0)
+                    out = [fo.create_earray('/', v.name, tb.Float64Atom(), shape=(0,))
+                           for v in points]
+                else:
+                    out = [fo.get_node('/', v.name) for v in points]
 
-            first_iter = False
-        
-        # Save chunk
-        [v.append(d) for v, d in zip(out, points_chunk)]
-        npts += points_chunk[0].shape[0]
+                # Save chunk
+                [v.append(d[i1:i2]) for v, d in zip(out, points_chunk)]
+
+            npts[t] += i2 - i1
 
-        fo.flush()
+    fi.close()
 
-    if npts != 0: print(('tile %03d: #points' % tile_num, npts, '...'))
+    for t in np.flatnonzero(npts):
+        print(('tile %03d: #points' % (t+1), npts[t], '...'))
 
-    try:
-        fo.close()
-    except:
-        pass
 
-    fi.close()
+def get_tiles_index(ifile, grid_bbox, dxy, buff=1, proj='3031',
+                    vnames=['lon', 'lat'], tree=None):
+    """
+    Reorder file by tile and save an index of the tiles (no tile files).
+
+    Each point is assigned to the single tile containing it (points in
+    the buffer outside the grid go to the closest tile, points further
+    away go last, to no tile). The rows of each tile are contiguous in
+    the output file, and the index holds per-tile row offset, number of
+    rows and bbox (for all tiles, or all leaves of the tile tree). The
+    buffer (halo) is not duplicated: it is selected from the neighbouring
+    tiles at read time ('file:tile' references).
+    """
+    xg, yg = get_tile_edges(grid_bbox, dxy)
+    bboxs = np.array(get_tile_bboxs(grid_bbox, dxy))
+
+    nx, ny = len(xg) - 1, len(yg) - 1
+
+    x, y = get_xy(ifile, vnames, proj)
+
+    # Tile containing each point (numbered as in get_tile_bboxs)
+    ix = np.clip(np.searchsorted(xg, x, 'right') - 1, 0, nx - 1)
+    iy = np.clip(np.searchsorted(yg, y, 'right') - 1, 0, ny - 1)
+    i_tile = ix * ny + iy
+
+    # Leaf containing each point (numbered as nodes of the tree)
+    if tree is not None:
+        i_tile = get_leaf(x, y, i_tile, tree)
+        bboxs = tree['bbox']
+
+    leaf = np.ones(len(bboxs), bool) if tree is None else tree['leaf']
+
+    # Points outside grid + buffer (or NaN) belong to no tile
+    i_out = ~( (x >= xg[0]-buff) & (x <= xg[-1]+buff) &
+               (y >= yg[0]-buff) & (y <= yg[-1]+buff) )
+    i_tile[i_out] = len(bboxs)
+
+    i_sort = np.argsort(i_tile, kind='stable')
+
+    # Rows of each tile (also empty ones, they may have buffer data)
+    n_rows = np.bincount(i_tile, minlength=len(bboxs)+1)[:-1]
+    i_start = np.cumsum(n_rows) - n_rows
+
+    ofile = add_suffix(ifile, '_TILED')
+
+    # Output row of next point of each tile (last: points in no tile)
+    i_next = np.append(i_start, n_rows.sum())
+
+    # Reorder in chunks: the points of a tile in a chunk (stable order)
+    # go to consecutive output rows, written as a single slab per tile
+    with h5py.File(ifile, 'r') as fi, h5py.File(ofile, 'w') as fo:
+
+        dsets = [(fi[v], fo.create_dataset(v, fi[v].shape, fi[v].dtype))
+                 for v in fi.keys()]
+
+        for i in range(0, len(i_tile), chunks):
+
+            k = min(i+chunks, len(i_tile))
+
+            i_chunk = np.argsort(i_tile[i:k], kind='stable')
+            tiles, i_first, n_pts = np.unique(i_tile[i:k][i_chunk],
+                                              return_index=True,
+                                              return_counts=True)
+
+            for d_in, d_out in dsets:
+
+                data = d_in[i:k][i_chunk]
+
+                for t, j, n in zip(tiles, i_first, n_pts):
+                    d_out[i_next[t]:i_next[t]+n] = data[j:j+n]
+
+            i_next[tiles] += n_pts
+
+    with h5py.File(add_suffix(ofile, '_INDEX'), 'w') as fo:
+        fo['tile_num'] = np.flatnonzero(leaf) + 1
+        fo['i_start'] = i_start[leaf]
+        fo['n_rows'] = n_rows[leaf]
+        fo['bbox'] = bboxs[leaf]
+        fo['row'] = i_sort              # original row of each row
+        fo.attrs['buff'] = buff
+        fo.attrs['proj'] = proj
+        fo.attrs['xvar'], fo.attrs['yvar'] = vnames
+
+    print(('tiles with data:', int(np.count_nonzero(n_rows)), '->', ofile))
 
 
 def count_files(ifiles, key='*tile*'):
@@ -207,38 +525,47 @@ bbox_ = args.bbox        # bounding box EPSG (m) or geographical (deg)
 dr = args.dr[0] * 1e3    # buffer (km -> m)
 dxy = args.dxy[0] * 1e3  # tile length (km -> m)
 proj = args.proj[0]      # EPSG proj number
-njobs = args.njobs[0]    # parallel writing
+njobs = args.njobs[0]    # parallel files
+index = args.index       # indexed tiling (no tile files)
+maxpts = args.maxpts[0]  # max points per tile (adaptive tiling)
+fmanifest = args.manifest[0]  # tile tree of adaptive tiling
 
 print_args(args)
 
 if len(ifiles) == 1: ifiles = glob(ifiles[0])  # pass str if "Argument list too long"
 
-# Generate list of items (only once!) for parallel proc
-print('generating list of tasks (files x tiles) ...')
-
-# NOTE: To avoid reprojecting coords (lon/lat -> x/y) several
-# times for each file (one conversion per tile), coordinates are
-# loaded into mem, converted once per file and passed to each worker.
+# NOTE: Each file is read only once: the tile(s) of each point
+# are computed once and all tiles are written in a single pass.
 
-bboxs = get_tile_bboxs(bbox_, dxy)                                       # [b1, b2..]
-xys = [get_xy(f, vnames, proj) for f in ifiles]                          # [(x1,y1), (x2,y2)..]
-fxys = [(f,x,y) for f,(x,y) in zip(ifiles, xys)]                         # [(f1,x1,y1), (f2,x2,y2)..]
-fxybs = [(f,x,y,b,n+1) for (f,x,y) in fxys for n,b in enumerate(bboxs)]  # [(f1,x1,y1,b1,1), (f1,x1,y1,b2,2)..]
+bboxs = get_tile_bboxs(bbox_, dxy)
 
 print(('number of files:', len(ifiles)))
 print(('number of tiles:', len(bboxs)))
-print(('number of tasks:', len(fxybs)))
 
-# NOTE: For each bbox scan full file
+# Adaptive tiling: same tile tree (saved to manifest) for all files
+if maxpts:
+    tree = get_tile_tree(ifiles, bbox_, dxy, maxpts, vnames, proj)
+
+    if fmanifest is None:
+        fmanifest = os.path.join(os.path.dirname(ifiles[0]),
+                                 'tile_manifest.h5')
+
+    save_manifest(fmanifest, tree, dr, proj)
+else:
+    tree = None
+
+tiler = get_tiles_index if index else get_tiles_data
 
 if njobs == 1:
     print('running sequential code ...')
-    [get_tile_data(f, x, y, b, dr, proj, n) for f,x,y,b,n in fxybs]
+    [tiler(f, bbox_, dxy, dr, proj, vnames, tree) for f in ifiles]
 
 else:
     print(('running parallel code (%d jobs) ...' % njobs))
     from joblib import Parallel, delayed
     Parallel(n_jobs=njobs, verbose=5)(
-            delayed(get_tile_data)(f, x, y, b, dr, proj, n) for f,x,y,b,n in fxybs)  
+            delayed(tiler)(f, bbox_, dxy, dr, proj, vnames, tree)
+            for f in ifiles)
 
-print(('number of tiles with data:', count_files(ifiles)))
+if not index:
+    print(('number of tiles with data:', count_files(ifiles)))
@@ -2,12 +2,22 @@
 High-level functions used across the CAP-Toolkit package.
 
 """
+import os
+import json
+import zlib
 import h5py
 import pyproj
 import numpy as np
 import pandas as pd
 import xarray as xr
 from scipy import signal
+from concurrent.futures import ThreadPoolExecutor
+
+# Extension of directory-of-chunks column stores (see save_h5)
+STORE_EXT = ".chunks"
+
+# Default number of rows per chunk of column stores
+CHUNK = 2 ** 16
 
 
 # --- Utilitiy functions --- #
@@ -20,26 +30,276 @@ def print_args(args):
         print(arg)
 
 
-def read_h5(fname, vnames):
-    """Generic HDF5 reader.
+def is_store(fname):
+    """Test if file name is a directory-of-chunks column store."""
+    return fname.endswith(STORE_EXT) or os.path.isdir(fname)
 
-    vnames : ['var1', 'var2', 'var3']
+
+def _read_meta(fname):
+    with open(os.path.join(fname, "meta.json")) as f:
+        return json.load(f)
+
+
+def _write_meta(fname, meta):
+    with open(os.path.join(fname, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+
+def _chunk_file(fname, vname, k):
+    return os.path.join(fname, vname, "%06d.bin" % k)
+
+
+def _read_chunk(fname, vname, k, meta):
+    """Read and decompress chunk k of column in store."""
+    col = meta["columns"][vname]
+
+    with open(_chunk_file(fname, vname, k), "rb") as f:
+        buf = f.read()
+
+    if meta["compression"]:
+        buf = zlib.decompress(buf)
+
+    return np.frombuffer(buf, col["dtype"]).reshape((-1,) + tuple(col["shape"]))
+
+
+def _write_chunk(fname, vname, k, data, compression, level=1):
+    """Compress and write chunk k of column in store."""
+    buf = np.ascontiguousarray(data).tobytes()
+
+    if compression:
+        buf = zlib.compress(buf, level)
+
+    with open(_chunk_file(fname, vname, k), "wb") as f:
+        f.write(buf)
+
+
+def _chunk_stats(data):
+    """Min/max of a chunk (NaN if not numeric or all NaN)."""
+    if data.dtype.kind not in "iuf" or data.size == 0 or np.all(np.isnan(data)):
+        return np.nan, np.nan
+
+    return float(np.nanmin(data)), float(np.nanmax(data))
+
+
+def _get_rows(nrows, rows):
+    """Row range (i1, i2) from None or (i1, i2) with None for open ends."""
+    i1, i2 = rows if rows is not None else (None, None)
+
+    return slice(i1, i2).indices(nrows)[:2]
+
+
+def _read_store(fname, vnames, rows=None, where=None, nthreads=1):
+    """Read columns of store (see read_h5)."""
+    meta = _read_meta(fname)
+    chunk = meta["chunk"]
+    i1, i2 = _get_rows(meta["nrows"], rows)
+
+    # Chunks in row range, skipping chunks outside predicate (min/max)
+    chunks = list(range(i1 // chunk, (i2 - 1) // chunk + 1)) if i2 > i1 else []
+
+    for v, (vmin, vmax) in (where or {}).items():
+        cmin, cmax = meta["columns"][v]["min"], meta["columns"][v]["max"]
+        chunks = [k for k in chunks if not (cmax[k] < vmin or cmin[k] > vmax)]
+
+    names = list(vnames) + [v for v in (where or {}) if v not in vnames]
+
+    # Read and decompress chunks in parallel
+    with ThreadPoolExecutor(nthreads) as pool:
+        jobs = dict(
+            ((v, k), pool.submit(_read_chunk, fname, v, k, meta))
+            for v in names
+            for k in chunks
+        )
+
+    data = {}
+
+    for v in names:
+        col = meta["columns"][v]
+        parts = [
+            jobs[(v, k)].result()[max(i1 - k * chunk, 0) : i2 - k * chunk]
+            for k in chunks
+        ]
+        data[v] = (
+            np.concatenate(parts)
+            if parts
+            else np.empty((0,) + tuple(col["shape"]), col["dtype"])
+        )
+
+    return data
+
+
+def _read_dataset(ds, i1, i2, nthreads=1):
+    """
+    Read rows i1:i2 of HDF5 dataset.
+
+    Gzip-chunked datasets (chunks spanning full rows, no other filters)
+    are read as raw chunks and decompressed in parallel threads.
     """
+    parallel = (
+        nthreads > 1
+        and ds.chunks is not None
+        and ds.compression == "gzip"
+        and not ds.shuffle
+        and not ds.fletcher32
+        and ds.scaleoffset is None
+        and ds.chunks[1:] == ds.shape[1:]
+        and ds.dtype.kind in "iuf"
+        and i2 > i1
+    )
+
+    if not parallel:
+        return ds[i1:i2]
+
+    chunk = ds.chunks[0]
+    chunks = range(i1 // chunk, (i2 - 1) // chunk + 1)
+    zeros = (0,) * (ds.ndim - 1)
+
+    def read(k):
+        try:
+            mask, buf = ds.id.read_direct_chunk((k * chunk,) + zeros)
+        except Exception:
+            # Chunk not allocated (fill value), read through HDF5
+            return ds[k * chunk : (k + 1) * chunk]
+
+        return mask, buf
+
+    def decompress(item):
+        if not isinstance(item, tuple):
+            return item
+
+        mask, buf = item
+        buf = buf if mask & 1 else zlib.decompress(buf)
+
+        return np.frombuffer(buf, ds.dtype).reshape((-1,) + ds.shape[1:])
+
+    # Raw chunk reads are serialized by HDF5, decompression is not
+    raw = [read(k) for k in chunks]
+
+    with ThreadPoolExecutor(nthreads) as pool:
+        parts = list(pool.map(decompress, raw))
+
+    data = np.concatenate(parts)
+    i0 = chunks[0] * chunk
+
+    return data[i1 - i0 : i2 - i0]
+
+
+def _read_hdf5(fname, vnames, rows=None, where=None, nthreads=1):
+    """Read columns of HDF5 file (see read_h5)."""
     with h5py.File(fname, "r") as f:
-        variables = [f[v][()] for v in vnames]
+        names = list(vnames) + [v for v in (where or {}) if v not in vnames]
+
+        # Scalars and n-d grids are read whole
+        if rows is None and where is None:
+            return dict((v, f[v][()]) for v in names)
+
+        i1, i2 = _get_rows(f[names[0]].shape[0], rows)
+
+        return dict((v, _read_dataset(f[v], i1, i2, nthreads)) for v in names)
+
+
+def read_h5(fname, vnames, rows=None, where=None, nthreads=1):
+    """Generic HDF5 (or column store) reader.
+
+    vnames : ['var1', 'var2', 'var3']
+    rows : (i1, i2) to read row range only (None for open ends)
+    where : {'var': (vmin, vmax)} to read rows within range(s) only
+    nthreads : number of threads to decompress chunks
+
+    Reads HDF5 files, or directory-of-chunks column stores (STORE_EXT),
+    only the requested columns (and predicate vars). Store chunks
+    outside the predicate ranges (chunk min/max) are not read.
+    """
+    read = _read_store if is_store(fname) else _read_hdf5
+
+    data = read(fname, vnames, rows, where, nthreads)
 
-        return variables if len(vnames) > 1 else variables[0]
+    # Apply predicate
+    if where:
+        mask = np.ones(len(data[vnames[0]]), dtype=bool)
 
+        for v, (vmin, vmax) in where.items():
+            mask &= (data[v] >= vmin) & (data[v] <= vmax)
 
-def save_h5(fname, vardict, mode="a"):
-    """Generic HDF5 writer.
+        data = dict((v, d[mask]) for v, d in data.items())
+
+    variables = [data[v] for v in vnames]
+
+    return variables if len(vnames) > 1 else variables[0]
+
+
+def _save_store(fname, vardict, mode="a", chunks=None, compression=None, nthreads=1):
+    """Write columns to store (see save_h5)."""
+    meta_file = os.path.join(fname, "meta.json")
+
+    if mode == "w" or not os.path.exists(meta_file):
+        meta = {"nrows": None, "chunk": chunks or CHUNK,
+                "compression": compression, "columns": {}}
+    else:
+        meta = _read_meta(fname)
+
+    chunk = meta["chunk"]
+
+    for k, v in list(vardict.items()):
+        v = np.atleast_1d(np.squeeze(v))
+
+        if meta["nrows"] is None:
+            meta["nrows"] = len(v)
+
+        assert len(v) == meta["nrows"], "columns must have equal length"
+
+        os.makedirs(os.path.join(fname, k), exist_ok=True)
+
+        blocks = [v[i : i + chunk] for i in range(0, len(v), chunk)]
+
+        with ThreadPoolExecutor(nthreads) as pool:
+            jobs = [
+                pool.submit(_write_chunk, fname, k, i, b, meta["compression"])
+                for i, b in enumerate(blocks)
+            ]
+            [job.result() for job in jobs]
+
+        stats = [_chunk_stats(b) for b in blocks]
+
+        meta["columns"][k] = {
+            "dtype": v.dtype.str,
+            "shape": list(v.shape[1:]),
+            "min": [s[0] for s in stats],
+            "max": [s[1] for s in stats],
+        }
+
+    _write_meta(fname, meta)
+
+
+def save_h5(fname, vardict, mode="a", chunks=None, compression=None,
+            nthreads=1):
+    """Generic HDF5 (or column store) writer.
 
     vardict : {'name1': var1, 'name2': va2, 'name3': var3}
+    chunks : number of rows per chunk (contiguous HDF5 if None)
+    compression : 'gzip'/'lzf' (HDF5), any for zlib (stores), None for none
+    nthreads : number of threads to compress chunks (stores)
+
+    File names ending with STORE_EXT are written as directory-of-chunks
+    column stores: a directory per column with one (compressed) file per
+    chunk of rows, and chunk min/max for predicate reads (see read_h5).
     """
+    if is_store(fname):
+        compression = "zlib" if compression else None
+        return _save_store(fname, vardict, mode, chunks, compression, nthreads)
+
     with h5py.File(fname, mode) as f:
         for k, v in list(vardict.items()):
             if k in f:
                 f[k][:] = np.squeeze(v)
+            elif chunks or compression:
+                v = np.squeeze(v)
+                f.create_dataset(
+                    k,
+                    data=v,
+                    chunks=(min(chunks or CHUNK, len(v)),) + v.shape[1:],
+                    compression=compression,
+                )
             else:
                 f[k] = np.squeeze(v)
 
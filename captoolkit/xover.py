@@ -11,6 +11,7 @@ import warnings
 import matplotlib.pyplot as plt
 from scipy.interpolate import InterpolatedUnivariateSpline
 from datetime import datetime
+from contextlib import nullcontext
 from scipy import stats
 from mpl_toolkits.axes_grid1.inset_locator import inset_axes
 
@@ -24,7 +25,8 @@ from mpl_toolkits.axes_grid1.inset_locator import inset_axes
     processing. For external processing please use "tile.py" with a provided extent, as the program uses the tile 
     numbering to determine which tiles should be crossed together. To further speed up processing the user can 
     down-sample the tracks, allowing for a faster computation of the crossing point (the difference is computed using 
-    the full track sampling).
+    the full track sampling). Tiles of files indexed with "tile.py -i" are passed as "file:tile" (or "file:*" for all
+    tiles with -f), reading the buffer from the neighbouring tiles and keeping only the crossovers inside the tile.
     
     Please type "xover.py -h" for help with input!
     
@@ -46,7 +48,8 @@ def get_args():
             description='Program for computing satellite/airborne crossovers.')
     parser.add_argument(
             'input', metavar='ifile', type=str, nargs=2,
-            help='name of two input files to cross (HDF5)')
+            help=('name of two input files to cross (HDF5), or "file:tile" '
+                  'of files indexed with tile.py -i ("file:*" with -f)'))
     parser.add_argument(
             '-o', metavar='ofile', dest='output', type=str, nargs=1,
             help='name of output file (HDF5)',
@@ -99,6 +102,10 @@ def get_args():
             '-i', dest='diff', action='store_true',
             help=('do not interpolate vars just take diff'),
             default=False)
+    parser.add_argument(
+            '--manifest', metavar=('file'), dest='manifest', type=str, nargs=1,
+            help=('tile manifest (tile.py -a) to process largest tiles first'),
+            default=[None],)
             
     return parser.parse_args()
 
@@ -216,9 +223,117 @@ def tile_num(fname):
     i = l.index('tile')
     return int(l[i+1])
 
+def split_ref(fref):
+    """ Split 'file:tile' reference into file name and tile number. """
+    fname, sep, tile = fref.rpartition(':')
+    if sep and tile.isdigit():
+        return fname, int(tile)
+    return fref, None
+
+
+def tile_name(fref):
+    """ Name for outputs of 'file:tile' reference (file name if no tile). """
+    fname, tile = split_ref(fref)
+    if tile is None:
+        return fname
+    path, ext = os.path.splitext(fname)
+    return path + '_tile_%03d' % tile + ext
+
+
+def read_tile(fref, vnames=None):
+    """
+    Read data of 'file:tile' reference (file indexed with tile.py -i).
+
+    The rows of the tile and of its neighbours are read from the file
+    (sorted by tile), and the buffer is selected with the tile bbox.
+    Returns dict of 1d arrays (in original order), mask of the rows
+    of the tile itself (no buffer), bbox of the tile, and projection
+    (EPSG number) of the bbox. Data is empty if tile is not in index.
+    """
+    fname, tile = split_ref(fref)
+    path, ext = os.path.splitext(fname)
+
+    with h5py.File(path + '_INDEX' + ext, 'r') as fi, \
+         h5py.File(fname, 'r') as f:
+
+        tiles = fi['tile_num'][:]
+        bboxs = fi['bbox'][:]
+        i_start = fi['i_start'][:]
+        n_rows = fi['n_rows'][:]
+        buff, proj = fi.attrs['buff'], str(fi.attrs['proj'])
+        xvar, yvar = fi.attrs['xvar'], fi.attrs['yvar']
+
+        if tile not in tiles:
+            return {}, np.array([], dtype=bool), None, proj
+
+        bbox = list(bboxs[tiles == tile][0])
+        xmin, xmax, ymin, ymax = bbox
+
+        # Tiles overlapping the buffered bbox
+        k, = np.where( (bboxs[:,0] <= xmax+buff) & (bboxs[:,1] >= xmin-buff) &
+                       (bboxs[:,2] <= ymax+buff) & (bboxs[:,3] >= ymin-buff) )
+
+        def read(d):
+            return np.concatenate([d[i:i+n] for i, n in
+                                   zip(i_start[k], n_rows[k])])
+
+        if vnames is None: vnames = list(f.keys())
+        vnames = set([v for v in vnames if v and v in f] + [xvar, yvar])
+
+        data = {v: read(f[v]) for v in vnames}
+        row = read(fi['row'])
+        own = np.repeat(tiles[k] == tile, n_rows[k])
+
+    x, y = transform_coord('4326', proj, data[xvar], data[yvar])
+
+    # Select buffer and restore original order
+    i_buff, = np.where( (x >= xmin-buff) & (x <= xmax+buff) &
+                        (y >= ymin-buff) & (y <= ymax+buff) )
+    i_buff = i_buff[np.argsort(row[i_buff])]
+
+    data = {v: d[i_buff] for v, d in data.items()}
+
+    return data, own[i_buff], bbox, proj
+
+
+def sort_tiles(files, fmanifest):
+    """
+    Sort tiles by number of points (tile.py -a manifest), largest first.
+
+    Tiles are given as tile files (*_tile_NNN*) or "file:tile" references.
+    Files without tile number (or not in the manifest) are left last.
+    """
+    with h5py.File(fmanifest, 'r') as fm:
+        n_pts = dict(zip(fm['tile_num'][:], fm['n_pts'][:]))
+
+    def size(fname):
+        fname, tile = split_ref(fname)
+        if tile is None:
+            name = os.path.splitext(os.path.basename(fname))[0].split('_')
+            if 'tile' not in name: return -1
+            tile = int(name[name.index('tile') + 1])
+        return n_pts.get(tile, -1)
+
+    return sorted(files, key=size, reverse=True)
+
+
 def match_tiles(str1,str2,key):
     """ Matches tile indices """
 
+    # Indexed files (tile.py -i): tiles with data in any of the files
+    if str1.endswith(':*') and str2.endswith(':*'):
+
+        tiles = []
+        for fname in [str1[:-2], str2[:-2]]:
+            path, ext = os.path.splitext(fname)
+            with h5py.File(path + '_INDEX' + ext, 'r') as fi:
+                tiles.append(fi['tile_num'][fi['n_rows'][:] > 0])
+
+        tiles = np.union1d(*tiles)
+
+        return ([str1[:-1] + str(t) for t in tiles],
+                [str2[:-1] + str(t) for t in tiles])
+
     # Get file names
     files1 = glob.glob(str1)
     files2 = glob.glob(str2)
@@ -266,6 +381,7 @@ njobs  = args.njobs[0]
 tile   = args.tile
 plot   = args.plot
 diff   = args.diff
+fmanifest = args.manifest[0]
 
 print('parameters:')
 for arg in list(vars(args).items()): print(arg)
@@ -316,9 +432,23 @@ def main(ifile1, ifile2):
 
     print(('crossing files:', ifile1, ifile2, '...'))
 
+    # Plain files, or tiles of indexed files (data + buffer)
+    if split_ref(ifile1)[1] is None:
+        fi1, fi2 = h5py.File(ifile1, 'r'), h5py.File(ifile2, 'r')
+        bbox_tile, proj_tile = None, None
+    else:
+        fi1, _, bbox_tile, proj_tile = read_tile(ifile1, vnames + ['h_bs'])
+        fi2 = read_tile(ifile2, vnames + ['h_bs'])[0]
+
+        # Tile not in index (e.g. split tile of adaptive index)
+        if not fi1 or not fi2:
+            print(('SKIP FILES: TILE NOT IN INDEX:', ifile1, ifile2))
+            return
+
+        fi1, fi2 = nullcontext(fi1), nullcontext(fi2)
+
     # Load all 1d variables needed
-    with h5py.File(ifile1, 'r') as f1, \
-         h5py.File(ifile2, 'r') as f2:
+    with fi1 as f1, fi2 as f2:
              
         # File 1
         orbit1  = f1[ovar][:]
@@ -647,7 +777,7 @@ def main(ifile1, ifile2):
                 
                 # Create RMSE of crossovers
                 rms_a = np.std(ha[0:nobs]) / n_rms
-                rms_d = np.std(hd[0:nobs]) / n_rms
+                rms_d = np.std(hb[0:nobs]) / n_rms
                 
                 # Compute differences and save parameters
                 out_i[0]  = xi
@@ -756,6 +886,24 @@ def main(ifile1, ifile2):
         print('no crossovers found!')
         return
 
+    # Keep only crossovers inside the tile (no duplicates between tiles)
+    if bbox_tile is not None:
+
+        xmin_t, xmax_t, ymin_t, ymax_t = bbox_tile
+
+        # Crossover coords in the projection of the tile bbox
+        if proj_tile != proj:
+            xt, yt = transform_coord(proj, proj_tile, out[:,0], out[:,1])
+        else:
+            xt, yt = out[:,0], out[:,1]
+
+        out = out[(xt >= xmin_t) & (xt < xmax_t) &
+                  (yt >= ymin_t) & (yt < ymax_t)]
+
+        if len(out) == 0:
+            print('no crossovers found inside tile!')
+            return
+
     # Remove the two id columns if they are empty 
     out = out[:,:-2] if np.isnan(out[:,-1]).all() else out
 
@@ -766,9 +914,9 @@ def main(ifile1, ifile2):
 
     # Create output file name if not given
     if ofile_ is None:
-        path, ext = os.path.splitext(ifile1)
+        path, ext = os.path.splitext(tile_name(ifile1))
         if tile:
-            tilenum = str(tile_num(ifile1))
+            tilenum = str(tile_num(tile_name(ifile1)))
         else:
             tilenum = ''
         ofile = path + 'xovers_'+tilenum + ext
@@ -790,7 +938,7 @@ def main(ifile1, ifile2):
         f[oovar_a] = out[:,18]
         f[oovar_d] = out[:,19]
         f['dhdt']  = out[:,8]
-        f['rmse']  = out[20]
+        f['rmse']  = out[:,20]
         
         # Add extra parameters
         if flag_bs:
@@ -898,8 +1046,14 @@ else:
     # Get matching tiles
     files1, files2 = match_tiles(str1, str2, 'tile')
 
+    # Largest tiles first (load balancing)
+    if fmanifest:
+        files1_ = sort_tiles(files1, fmanifest)
+        files2 = [files2[files1.index(f)] for f in files1_]
+        files1 = files1_
+
     # Run tiles in parallel
-    Parallel(n_jobs=njobs, verbose=5)(delayed(main)(files1[i],files2[i], n) for i in range(len(files1)))
+    Parallel(n_jobs=njobs, verbose=5)(delayed(main)(files1[i],files2[i]) for i in range(len(files1)))
 
 
 